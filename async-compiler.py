@@ -1,26 +1,15 @@
-import os, sys, shutil
+import os, sys, shutil, multiprocessing
 import atexit
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import time
 
-import pyparsing
-import grammar
-import ntpath
-import csv
-import os
-
-if len(sys.argv) > 1:
-    os.chdir(sys.argv[1])
-
-with open('tmp_all_vars.csv', 'rb') as csvfile:
-    rows = list(csv.reader(csvfile))
-    heap = dict(zip(rows[0],
-                    [float(e) if e != 'NA' else
-                     None for e in rows[2]]))
+import folding
+import watch
 
 compiler_in = "_compiler_in"
 compiler_out = "_compiler_out"
+heap_path = "tmp_all_vars.csv"
 
 def ensure_directory(_path):
     if not os.path.exists(_path):
@@ -30,52 +19,58 @@ def safe_delete(_path):
     if os.path.exists(_path):
         shutil.rmtree(_path)
 
-ensure_directory(compiler_in)
-ensure_directory(compiler_out)
-
 def shutdown():
     print "Shutting down"
     safe_delete(compiler_in)
     safe_delete(compiler_out)
 
-atexit.register(shutdown)
-
 class CompilerHandler(FileSystemEventHandler):
-    def on_modified(self, event):
-        filename = ntpath.basename(event.src_path)
+    def on_any_event(self, event):
+        if event.is_directory or event.event_type not in ('created', 'modified'):
+            return
+        filename = os.path.basename(event.src_path)
 
         if filename == "shutdown.txt":
             shutdown()
             os._exit(0)
 
         else:
-            print "Compiling " + filename
-            try:
-                code = open(event.src_path, 'r').readline().strip()
-                if code[0] == '"':
-                    code = code[1:-1]
-                compiled = grammar.formula.parseString(code)[0].compile(heap)
-                print "Compilation successful"
-                print compiled
-                with open(compiler_out + "\\" + filename, 'w') as f:
-                    f.write(compiled)
-
-            except pyparsing.ParseException as e:
-                print str(e)
-            except:
-                print str(sys.exc_info()[0])
-                print
-
-observer = Observer()
-observer.schedule(CompilerHandler(), path = compiler_in)
-observer.start()
-
-print "Ready to compile\n"
-
-try:
-    while True:
-        time.sleep(1)
-except KeyboardInterrupt:
-    observer.stop()
-
-observer.join()
+            watcher.submit(event.src_path)
+
+# The heap is reloaded when eViews rewrites it, see Watcher.reload_heap
+class HeapHandler(FileSystemEventHandler):
+    def on_any_event(self, event):
+        paths = [event.src_path, getattr(event, 'dest_path', '')]
+        if not event.is_directory and any(os.path.basename(path) == heap_path for path in paths):
+            watcher.submit_heap()
+
+# The worker processes import this module on Windows: everything else only runs in the main process
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    if len(sys.argv) > 1:
+        os.chdir(sys.argv[1])
+
+    ensure_directory(compiler_in)
+    ensure_directory(compiler_out)
+    atexit.register(shutdown)
+
+    # Formulas are compiled concurrently, see watch.py
+    # Fixed parameters are folded into the equations, if requested, see folding.py
+    watcher = watch.Watcher(compiler_out, heap_path, fixed = folding.requested_fixed())
+
+    observer = Observer()
+    observer.schedule(CompilerHandler(), path = compiler_in)
+    observer.schedule(HeapHandler(), path = '.')
+    observer.start()
+
+    print "Ready to compile\n"
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        observer.stop()
+
+    observer.join()
+    watcher.close()
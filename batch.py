@@ -0,0 +1,178 @@
+import sys, argparse, multiprocessing
+
+import pyparsing
+import compilation
+import elements
+import incremental
+import folding
+import namedsets
+import cse
+
+# Compiles a whole model file, one formula per line, in parallel
+# Blank lines and comment lines (starting with ' or #) are skipped
+#
+# The output file lists, in the order of the model file, each formula as an eViews comment
+# followed by its compiled equations, e.g.
+#   ' 12: Q[c] = QD[c] + QM[c], c in 01 02
+#   Q_01 = QD_01 + QM_01
+#   Q_02 = QD_02 + QM_02
+# and formulas which failed to compile as error records, e.g.
+#   ' ERROR 13: = QD[c] + QM[c], c in 01 02
+#   ' Expected "sum" (at char 0), (line:1, col:1)
+#
+# With --state, the compilation is incremental: only the formulas which read heap values
+# that changed since the previous run are compiled again, see incremental.py
+#
+# With --fixed, the fixed parameters listed in the given file are folded into the equations, see folding.py
+#
+# With --sets, the iterators can refer to the named sets defined in the given file, see namedsets.py
+#
+# With --cse, the sums and value(...) functions which occur more than once in the model are replaced
+# by auxiliary variables, see cse.py, whose equations are listed first, e.g.
+#   ' COMMON SUBEXPRESSIONS
+#   CSE_5D41402A = QD_01_01 + QD_01_02 + QD_01_03
+
+COMMENT_CHARACTERS = "'#"
+
+def read_model(path):
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    return [(number, compilation.clean_code(line)) for number, line in enumerate(lines, 1)
+            if line.strip() and line.strip()[0] not in COMMENT_CHARACTERS]
+
+# Each worker process loads the heap once; a HeapStore is memory-mapped,
+# so that all workers share the same pages
+heap = None
+# Whether the heap values read by each formula are recorded, for incremental compilation
+record = False
+# Names of the fixed parameters folded into the equations, if any
+fixed = None
+# Whether sums and value(...) functions are marked, for common subexpression extraction
+mark = False
+
+def init_worker(heap_path, record_reads = False, fixed_parameters = None, mark_subexpressions = False, named_sets = None):
+    global heap, record, fixed, mark
+    heap = compilation.load_heap(heap_path)
+    record = record_reads
+    fixed = fixed_parameters
+    mark = mark_subexpressions
+    namedsets.define(named_sets)
+
+# Returns (line number, code, output, error message, heap values read or None)
+def compile_entry(entry):
+    formulaHeap = incremental.RecordingHeap(heap) if record else heap
+    reads = formulaHeap.reads if record else None
+    if mark:
+        with cse.marking():
+            return compile_with(formulaHeap, entry, fixed) + (reads,)
+    return compile_with(formulaHeap, entry, fixed) + (reads,)
+
+# Returns (line number, code, output, error message), compiling against the given heap
+def compile_with(formulaHeap, entry, fixed = None):
+    number, code = entry
+    try:
+        return number, code, compilation.parse(code).compile(formulaHeap, fixed), None
+    except (pyparsing.ParseException, elements.InvalidReferences) as e:
+        return number, code, None, str(e)
+    except Exception as e:
+        return number, code, None, repr(e)
+
+def format_result(result):
+    number, code, output, error = result[:4]
+    if error is None:
+        return "' %d: %s\n%s\n" % (number, code, output) if output else "' %d: %s\n" % (number, code)
+    else:
+        return "' ERROR %d: %s\n' %s\n" % (number, code, error.replace('\n', ' '))
+
+def compile_results(entries, heap_path = 'tmp_all_vars.csv', processes = None, record_reads = False, fixed = None,
+                    mark_subexpressions = False, sets = None):
+    if processes == 1:
+        init_worker(heap_path, record_reads, fixed, mark_subexpressions, sets)
+        for entry in entries:
+            yield compile_entry(entry)
+        return
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, init_worker, (heap_path, record_reads, fixed, mark_subexpressions, sets))
+    try:
+        # imap returns the results in the order of the entries, as soon as they are available
+        for result in pool.imap(compile_entry, entries, chunksize = max(1, len(entries) / (8 * processes))):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+# Compiles the model file into the output file, and returns the number of formulas which failed
+# If state_path is given, only the formulas which read heap values that changed since the previous run,
+# or the variables in changed if given, are compiled again; the outputs of the others are reused
+# If fixed is given, the fixed parameters it names are folded, see folding.py
+# If extract_subexpressions is true, the outputs are held until all the formulas are compiled,
+# and the common subexpressions are extracted from them, see cse.py
+# If sets is given, as [(name, Lst)], the iterators can refer to these named sets, see namedsets.py
+def compile_model(model_path, output_path, heap_path = 'tmp_all_vars.csv', processes = None,
+                  state_path = None, changed = None, fixed = None, extract_subexpressions = False, sets = None):
+    entries = read_model(model_path)
+    state = incremental.State.load(state_path, fixed, sets) if state_path else None
+    if state is not None:
+        currentHeap = compilation.load_heap(heap_path)
+        stale = [(number, code) for number, code in entries if state.stale(code, currentHeap, changed)]
+    else:
+        stale = entries
+    staleNumbers = set(number for number, _ in stale)
+    results = compile_results(stale, heap_path, processes, state is not None, fixed,
+                              extract_subexpressions, sets) if stale else iter([])
+
+    def all_results():
+        for number, code in entries:
+            if number in staleNumbers:
+                result = next(results)
+                if state is not None:
+                    if result[3] is None:
+                        state.record(code, result[2], result[4])
+                    else:
+                        state.forget(code)
+            else:
+                result = (number, code, state.output(code), None)
+            yield result
+
+    errors = 0
+    with open(output_path, 'w') as f:
+        if extract_subexpressions:
+            allResults = list(all_results())
+            definitions, outputs = cse.extract(result[2] or '' for result in allResults)
+            if definitions:
+                f.write("' COMMON SUBEXPRESSIONS\n" + cse.format_definitions(definitions))
+            allResults = [result[:2] + (output if result[3] is None else None,) + result[3:4]
+                          for result, output in zip(allResults, outputs)]
+        else:
+            # Outputs kept in the state may have been marked by a previous run with extraction
+            allResults = (result[:2] + (result[2] and cse.unmarked(result[2]),) + result[3:4] for result in all_results())
+        for result in allResults:
+            errors += result[3] is not None
+            f.write(format_result(result))
+    if state is not None:
+        state.retain(code for _, code in entries)
+        state.save()
+    return errors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Compile a model file, one formula per line")
+    parser.add_argument("model", help = "file of formulas")
+    parser.add_argument("output", help = "file where the compiled equations are written")
+    parser.add_argument("--heap", default = 'tmp_all_vars.csv', help = "values of all variables (default: tmp_all_vars.csv)")
+    parser.add_argument("--processes", type = int, help = "number of worker processes (default: number of cores)")
+    parser.add_argument("--state", help = "file where the outputs and the heap values read are kept between runs, "
+                                          "to only compile the formulas affected by changes in the heap")
+    parser.add_argument("--changed", nargs = '+', help = "with --state, the variables which changed, "
+                                                        "instead of comparing the heap values")
+    parser.add_argument("--fixed", help = "file of the names of fixed parameters, whose heap values are folded into the equations")
+    parser.add_argument("--cse", action = 'store_true', help = "replace the sums and value(...) functions which occur more "
+                                                             "than once by auxiliary variables")
+    parser.add_argument("--sets", help = "file of named sets of iterator values, e.g. %%coms in 01..24")
+    args = parser.parse_args()
+
+    fixed = folding.read_fixed(args.fixed) if args.fixed else None
+    sets = namedsets.read_sets(args.sets) if args.sets else None
+    errors = compile_model(args.model, args.output, args.heap, args.processes, args.state, args.changed, fixed, args.cse, sets)
+    if errors > 0:
+        print str(errors) + " formula(s) failed to compile"
+    sys.exit(1 if errors > 0 else 0)
@@ -0,0 +1,184 @@
+import os, sys, json, time, random, argparse, platform, shutil, subprocess, tempfile
+
+import grammar
+import fastparser
+import heapstore
+from heapstore import HeapStore
+
+# Benchmarks of the compilation phases, on ThreeME-shaped workloads
+#
+# The heap and the formulas are generated synthetically, over 24 commodities and 24 sectors
+# by default, and can be scaled up with --scale, which multiplies the number of commodities
+# Each phase is timed separately (best of --repeat runs):
+#   parse       grammar.formula.parseString
+#   parse_fast  fastparser.parse_formula
+#   iterate     Formula.iter_values, the tuples of values in the Layout of the Formula
+#   conditions  LayoutCondition.evaluate_each over these values, vectorized if possible
+#   compile     Formula.compile, including the iterate and conditions phases
+#   heap_csv    reading tmp_all_vars.csv, or the CSV passed with --heap
+#   heap_build  HeapStore.open, building the binary cache
+#   heap_open   HeapStore.open, memory-mapping the existing cache
+#
+# Results are written as JSON, one record per benchmark and phase, so that runs on
+# different commits can be compared with --compare
+
+VARIABLES = ['Q', 'CH', 'G', 'I', 'X']
+
+def codes(count):
+    width = max(2, len(str(count)))
+    return ['%0*d' % (width, i) for i in range(1, count + 1)]
+
+# Values of all variables used by the formulas, with about 10% of zeros and 5% of NA values
+def synthetic_heap(commodities, sectors, seed = 42):
+    rng = random.Random(seed)
+    def value():
+        r = rng.random()
+        return None if r < 0.05 else 0. if r < 0.15 else round(rng.uniform(1, 1000), 3)
+    heap = {}
+    for c in codes(commodities):
+        for v in VARIABLES:
+            for suffix in ['', 'D', 'M']:
+                heap['%s%s_%s' % (v, suffix, c)] = value()
+                for s in codes(sectors):
+                    heap['%s%s_%s_%s' % (v, suffix, c, s)] = value()
+    for i in range(1, commodities + 1):
+        for j in range(1, sectors + 1):
+            heap['PHI_%d_%d' % (i, j)] = value()
+    return heap
+
+# Writes the heap in the format of tmp_all_vars.csv: names, an empty row, then the values
+def write_heap_csv(heap, path):
+    names = sorted(heap)
+    with open(path, 'w') as f:
+        f.write(','.join(['obs'] + names) + '\n')
+        f.write(',' * len(names) + '\n')
+        f.write(','.join(['2006'] + ['NA' if heap[name] is None else repr(heap[name]) for name in names]) + '\n')
+
+def synthetic_formulas(commodities, sectors):
+    c = ' '.join(codes(commodities))
+    s = ' '.join(codes(sectors))
+    v = ' '.join(VARIABLES)
+    return [
+        ('placeholders', "|V|[c, s] = |V|D[c, s] + |V|M[c, s], V in %s, c in %s, s in %s" % (v, c, s)),
+        ('condition', "|V|[c, s] = |V|D[c, s] + |V|M[c, s] if |V|D[c, s] > 0 and |V|M[c, s] <> 0, "
+                      "V in %s, c in %s, s in %s" % (v, c, s)),
+        ('sum', "|V|[c] = sum(|V|D[c, s] if |V|D[c, s] <> 0, s in %s), V in %s, c in %s" % (s, v, c)),
+        ('nested_sum', "|V| = sum(sum(|V|[c, s] if |V|[c, s] > |V|M[c, s], s in %s) if |V|[c] <> 0, c in %s), "
+                       "V in %s" % (s, c, v)),
+        ('pv', "!pv |V|[c] = sum(|V|D[c, s] + |V|M[c, s] if |V|D[c, s] <> 0, s in %s), V in %s, c in %s" % (s, v, c)),
+        ('loop_counter', "X[c, s] = PHI[$c, $s] * Q[c, s], c in %s, s in %s" % (c, s)),
+    ]
+
+# Best time of repeat runs of function, in seconds
+def best_time(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+# The phases time the paths which Formula.compile uses, see Formula.iter_conditions
+def benchmark_formula(code, heap, repeat):
+    formula = grammar.formula.parseString(code)[0]
+    valuesList = list(formula.iter_values())
+    if len(formula.conditions) > 0:
+        condition = formula.conditions[0].at(formula.layout())
+        conditions = lambda: condition.evaluate_each(valuesList, heap)
+        # numpy is imported on the first vectorized evaluation, see vectorized.load
+        conditions()
+    else:
+        conditions = lambda: None
+    return [('parse', best_time(lambda: grammar.formula.parseString(code), repeat), None),
+            ('parse_fast', best_time(lambda: fastparser.parse_formula(code), repeat), None),
+            ('iterate', best_time(lambda: list(formula.iter_values()), repeat), len(valuesList)),
+            ('conditions', best_time(conditions, repeat), len(valuesList)),
+            ('compile', best_time(lambda: formula.compile(heap), repeat), len(valuesList))]
+
+# Times the loading of a copy of the CSV, so that the cache next to the original is left alone
+def benchmark_heap(csv_path, repeat):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'tmp_all_vars.csv')
+        shutil.copy(csv_path, path)
+        def build():
+            if os.path.exists(path + '.heap'):
+                os.remove(path + '.heap')
+            HeapStore.open(path).close()
+        count = len(heapstore.read_csv(path))
+        results = [('heap_csv', best_time(lambda: heapstore.read_csv(path), repeat), count),
+                   ('heap_build', best_time(build, repeat), count),
+                   ('heap_open', best_time(lambda: HeapStore.open(path).close(), repeat), count)]
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+# Runs the benchmarks against a synthetic heap, loaded through a HeapStore as in the compiler
+# Heap loading is timed on heap_path if given, e.g. a real tmp_all_vars.csv
+def run(commodities = 24, sectors = 24, repeat = 3, only = None, heap_path = None):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'tmp_all_vars.csv')
+        write_heap_csv(synthetic_heap(commodities, sectors), path)
+        heap = HeapStore.open(path)
+        results = []
+        for name, code in synthetic_formulas(commodities, sectors):
+            if only is None or name in only:
+                for phase, seconds, size in benchmark_formula(code, heap, repeat):
+                    results.append({"benchmark": name, "phase": phase, "size": size, "seconds": seconds})
+        heap.close()
+        if only is None or 'heap' in only:
+            for phase, seconds, size in benchmark_heap(heap_path or path, repeat):
+                results.append({"benchmark": "heap", "phase": phase, "size": size, "seconds": seconds})
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr = devnull,
+                                           cwd = os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def report(commodities, sectors, repeat, results):
+    return {"commit": git_commit(), "python": platform.python_version(), "time": int(time.time()),
+            "commodities": commodities, "sectors": sectors, "repeat": repeat, "results": results}
+
+# Lines comparing the results with those of a previous report, as ratios of the times
+def compare(previous, results):
+    before = dict(((r["benchmark"], r["phase"]), r["seconds"]) for r in previous["results"])
+    lines = []
+    for r in results:
+        key = (r["benchmark"], r["phase"])
+        if key in before and before[key] > 0:
+            lines.append("%-14s %-12s %10.4f s %10.4f s  x%.2f" % (r["benchmark"], r["phase"], before[key],
+                                                                   r["seconds"], r["seconds"] / before[key]))
+    return lines
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmark the compilation phases on synthetic ThreeME-shaped workloads")
+    parser.add_argument("--commodities", type = int, default = 24, help = "number of commodities (default: 24)")
+    parser.add_argument("--sectors", type = int, default = 24, help = "number of sectors (default: 24)")
+    parser.add_argument("--scale", type = int, default = 1, help = "multiplies the number of commodities, e.g. 10 or 100")
+    parser.add_argument("--repeat", type = int, default = 3, help = "runs of each phase, the best time is kept (default: 3)")
+    parser.add_argument("--only", nargs = '+', help = "benchmarks to run, among: heap " +
+                        ' '.join(name for name, _ in synthetic_formulas(1, 1)))
+    parser.add_argument("--heap", help = "CSV on which heap loading is timed, e.g. tmp_all_vars.csv (default: synthetic heap)")
+    parser.add_argument("--output", help = "file where the JSON results are written (default: stdout)")
+    parser.add_argument("--compare", help = "JSON results of a previous run, to compare with")
+    args = parser.parse_args()
+
+    commodities = args.commodities * args.scale
+    results = report(commodities, args.sectors, args.repeat, run(commodities, args.sectors, args.repeat, args.only, args.heap))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+    else:
+        json.dump(results, sys.stdout, indent = 2)
+        print
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            for line in compare(json.load(f), results["results"]):
+                sys.stderr.write(line + '\n')
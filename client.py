@@ -0,0 +1,38 @@
+import os, sys, time, random, socket, multiprocessing
+
+import protocol
+
+# Thin client for the compile server, called by eViews in place of imcompiler.py
+# If no server is running, the formulas are compiled in-process instead
+def compile_formulas(formulas, address = None):
+    try:
+        return protocol.request({"formulas": formulas}, address)["outputs"]
+    except socket.error:
+        # Only import the compiler when the server is unavailable, to keep the client light
+        import compilation
+        heap = compilation.load_heap()
+        return [compilation.compile_code(code, heap) for code in formulas]
+
+# When no server is running, the worker processes of parallel compilation, see parallel.py,
+# import this module on Windows, including in the executable built by PyInstaller
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    # The formula to be compiled is passed in the first command line argument
+    # If no formula was passed, exit
+    if len(sys.argv) < 2:
+        sys.exit(0)
+
+    output = compile_formulas([sys.argv[1]])[0]
+
+    compiler_out = "_compiler_out"
+    if not os.path.exists(compiler_out):
+        os.makedirs(compiler_out)
+
+    # Writes the output, compiled code or error message to a file in _compiler_out
+    filename = str(int(time.time())) + str(random.randint(0, 999)) + ".txt"
+    with open(os.path.join(compiler_out, filename), 'w') as f:
+        f.write(output)
+
+    # Prints the filename to stdout, so that eViews can then load it
+    print filename
@@ -0,0 +1,94 @@
+import os, sys, shutil
+
+# The grammar, and pyparsing, are only imported when a formula is neither in the parse cache
+# nor parsed by fastparser.py, see ParseCache.parse: eViews waits for the compiler on every formula
+from heapstore import HeapStore
+from parsecache import ParseCache
+from resultcache import ResultCache
+from incremental import RecordingHeap
+from elements import InvalidReferences
+import stats
+import cse
+
+parseCache = ParseCache()
+
+# Outputs of the formulas already compiled against the same heap values, see resultcache.py
+# Set the MODEL_RESULT_CACHE environment variable to 0 to always compile
+resultCache = None if os.environ.get('MODEL_RESULT_CACHE') == '0' else ResultCache()
+
+# Load values of all variables, as a mapping of {name: value}
+# NA values are loaded as None
+def load_heap(path = 'tmp_all_vars.csv'):
+    with stats.phase('heap'):
+        return HeapStore.open(path)
+
+# eViews may pass the formula between double quotes
+def clean_code(code):
+    code = code.strip()
+    if code[:1] == '"':
+        code = code[1:-1]
+    return code.strip()
+
+def parse(code):
+    with stats.phase('parse'):
+        return parseCache.parse(code)
+
+def compile_formula(code, heap, fixed = None):
+    return parse(code).compile(heap, fixed)
+
+# Compiles the formula into the file f, or copies its output from the result cache,
+# and returns the number of bindings compiled
+def write_formula(code, heap, f, fixed = None):
+    # Marked outputs are only meant for extraction, see cse.py
+    if resultCache is None or cse.enabled:
+        return parse(code).write(heap, f, fixed)
+    cached = resultCache.get(code, heap, fixed)
+    if cached is not None:
+        count, output = cached
+        with output:
+            shutil.copyfileobj(output, f)
+        return count
+    recordingHeap = RecordingHeap(heap)
+    entry = resultCache.entry(code, f, fixed)
+    try:
+        count = parse(code).write(recordingHeap, entry, fixed)
+    except:
+        entry.discard()
+        raise
+    entry.commit(recordingHeap.reads, count)
+    return count
+
+# A ParseException can only have been raised if pyparsing was imported,
+# so it is never imported just to check for one
+def is_parse_error(e):
+    pyparsing = sys.modules.get('pyparsing')
+    return pyparsing is not None and isinstance(e, pyparsing.ParseException)
+
+# Error message for the exception being handled, prefixed by "Error\r\n",
+# which eViews checks for on the first line of the output
+# Parse errors and invalid heap references are detailed, see Formula.check_references
+def error_message():
+    e = sys.exc_info()[1]
+    if is_parse_error(e) or isinstance(e, InvalidReferences):
+        return "Error\r\n" + str(e)
+    else:
+        return "Error\r\n" + str(sys.exc_info()[0])
+
+# Compiles the formula, or returns an error message
+def compile_code(code, heap):
+    try:
+        return compile_formula(clean_code(code), heap)
+    except:
+        return error_message()
+
+# Compiles the formula into the file f, one equation at a time, so that the whole output
+# is never held in memory. Fixed parameters, if given, are folded, see folding.py
+# If the compilation fails, whatever was already written
+# is replaced with the error message
+def write_code(code, heap, f, fixed = None):
+    try:
+        write_formula(clean_code(code), stats.counted(heap), f, fixed)
+    except:
+        f.seek(0)
+        f.truncate()
+        f.write(error_message())
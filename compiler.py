@@ -1,33 +1,40 @@
-import os, sys, csv
-
-import pyparsing
-import grammar
-
-# The code to be compiled is passed in file in.txt
-with open("in.txt", "r") as f:
-    code = f.readline().strip()
-
-if code[0] == '"':
-    code = code[1:-1]
-
-# Load values of all variables
-with open('tmp_all_vars.csv', 'rb') as csvfile:
-    rows = list(csv.reader(csvfile))
-    heap = dict(zip(rows[0],
-                    [float(e) if e != 'NA' else
-                     None for e in rows[2]]))
-
-# Compilation
-if len(sys.argv) > 1:
-    output = grammar.formula.parseString(code)[0].compile(heap)
-else:
-    try:
-        output = grammar.formula.parseString(code)[0].compile(heap)
-    except pyparsing.ParseException as e:
-        output = "Error\r\n" + str(e)
-    except Exception as e:
-        output = "Error\r\n" + repr(e)
-
-# Writes the output, compiled code or error message to file out.txt
-with open("out.txt", 'w') as f:
-    f.write(output)
+import os, sys, multiprocessing
+
+import compilation
+import stats
+import folding
+
+# The worker processes of parallel compilation, see parallel.py, import this module on Windows,
+# including in the executable built by PyInstaller: everything else only runs in the main process
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    # The code to be compiled is passed in file in.txt
+    with open("in.txt", "r") as f:
+        code = f.readline().strip()
+
+    if code[0] == '"':
+        code = code[1:-1]
+
+    # Statistics of the compilation, if requested, see stats.py
+    stats.start_if_requested()
+
+    # Load values of all variables
+    heap = stats.counted(compilation.load_heap())
+
+    # Fixed parameters to fold into the equations, if requested, see folding.py
+    fixed = folding.requested_fixed()
+
+    # Compilation, writing the output, compiled code or error message to file out.txt
+    # The equations are written as they are compiled
+    with open("out.txt", 'w') as f:
+        if len(sys.argv) > 1:
+            compilation.write_formula(code, heap, f, fixed)
+        else:
+            try:
+                compilation.write_formula(code, heap, f, fixed)
+            except Exception as e:
+                f.seek(0)
+                f.truncate()
+                f.write("Error\r\n" + (str(e) if compilation.is_parse_error(e) else repr(e)))
+    stats.finish("out.txt")
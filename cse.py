@@ -0,0 +1,95 @@
+import re, hashlib
+from collections import Counter
+from contextlib import contextmanager
+
+# Common subexpression extraction, opt-in
+#
+# While marking, the compiled text of sums and of value(...) functions is enclosed in markers,
+# e.g. `X_01 = 0 + \x02QD_01_01 + QD_01_02 + QD_01_03\x03`. extract then replaces the marked texts
+# which occur at least twice, across the equations of a formula or across a whole model file,
+# by auxiliary variables, e.g. CSE_5D41402A, whose defining equations are returned separately
+# The name of an auxiliary variable is lengthened if the hash of its text collides with that of another text
+#
+# Compiled sums and value(...) functions are not enclosed in parentheses, e.g. `2 * 0 + X_01 + X_02`,
+# so a marked text is only replaced where this does not change how eViews reads the equation:
+# after the start of the equation, `=`, `+`, `(` or `,`, and before its end, `=`, `+`, `-`, `)` or `,`
+# Elsewhere, and if it occurs only once, the text is left inline
+#
+# Nested marked texts, e.g. a sum in a sum, are extracted from the innermost outwards
+
+START, END = '\x02', '\x03'
+INNERMOST = re.compile('\x02([^\x02\x03]*)\x03')
+
+# Marked texts with less terms are left inline
+MIN_TERMS = 3
+
+PREFIX = 'CSE_'
+
+LEFT_BOUNDARIES = set(['', '=', '+', '(', ',', '\n'])
+RIGHT_BOUNDARIES = set(['', '=', '+', '-', ')', ',', '\n'])
+
+enabled = False
+
+# Marks the compiled sums and value(...) functions, see SumFunc and MarkedSlot
+@contextmanager
+def marking():
+    global enabled
+    previous, enabled = enabled, True
+    try:
+        yield
+    finally:
+        enabled = previous
+
+def marked(text):
+    if enabled and text.count(' + ') + 1 >= MIN_TERMS:
+        return START + text + END
+    return text
+
+# Removes the markers, leaving all texts inline
+def unmarked(text):
+    return text.replace(START, '').replace(END, '')
+
+# Number of hexadecimal digits of the hash in the names of the auxiliary variables
+NAME_LENGTH = 8
+
+# The name of the auxiliary variable of text, lengthened while it is one of the taken names
+def name(text, taken = ()):
+    digest = hashlib.md5(text).hexdigest().upper()
+    length = NAME_LENGTH
+    while PREFIX + digest[:length] in taken and length < len(digest):
+        length += 1
+    return PREFIX + digest[:length]
+
+# The character next to position in text, in the given direction, skipping spaces and markers
+def neighbour(text, position, step):
+    while 0 <= position < len(text) and text[position] in ' \x02\x03':
+        position += step
+    return text[position] if 0 <= position < len(text) else ''
+
+def replaceable(text, match):
+    return (neighbour(text, match.start() - 1, -1) in LEFT_BOUNDARIES and
+            neighbour(text, match.end(), 1) in RIGHT_BOUNDARIES)
+
+# Replaces the marked texts which occur at least twice in outputs by auxiliary variables
+# Returns the (name, text) of the auxiliary variables, and the outputs, without markers
+def extract(outputs):
+    outputs = list(outputs)
+    definitions, taken = {}, set()
+    while any(START in output for output in outputs):
+        counts = Counter(match.group(1) for output in outputs
+                         for match in INNERMOST.finditer(output) if replaceable(output, match))
+        def replace(output):
+            def substitute(match):
+                text = match.group(1)
+                if counts[text] < 2 or not replaceable(output, match):
+                    return text
+                if text not in definitions:
+                    definitions[text] = name(text, taken)
+                    taken.add(definitions[text])
+                return definitions[text]
+            return INNERMOST.sub(substitute, output)
+        outputs = [replace(output) for output in outputs]
+    return sorted((name, text) for text, name in definitions.items()), outputs
+
+def format_definitions(definitions):
+    return ''.join("%s = %s\n" % definition for definition in definitions)
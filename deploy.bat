@@ -1,2 +1,4 @@
 pyinstaller -F compiler.py
+pyinstaller -F client.py
 copy dist\compiler.exe ..\ThreeME\src\addin\
+copy dist\client.exe ..\ThreeME\src\addin\
@@ -1,28 +1,197 @@
-from collections import *
-from funcy import *
+from collections import namedtuple
 
 import itertools
 
+import vectorized
+import stats
+import cse
+import parallel
+
+# Lightweight equivalents of the funcy helpers: elements are loaded on every run of the compiler,
+# including when the Formula comes from the parse cache, and importing funcy would dominate its startup
+def cat(seqs):
+    return list(itertools.chain.from_iterable(seqs))
+
+def interpose(separator, seq):
+    for i, e in enumerate(seq):
+        if i > 0:
+            yield separator
+        yield e
+
 def priceVolume(base, option):
     if option == '!pv':
         return 'P' + base + ' * ' + base
     else:
         return base
 
-class BaseElement(namedtuple("BaseElement", ['value'])):
+# Same as priceVolume, for the parts of a Template
+def priceVolumeParts(base, option):
+    if option == '!pv':
+        return ['P'] + base + [' * '] + base
+    else:
+        return base
+
+def joinParts(separator, partsList):
+    return cat(interpose([separator], partsList))
+
+# Number of iterator bindings whose conditions are evaluated at once
+# when the compiled equations are generated
+BINDINGS_CHUNK_SIZE = 4096
+
+# A Template is the compiled text of an element, where the parts that depend on the bindings
+# are left as slots. Elements are lowered to a Template once, given the VariableNames which
+# will be bound and the price-volume option, and the Template is then filled for each binding
+# Parts are either literal strings or slots, which have a fill(bindings, heap) method
+class Template(object):
+    def __init__(self, parts):
+        # Merge consecutive literal strings
+        self.parts = []
+        for part in parts:
+            if isinstance(part, str) and len(self.parts) > 0 and isinstance(self.parts[-1], str):
+                self.parts[-1] += part
+            else:
+                self.parts.append(part)
+        self.slots = [(i, part) for i, part in enumerate(self.parts) if not isinstance(part, str)]
+
+    def fill(self, bindings, heap):
+        parts = list(self.parts)
+        for i, slot in self.slots:
+            parts[i] = slot.fill(bindings, heap)
+        return ''.join(parts)
+
+    # Whether filling the Template reads the heap, i.e. it has sums
+    def depends_on_heap(self):
+        return any(isinstance(slot, (SumSlot, LayoutSumSlot)) or
+                   (isinstance(slot, MarkedSlot) and slot.template.depends_on_heap()) for _, slot in self.slots)
+
+    # The same Template, to be filled with tuples of values in the given Layout instead of bindings dicts
+    def at(self, layout):
+        return Template([part if isinstance(part, str) else part.at(layout) for part in self.parts])
+
+# When a Formula is compiled, its bindings are tuples of values rather than dicts,
+# so that no dict is built and hashed for each binding
+# A Layout gives the position of each bound VariableName in these tuples
+# A VariableName may be bound more than once, e.g. by the iterator of a sum and by the outer Formula:
+# positions then gives the one which takes precedence
+class Layout(object):
+    def __init__(self, names):
+        self.names = tuple(names)
+        self.positions = dict((name, i) for i, name in enumerate(self.names))
+
+    # Layout of these values followed by values for names
+    # The VariableNames of this Layout take precedence if outer is true, those of names otherwise
+    def extend(self, names, outer):
+        layout = Layout(self.names + tuple(names))
+        if outer:
+            layout.positions.update(self.positions)
+        return layout
+
+    def as_dict(self, values):
+        return dict((name, values[i]) for name, i in self.positions.items())
+
+# Slot for the value bound to a VariableName, e.g. an iterator or a loop counter
+class BindingSlot(namedtuple("BindingSlot", ['variableName'])):
+    def fill(self, bindings, heap):
+        return str(bindings[self.variableName])
+
+    def at(self, layout):
+        if self.variableName in layout.positions:
+            return PositionSlot(layout.positions[self.variableName])
+        else:
+            return UnboundSlot(self.variableName)
+
+class PositionSlot(namedtuple("PositionSlot", ['position'])):
+    def fill(self, values, heap):
+        return str(values[self.position])
+
+# Slot for a VariableName which is not bound, e.g. an undefined Placeholder in a sum
+class UnboundSlot(namedtuple("UnboundSlot", ['variableName'])):
+    def fill(self, values, heap):
+        raise KeyError(self.variableName)
+
+# Slot for a sum, which depends on the heap through its conditions
+class SumSlot(namedtuple("SumSlot", ['sumFunc', 'option'])):
+    def fill(self, bindings, heap):
+        return self.sumFunc.compile(bindings, heap, self.option)
+
+    def at(self, layout):
+        return LayoutSumSlot(self.sumFunc, self.option, layout)
+
+class LayoutSumSlot(namedtuple("LayoutSumSlot", ['sumFunc', 'option', 'layout'])):
+    def fill(self, values, heap):
+        return self.sumFunc.compile_values(self.layout, values, heap, self.option)
+
+# Slot for the Template of a value(...) function, which is marked for common subexpression extraction, see cse.py
+class MarkedSlot(namedtuple("MarkedSlot", ['template'])):
+    def fill(self, bindings, heap):
+        return cse.marked(self.template.fill(bindings, heap))
+
+    def at(self, layout):
+        return MarkedSlot(self.template.at(layout))
+
+# Parsed elements are immutable nodes, without a __dict__, which are hash-consed:
+# structurally equal nodes are built only once, and then shared, e.g. the Arrays Q[c, s]
+# repeated in a Formula and across the Formulas of a model
+# As a consequence, nodes can be compared with `is`, and keyed by id(node) as long as they are alive
+# Lists, e.g. the elements of an Expression, are stored as tuples, so that all nodes are hashable
+#
+# Nodes are interned when they are built, including when they are unpickled from the parse cache
+# The table keys each node on its class and the identities of its children, which are
+# themselves interned, rather than on tuple equality, for which e.g. Integer(1) == Real(1.0)
+# The table is cleared once it holds MAX_NODES nodes, so that long-lived processes, e.g. server.py,
+# do not keep every formula they have parsed: nodes built afterwards are equal to those built before,
+# but not the same, which the caches keyed by id(node) check with `is`. These caches are cleared
+# with it, so that they do not keep the nodes alive either, see clear_nodes
+nodes = {}
+
+MAX_NODES = 1000000
+
+def frozen(value):
+    return tuple(frozen(v) for v in value) if isinstance(value, list) else value
+
+def node_key(value):
+    if isinstance(value, Node):
+        return id(value)
+    elif isinstance(value, tuple):
+        return (tuple,) + tuple(node_key(v) for v in value)
+    else:
+        return (type(value), value)
+
+class Node(object):
+    __slots__ = ()
+
+    # The key is computed from the arguments, so that no node is built when it is already interned
+    def __new__(cls, *args):
+        args = [frozen(a) for a in args]
+        key = (cls,) + tuple([node_key(a) for a in args])
+        node = nodes.get(key)
+        if node is None:
+            if len(nodes) >= MAX_NODES:
+                clear_nodes()
+            node = nodes[key] = super(Node, cls).__new__(cls, *args)
+        return node
+
+class BaseElement(Node, namedtuple("BaseElement", ['value'])):
+    __slots__ = ()
+
     def compile(self, bindings, heap, option):
         return str(self.value)
 
+    def lower(self, bound, option):
+        return [str(self.value)]
+
 # Used to mark parsed elements that contain immediate (ie constant) values
-class Immediate: pass
+class Immediate(object): __slots__ = ()
 
 # Numerical types
-class Integer(BaseElement, Immediate): pass
-class Real(BaseElement, Immediate): pass
+class Integer(BaseElement, Immediate): __slots__ = ()
+class Real(BaseElement, Immediate): __slots__ = ()
 
 # A VariableName must start with an alphabetical character or an underscore,
 # and can contain any number of alphanumerical characters or underscores
 class VariableName(BaseElement):
+    __slots__ = ()
+
     def getLoopCounterVariable(self):
         return VariableName('$' + self.value)
 
@@ -32,17 +201,32 @@ class VariableName(BaseElement):
         else:
             return priceVolume(str(self.value), option)
 
+    def lower(self, bound, option):
+        if self in bound:
+            return [BindingSlot(self)]
+        else:
+            return [priceVolume(str(self.value), option)]
+
 # A Placeholder is a VariableName enclosed in curly brackets, e.g. `{X}`
 class Placeholder(BaseElement):
+    __slots__ = ()
+
     def compile(self, bindings, heap, option):
         return bindings[self.value]
 
-class HasIteratedVariables:
+    def lower(self, bound, option):
+        return [BindingSlot(self.value)]
+
+class HasIteratedVariables(object):
+    __slots__ = ()
+
     def getIteratedVariableNames(self): raise NotImplementedError
 
 # An identifier is a combination of one or more VariableNames and Placeholders
 # e.g. {V}_energy, or Price{O}
 class Identifier(BaseElement, HasIteratedVariables):
+    __slots__ = ()
+
     def getIteratedVariableNames(self):
         return [e.value for e in self.value if isinstance(e, Placeholder)]
 
@@ -51,21 +235,36 @@ class Identifier(BaseElement, HasIteratedVariables):
         # without the price-volume option, if any
         return priceVolume(''.join([e.compile(bindings, heap, '') for e in self.value]), option)
 
+    def lower(self, bound, option):
+        return priceVolumeParts(cat([e.lower(bound, '') for e in self.value]), option)
+
 # An Index is used in an Array to address its individual elements
 # It can have multiple dimensions, e.g. [com, sec]
 class Index(BaseElement, HasIteratedVariables):
+    __slots__ = ()
+
     def getIteratedVariableNames(self):
         return cat([e.getIteratedVariableNames() for e in self.value])
 
     def compile(self, bindings, heap, option):
         return '_'.join([e.compile(bindings, heap, option) for e in self.value])
 
+    def lower(self, bound, option):
+        return joinParts('_', [e.lower(bound, option) for e in self.value])
+
 class TimeOffset(BaseElement):
+    __slots__ = ()
+
     def compile(self, bindings, heap, option):
         return '(' + self.value.compile(bindings, heap, option) + ')'
 
+    def lower(self, bound, option):
+        return ['('] + self.value.lower(bound, option) + [')']
+
 # An Array is a combination of a Identifier and an Index
-class Array(namedtuple("Array", ['identifier', 'index', 'timeOffset']), HasIteratedVariables):
+class Array(Node, namedtuple("Array", ['identifier', 'index', 'timeOffset']), HasIteratedVariables):
+    __slots__ = ()
+
     def getIteratedVariableNames(self):
         return self.identifier.getIteratedVariableNames() + self.index.getIteratedVariableNames()
 
@@ -75,37 +274,82 @@ class Array(namedtuple("Array", ['identifier', 'index', 'timeOffset']), HasItera
         timeOffset = self.timeOffset[0].compile(bindings, heap, option) if len(self.timeOffset) > 0 else ''
         return priceVolume(self.identifier.compile(bindings, heap, '') + '_' + self.index.compile(bindings, heap, ''), option) + timeOffset
 
+    def lower(self, bound, option):
+        timeOffset = self.timeOffset[0].lower(bound, option) if len(self.timeOffset) > 0 else []
+        return priceVolumeParts(self.identifier.lower(bound, '') + ['_'] + self.index.lower(bound, ''), option) + timeOffset
+
 # An Expression is the building block of an equation
 # Expressions can include operators, functions and any operand (Array, Identifier, or number)
-class Expression(namedtuple("Expression", ['value']), HasIteratedVariables):
+class Expression(Node, namedtuple("Expression", ['value']), HasIteratedVariables):
+    __slots__ = ()
+
     def getIteratedVariableNames(self):
         return cat([e.getIteratedVariableNames() for e in self.value if isinstance(e, HasIteratedVariables)])
 
     def compile(self, bindings, heap, option):
         return ' '.join([e.compile(bindings, heap, option) for e in self.value])
 
+    def lower(self, bound, option):
+        return joinParts(' ', [e.lower(bound, option) for e in self.value])
+
     def evaluate(self, bindings, heap):
         return eval(' '.join([e.compile(bindings, heap, '') if isinstance(e, Immediate) else
                               str(heap[e.compile(bindings, heap, '').upper()]) for e in self.value]))
 
-class Operator(BaseElement, Immediate): pass
+    # Evaluates the Expression for a list of bindings at once, see vectorized.py
+    def evaluate_all(self, bindingsList, heap):
+        return evaluate_elements_all(self.value, lambda i, e: [e.compile(bindings, heap, '').upper() for bindings in bindingsList],
+                                     len(bindingsList), heap)
+
+# Evaluates the elements of an Expression for size bindings at once, see vectorized.py
+# names(i, e) returns the heap names of the i-th element e, an operand, for each binding
+def evaluate_elements_all(elements, names, size, heap):
+    if not vectorized.load():
+        raise vectorized.Unsupported()
+    tokens = []
+    for i, e in enumerate(elements):
+        if isinstance(e, (Integer, Real)):
+            tokens.append(('number', eval(e.compile({}, heap, ''))))
+        elif isinstance(e, Immediate):
+            tokens.append(('operator', e.compile({}, heap, '')))
+        else:
+            tokens.append(('values', vectorized.Values.gather(names(i, e), heap)))
+    return vectorized.evaluate(tokens, size)
+
+class Operator(BaseElement, Immediate): __slots__ = ()
 
-class ComparisonOperator(BaseElement, Immediate): pass
+class ComparisonOperator(BaseElement, Immediate): __slots__ = ()
 
-class BooleanOperator(BaseElement, Immediate): pass
+class BooleanOperator(BaseElement, Immediate): __slots__ = ()
+
+class SumFunc(Node, namedtuple("SumFunc", ['formula']), HasIteratedVariables):
+    __slots__ = ()
 
-class SumFunc(namedtuple("SumFunc", ['formula']), HasIteratedVariables):
     def getIteratedVariableNames(self):
         return set(self.formula.iterated_variables()) - set(self.formula.iterator_variables())
 
     def compile(self, bindings, heap, option):
+        stats.count('sum_expansions')
         compiled_sum = self.formula.compile_sum(bindings, heap, option)
         if len(compiled_sum) > 0:
-            return "0 + " + compiled_sum
+            return "0 + " + cse.marked(compiled_sum)
+        else:
+            return "0"
+
+    def compile_values(self, layout, values, heap, option):
+        stats.count('sum_expansions')
+        compiled_sum = self.formula.compile_sum_values(layout, values, heap, option)
+        if len(compiled_sum) > 0:
+            return "0 + " + cse.marked(compiled_sum)
         else:
             return "0"
 
-class Func(namedtuple("Func", ['variableName', 'expressions']), HasIteratedVariables):
+    def lower(self, bound, option):
+        return [SumSlot(self, option)]
+
+class Func(Node, namedtuple("Func", ['variableName', 'expressions']), HasIteratedVariables):
+    __slots__ = ()
+
     def getIteratedVariableNames(self):
         return cat([e.getIteratedVariableNames() for e in self.expressions])
 
@@ -113,14 +357,22 @@ class Func(namedtuple("Func", ['variableName', 'expressions']), HasIteratedVaria
         # The 'value' function allows to transform a volume
         # expression into a value expression
         if self.variableName.value == 'value':
-            return self.expressions[0].compile(bindings, heap, '!pv')
+            return cse.marked(self.expressions[0].compile(bindings, heap, '!pv'))
         # Expressions inside a function (such as, e.g. a dlog) mustn't be compiled
         # with the price-value option, if any
         else:
             return self.variableName.compile({}, {}, '') + '(' + ', '.join([e.compile(bindings, heap, '') for e in self.expressions]) + ')'
 
+    def lower(self, bound, option):
+        if self.variableName.value == 'value':
+            return [MarkedSlot(Template(self.expressions[0].lower(bound, '!pv')))]
+        else:
+            return [self.variableName.compile({}, {}, '') + '('] + joinParts(', ', [e.lower(bound, '') for e in self.expressions]) + [')']
+
 # An Equation is made of two Expressions separated by an equal sign
-class Equation(namedtuple("Equation", ['lhs', 'rhs']), HasIteratedVariables):
+class Equation(Node, namedtuple("Equation", ['lhs', 'rhs']), HasIteratedVariables):
+    __slots__ = ()
+
     def getIteratedVariableNames(self):
         return self.lhs.getIteratedVariableNames() + self.rhs.getIteratedVariableNames()
 
@@ -133,23 +385,246 @@ class Equation(namedtuple("Equation", ['lhs', 'rhs']), HasIteratedVariables):
         else:
             return volumeEquation
 
-class Condition(namedtuple("Condition", ["expression"]), HasIteratedVariables):
+    def lower(self, bound, option):
+        volumeEquation = self.lhs.lower(bound, '') + [' = '] + self.rhs.lower(bound, '')
+        if option == '!pv':
+            priceEquation = self.lhs.lower(bound, option) + [' = '] + self.rhs.lower(bound, option)
+            return priceEquation + ['\n'] + volumeEquation
+        else:
+            return volumeEquation
+
+class EvaluatedEach(object):
+    __slots__ = ()
+
+    # Evaluates the condition for each bindings of the list, vectorized if possible
+    def evaluate_each(self, bindingsList, heap):
+        try:
+            if len(bindingsList) < vectorized.MIN_BINDINGS or not vectorized.load():
+                raise vectorized.Unsupported()
+            return self.evaluate_all(bindingsList, heap)
+        except vectorized.Unsupported:
+            return [self.evaluate(b, heap) for b in bindingsList]
+
+class Condition(Node, namedtuple("Condition", ["expression"]), HasIteratedVariables, EvaluatedEach):
+    __slots__ = ()
+
     def getIteratedVariableNames(self):
         return self.expression.getIteratedVariableNames()
 
     def evaluate(self, bindings, heap):
         return self.expression.evaluate(bindings, heap)
 
+    def evaluate_all(self, bindingsList, heap):
+        return self.expression.evaluate_all(bindingsList, heap)
+
+    # The Condition, to be evaluated for tuples of values in the given Layout, see Template.at
+    def at(self, layout):
+        return LayoutCondition(self.expression, layout)
+
+    # Splits the Condition into the Conditions joined by its top-level `and` operators,
+    # e.g. `X[c] > 0 and Y[s] > 0` into `X[c] > 0` and `Y[s] > 0`
+    # A Condition with any other top-level boolean operator is not split
+    def conjuncts(self):
+        tokens = self.expression.value
+        if any(isinstance(e, BooleanOperator) and e.value != 'and' for e in tokens):
+            return [self]
+        conjuncts = [[]]
+        for e in tokens:
+            if isinstance(e, BooleanOperator):
+                conjuncts.append([])
+            else:
+                conjuncts[-1].append(e)
+        return [Condition(Expression(c)) for c in conjuncts]
+
+# A Condition whose operands are lowered to Templates in a Layout, evaluated as Expression.evaluate
+class LayoutCondition(EvaluatedEach):
+    def __init__(self, expression, layout):
+        bound = set(layout.names)
+        self.elements = expression.value
+        self.operands = [None if isinstance(e, Immediate) else Template(e.lower(bound, '')).at(layout) for e in self.elements]
+
+    # Whether the i-th element is an operand of an arithmetic operator, for which an NA value
+    # makes the evaluation fail, rather than compare lower than any number
+    def in_arithmetic(self, i):
+        return any(0 <= j < len(self.elements) and isinstance(self.elements[j], Operator) for j in [i - 1, i + 1])
+
+    def evaluate(self, values, heap):
+        return eval(' '.join([e.compile({}, heap, '') if operand is None else str(heap[operand.fill(values, heap).upper()])
+                              for e, operand in zip(self.elements, self.operands)]))
+
+    def evaluate_all(self, valuesList, heap):
+        return evaluate_elements_all(self.elements, lambda i, e: [self.operands[i].fill(values, heap).upper() for values in valuesList],
+                                     len(valuesList), heap)
+
+# Raised before a Formula is compiled, when its condition would read variables which are not in the heap,
+# or NA values in arithmetic on which its evaluation fails, see Formula.check_references
+# missing and na map each of these names to the first binding which reads it, e.g. 'c = 03, s = 01'
+class InvalidReferences(KeyError):
+    def __init__(self, missing, na):
+        KeyError.__init__(self, sorted(missing) + sorted(na))
+        self.missing = missing
+        self.na = na
+
+    def __str__(self):
+        listed = lambda names: ', '.join('%s (%s)' % (name, names[name]) if names[name] else name for name in sorted(names))
+        messages = []
+        if len(self.missing) > 0:
+            messages.append("Missing variables: " + listed(self.missing))
+        if len(self.na) > 0:
+            messages.append("NA values in arithmetic: " + listed(self.na))
+        return '; '.join(messages)
+
+# Whether the condition evaluates for the binding, e.g. an NA value in arithmetic is not read
+# after `and` if what precedes it is False. Missing variables are reported on their own
+def condition_evaluates(condition, values, heap):
+    try:
+        condition.evaluate(values, heap)
+    except TypeError:
+        return False
+    except KeyError:
+        pass
+    return True
+
+# All the VariableNames used in an element, including nested ones
+def variable_names(element):
+    if isinstance(element, VariableName):
+        return set([element])
+    elif isinstance(element, (tuple, list)):
+        names = set()
+        for e in element:
+            names |= variable_names(e)
+        return names
+    else:
+        return set()
+
+# Named sets of iterator values, {name: Lst}, see namedsets.py
+namedSets = {}
+
+# Values and loop counters of each Lst, keyed by id as sumExpansions, see Lst.expansion
+# Cleared whenever the named sets are defined, and with the interned nodes
+lstExpansions = {}
+
+def clear_nodes():
+    nodes.clear()
+    lstExpansions.clear()
+    sumExpansions.clear()
+
+# A range of numbers, e.g. 01..24, whose values are zero-padded to the width of its start
+# Its values are generated, and looked up, without being listed
+class LstRange(Node, namedtuple("LstRange", ['start', 'stop'])):
+    __slots__ = ()
+
+    def size(self):
+        return max(0, int(self.stop) - int(self.start) + 1)
+
+    def value(self, i):
+        return '%0*d' % (len(self.start), int(self.start) + i)
+
+    def values(self):
+        return (self.value(i) for i in xrange(self.size()))
+
+    def contains(self, value):
+        if not value.isdigit():
+            return False
+        i = int(value) - int(self.start)
+        return 0 <= i < self.size() and self.value(i) == value
+
+# A reference to a named set in a Lst, e.g. %coms
+class LstSet(BaseElement):
+    __slots__ = ()
+
+    def lst(self):
+        if self.value not in namedSets:
+            raise NameError("This set is not defined: " + self.value)
+        return namedSets[self.value]
+
+    def size(self):
+        return self.lst().size()
+
+    def values(self):
+        return iter(self.lst().compile())
+
+# Membership in the items of a Lst: strings and named sets are looked up in a set, ranges by arithmetic
+class Membership(object):
+    def __init__(self, items):
+        self.values = set()
+        self.ranges = []
+        for item in items:
+            if isinstance(item, LstRange):
+                self.ranges.append(item)
+            elif isinstance(item, LstSet):
+                self.values.update(item.values())
+            else:
+                self.values.add(item)
+
+    def contains(self, value):
+        return value in self.values or any(r.contains(value) for r in self.ranges)
+
+def lst_item_size(item):
+    return 1 if isinstance(item, basestring) else item.size()
+
 # A Lst is a sequence of space-delimited strings (usually numbers), used for an iterator
 # e.g. 01 02 03 04 05 06
-class Lst(namedtuple("LstBase", ['base', 'remove'])):
+# Its items can also be ranges, e.g. 01..24, and named sets, e.g. %coms, which are expanded lazily
+# The values after `\` are removed, and if there are values after `&`, only those are kept,
+# e.g. `01..24 \ 05 & %energy`
+class Lst(Node, namedtuple("LstBase", ['base', 'remove', 'keep'])):
+    __slots__ = ()
+
+    def base_values(self):
+        for item in self.base:
+            if isinstance(item, (LstRange, LstSet)):
+                for value in item.values():
+                    yield value
+            else:
+                yield item
+
+    # Number of values, which are only listed if some are removed or kept
+    def size(self):
+        if len(self.remove) > 0 or len(self.keep) > 0:
+            return len(self.compile())
+        return sum(lst_item_size(item) for item in self.base)
+
+    # The i-th value, the values being only listed if some are removed or kept
+    def value(self, i):
+        if len(self.remove) > 0 or len(self.keep) > 0:
+            return self.compile()[i]
+        for item in self.base:
+            if i < lst_item_size(item):
+                if isinstance(item, basestring):
+                    return item
+                return item.value(i) if isinstance(item, LstRange) else item.lst().value(i)
+            i -= lst_item_size(item)
+        raise IndexError(i)
+
+    # The values, and the positions of the values in the base list, from 1, which are
+    # only computed once, and shared: they must not be modified
+    def expansion(self):
+        lst, expansion = lstExpansions.get(id(self), (None, None))
+        if lst is not self:
+            removed = Membership(self.remove)
+            kept = Membership(self.keep) if len(self.keep) > 0 else None
+            values, counters = [], []
+            for i, value in enumerate(self.base_values()):
+                if not removed.contains(value) and (kept is None or kept.contains(value)):
+                    values.append(value)
+                    counters.append(i + 1)
+            expansion = (values, counters)
+            lstExpansions[id(self)] = (self, expansion)
+        return expansion
+
     def compile(self):
-        return [e for e in self.base if e not in self.remove]
+        return self.expansion()[0]
+
+    def counters(self):
+        return self.expansion()[1]
 
 # A Grouped is one element or
 # a comma-delimited list of elements, between parentheses
 # (notably used to iterate over multiple variables simultaneously)
 class Grouped(BaseElement):
+    __slots__ = ()
+
     def compile(self):
         return zip(*[e.compile() for e in self.value])
 
@@ -159,13 +634,29 @@ class Grouped(BaseElement):
 # e.g. c in 01 02 03 04 05 06 07 08 09
 # If the Lsts contains multiple Lst, then each list in the Lsts
 # are iterated over in parallel
-class Iter(namedtuple("Iter", ['variableNames_', 'lsts_'])):
+class Iter(Node, namedtuple("Iter", ['variableNames_', 'lsts_'])):
+    __slots__ = ()
+
     @property
     def variableNames(self):
-        return self.variableNames_
+        return self.variableNames_.value
+
+    # Shortcuts for the common case of an Iter over a single VariableName and Lst
+    @property
+    def variableName(self):
+        return self.variableNames[0]
+
+    # An Iter over a VariableName, e.g. `c in _coms`, iterates over the named set
+    @property
+    def lst(self):
+        if isinstance(self.lsts_, VariableName):
+            return LstSet(self.lsts_.value).lst()
+        return self.lsts_.value[0]
 
     @property
     def lsts(self):
+        if isinstance(self.lsts_, VariableName):
+            return zip(self.lst.compile())
         return self.lsts_.compile()
 
     def compileLoopCounter(self):
@@ -173,66 +664,65 @@ class Iter(namedtuple("Iter", ['variableNames_', 'lsts_'])):
         # This is because the list removal feature is designed to skip an equation,
         # but the loop counter is usually used to iterate over rows or columns of data
         # which ignore this skipping
-        return {self.variableNames[0].getLoopCounterVariable(): range(1, len(self.lsts[0].base) + 1) }
-
-    # # Return a dict of: {VariableName: compiled Lst}
-    # def compile(self):
-    #     # Check if all Lst have the same length
-    #     if len(set([len(l) for l in self.lsts])) > 1:
-    #         raise IndexError("When iterating multiple lists in parallel, all lists should be of equal length")
-    #     else:
-    #         return self.variableNames, self.lsts.compile()
+        return {self.variableNames[0].getLoopCounterVariable(): self.lst.counters()}
 
 # A Formula is the combination of an Equation, zero or one Condition, and one or more Iter(ators)
 # This is the full form of the code passed from eViews to the compiler
 # e.g. {V}[com] = {V}D[com] + {V}M[com], V in Q CH G I DS, com in 01 02 03 04 05 06 07 08 09
-class Formula(namedtuple("Formula", ['options', 'equation', 'conditions', 'iterators'])):
+class Formula(Node, namedtuple("Formula", ['options', 'equation', 'conditions', 'iterators'])):
+    __slots__ = ()
+
     def iterator_variables(self):
         return [v for i in self.iterators for v in i.variableNames]
 
+    # VariableNames bound by the iterators, including their loop counters
+    def bound_variables(self):
+        return self.iterator_variables() + [i.variableNames[0].getLoopCounterVariable() for i in self.iterators]
+
     def iterated_variables(self):
         return self.equation.getIteratedVariableNames()
 
-    # Cartesian product of all iterators, returned as dicts
-    # Turns {['V']: [['Q'], ['X']], ['c', 's']: [['01', '22'], ['02', '23'], ['03', '24']]}
-    # into [{'V': 'Q', 'c': '01', 's': '22'}, {'V': 'Q', 'c': '02', 's': '23'}, {'V': 'Q', 'c': '03', 's': '24'},
-    #       {'X': 'Q', 'c': '01', 's': '22'}, {'X': 'Q', 'c': '02', 's': '23'}, {'X': 'Q', 'c': '03', 's': '24'} ]
+    # Layout of the values generated by iter_values: the VariableNames of each iterator, then its loop counter
+    def layout(self):
+        return Layout([v for i in self.iterators for v in list(i.variableNames) + [i.variableNames[0].getLoopCounterVariable()]])
+
+    # Cartesian product of all iterators, generated lazily as tuples of values in the Layout of the Formula
+    # Turns [(['V', '$V'], [('Q', 1), ('X', 2)]), (['c', 's', '$c'], [('01', '22', 1), ('02', '23', 2)])]
+    # into ('Q', 1, '01', '22', 1), ('Q', 1, '02', '23', 2), ('X', 2, '01', '22', 1), ('X', 2, '02', '23', 2)
     def cartesianProduct(self, iterators):
-        # First, cartesian product of all Lst values
-        # e.g. [[['Q'], ['01', '22']], [['Q'], ['02', '23']], [['Q'], ['03', '24']],
-        #       [['X'], ['01', '22']], [['X'], ['02', '23']], [['X'], ['03', '24']]]
-        cartesianProd = [l for l in apply(itertools.product, iterators.values())]
-        # Second, combine the cartesian product values with their respective VariableNames
-        # (stored in iterators.keys)
-        # e.g. [[['V']: ['Q']], [['c', 's']: ['01', '22']]
-        zipped = [zip(iterators.keys(), p) for p in cartesianProd]
-        # Finally, create and merge all the inner dicts
-        return [merge(*[dict(zip(*l)) for l in z]) for z in zipped]
-        # return [dict(zip(iterators.keys(), p)) for p in cartesianProd]
+        return (tuple(itertools.chain.from_iterable(p)) for p in itertools.product(*[values for _, values in iterators]))
 
-    def build_iterator_dicts(self):
+    # The (VariableNames, values) of each iterator
+    def iterator_values(self):
         # Check that each iterator is defined only once
         if len(self.iterator_variables()) > len(set(self.iterator_variables())):
             raise NameError("Some iterated variables are defined multiple times")
 
-        # Compile each iterator to get a dict of {VariableNames: Iter}
-        # iterators = cat(i.variableNames, [i.compile()[1] for i in self.iterators]))
+        # Each iterator binds its VariableNames and its loop counter simultaneously
+        iterators = []
+        for i in self.iterators:
+            (counterVariable, counters), = i.compileLoopCounter().items()
+            iterators.append((list(i.variableNames) + [counterVariable],
+                              [tuple(values) + (counter,) for values, counter in zip(i.lsts, counters)]))
+        return iterators
 
-        # Zip in the loop counters
-        #lsts = [zip(i.lsts(),
-        loopCounters = dict(cat([i.compileLoopCounter().items() for i in self.iterators]))
+    def iter_values(self):
+        return self.cartesianProduct(self.iterator_values())
 
-        iteratorDicts = self.cartesianProduct(iterators)
-        loopCounterDicts = self.cartesianProduct(loopCounters)
+    # Bindings of the iterators as dicts, e.g. {'V': 'Q', '$V': 1, 'c': '01', 's': '22', '$c': 1}
+    def iter_iterator_dicts(self):
+        names = self.layout().names
+        return (dict(zip(names, values)) for values in self.iter_values())
 
-        return [merge(iterDict, counterDict) for iterDict, counterDict in zip(iteratorDicts, loopCounterDicts)]
+    def build_iterator_dicts(self):
+        return list(self.iter_iterator_dicts())
 
     def evaluate_conditions(self, bindings, heap, iteratorDicts):
         # Evaluate the condition for each iterator binding
         if len(self.conditions) > 0:
             if len(self.iterators) > 0:
-                conditions = [self.conditions[0].evaluate(dict(bindings.items() + local_bindings.items()), heap)
-                              for local_bindings in iteratorDicts]
+                bindingsList = [dict(bindings.items() + local_bindings.items()) for local_bindings in iteratorDicts]
+                conditions = self.conditions[0].evaluate_each(bindingsList, heap)
             else:
                 conditions = [self.conditions[0].evaluate(bindings, heap)]
         else:
@@ -242,25 +732,322 @@ class Formula(namedtuple("Formula", ['options', 'equation', 'conditions', 'itera
                 conditions = [True]
         return conditions
 
-    def init_compilation(self, bindings, heap):
-        iteratorDicts = self.build_iterator_dicts()
-        conditions = self.evaluate_conditions(bindings, heap, iteratorDicts)
-        option = self.options[0].lower() if len(self.options) > 0 else ''
-        return iteratorDicts, conditions, option
+    # Generates (condition, values) pairs, evaluating the conditions over chunks
+    # of the iterator product, or of the given values, so that it is never built as a whole
+    def iter_conditions(self, layout, heap, allValues = None):
+        condition = self.conditions[0].at(layout) if len(self.conditions) > 0 else None
+        allValues = self.iter_values() if allValues is None else allValues
+        while True:
+            with stats.phase('iterate'):
+                valuesList = list(itertools.islice(allValues, BINDINGS_CHUNK_SIZE))
+            if len(valuesList) == 0:
+                return
+            stats.count('bindings', len(valuesList))
+            if condition is None:
+                conditions = itertools.repeat(True)
+            else:
+                with stats.phase('conditions'):
+                    conditions = condition.evaluate_each(valuesList, heap)
+                if stats.current is not None:
+                    stats.count('conditions_evaluated', len(conditions))
+                    stats.count('conditions_true', len([c for c in conditions if c]))
+            for condition_, values in itertools.izip(conditions, valuesList):
+                yield condition_, values
+
+    def compile_option(self):
+        return self.options[0].lower() if len(self.options) > 0 else ''
+
+    # Lowers the equation once, for bindings of the given VariableNames, see Template
+    def template(self, bound, option):
+        return Template(self.equation.lower(set(bound), option))
+
+    # The Formula of a SumFunc is compiled for each binding of the outer Formula,
+    # so its SumExpansion is kept, and shared by all the sums with the same Formula, during one compilation
+    def sum_expansion(self):
+        formula, expansion = sumExpansions.get(id(self), (None, None))
+        if formula is not self:
+            expansion = SumExpansion(self)
+            sumExpansions[id(self)] = (self, expansion)
+        return expansion
 
     def compile_sum(self, bindings, heap, option):
-        iteratorDicts, conditions, _ = self.init_compilation(bindings, heap)
-        return " + ".join([self.equation.compile(dict(local_bindings.items() + bindings.items()), heap, option)
-                           for condition, local_bindings in zip(conditions, iteratorDicts) if condition])
+        layout = Layout(bindings.keys())
+        return self.sum_expansion().compile(layout, tuple(bindings[name] for name in layout.names), heap, option)
+
+    def compile_sum_values(self, layout, values, heap, option):
+        return self.sum_expansion().compile(layout, values, heap, option)
 
-    def compile(self, heap):
-        iteratorDicts, conditions, option = self.init_compilation({}, heap)
+    # Generates the compiled equations one at a time
+    # With the !pv option, each item holds the price equation and the volume equation
+    # If fixed parameter names are given, the equations are folded, see folding.py
+    # Formulas with many bindings are compiled in parallel, see parallel.py
+    def compile_lines(self, heap, fixed = None):
+        start_compilation()
+        self.check_iterated_variables()
+        iterators = self.iterator_values()
+        self.check_references(heap, iterators)
+        if parallel.wanted(iterators, heap):
+            lines = parallel.compile_lines(self, heap, fixed, iterators)
+        else:
+            lines = self.compile_partition(heap, fixed, iterators)
+        for line in lines:
+            yield line
 
-        # Check that all VariableNames used as iterators in the equation are defined
-        # in the iterators section of the Formula
+    # Check that all VariableNames used as iterators in the equation are defined
+    # in the iterators section of the Formula
+    def check_iterated_variables(self):
         missingVars = set(self.iterated_variables()) - set(self.iterator_variables())
         if len(missingVars) > 0:
             raise IndexError("These iterated variables are not defined: " + ", ".join([e.value for e in missingVars]))
 
-        return "\n".join([self.equation.compile(bindings, heap, option)
-                          for condition, bindings in zip(conditions, iteratorDicts) if condition])
+    # Check that the heap has all the variables read by the condition over the whole iterator product,
+    # and that the values used in arithmetic are not NA, so that a Formula which would fail
+    # does so before any binding is evaluated, with all the offending names
+    # The condition reads all its operands for every binding: each operand is only filled for
+    # the distinct values of the iterators it uses, e.g. once per c for X[c] in `..., c in 01 02, s in 01 02`
+    # Operands with sums, and the conditions of sums, which are only evaluated for the bindings
+    # whose outer condition holds, are left to the evaluation
+    def check_references(self, heap, iterators):
+        if len(self.conditions) == 0:
+            return
+        layout = self.layout()
+        condition = self.conditions[0].at(layout)
+        # (iterator, offset in its values) of each position of the Layout
+        owners = [(i, j) for i, (names, _) in enumerate(iterators) for j in range(len(names))]
+        shown = [p for p, name in enumerate(layout.names) if name in set(self.iterator_variables())]
+        binding = lambda values: ', '.join('%s = %s' % (layout.names[p].value, values[p]) for p in shown)
+        missing, na = {}, {}
+        for k, operand in enumerate(condition.operands):
+            if operand is None or any(not isinstance(slot, PositionSlot) for _, slot in operand.slots):
+                continue
+            positions = [owners[slot.position] for _, slot in operand.slots]
+            # For each iterator, its first values with distinct values at the positions used by the operand
+            choices = []
+            for i, (_, values) in enumerate(iterators):
+                offsets = [j for owner, j in positions if owner == i]
+                seen, chosen = set(), []
+                for v in values if len(offsets) > 0 else values[:1]:
+                    key = tuple(v[j] for j in offsets)
+                    if key not in seen:
+                        seen.add(key)
+                        chosen.append(v)
+                choices.append(chosen)
+            for combination in itertools.product(*choices):
+                values = tuple(itertools.chain.from_iterable(combination))
+                name = operand.fill(values, heap).upper()
+                if name in missing or name in na:
+                    continue
+                try:
+                    if heap[name] is None and condition.in_arithmetic(k) and not condition_evaluates(condition, values, heap):
+                        na[name] = binding(values)
+                except KeyError:
+                    missing[name] = binding(values)
+        if len(missing) > 0 or len(na) > 0:
+            raise InvalidReferences(missing, na)
+
+    # Template of the compiled equations in the Layout of the Formula, folded if fixed parameter names are given
+    def line_template(self, layout, fixed):
+        if fixed and isinstance(self.equation, Equation):
+            import folding
+            return folding.FoldedTemplate(self.equation, layout, self.compile_option(), fixed)
+        else:
+            return self.template(layout.names, self.compile_option()).at(layout)
+
+    # Generates the compiled equations for the product of the given (VariableNames, values) of the iterators
+    def compile_partition(self, heap, fixed, iterators):
+        layout = self.layout()
+        template = self.line_template(layout, fixed)
+        for condition, values in self.iter_conditions(layout, heap, self.cartesianProduct(iterators)):
+            if condition:
+                with stats.phase('emit'):
+                    line = template.fill(values, heap)
+                yield line
+
+    # Writes the compiled equations to the file f as they are generated,
+    # and returns the number of bindings which were compiled
+    def write(self, heap, f, fixed = None):
+        count = 0
+        for line in self.compile_lines(heap, fixed):
+            with stats.phase('write'):
+                if count > 0:
+                    f.write('\n')
+                f.write(line)
+            stats.count('lines', line.count('\n') + 1)
+            stats.count('bytes', len(line) + (count > 0))
+            count += 1
+        return count
+
+    def compile(self, heap, fixed = None):
+        return "\n".join(self.compile_lines(heap, fixed))
+
+    # Compiles the Formula against several heaps, e.g. scenarios, at once
+    # Generates, for each binding whose condition holds in any heap, a tuple of its compiled equations
+    # in each heap, None where it does not hold. Equations which do not depend on the heap,
+    # i.e. without sums nor folding, are only filled once
+    def compile_scenarios(self, heaps, fixed = None):
+        start_compilation()
+        self.check_iterated_variables()
+        iterators = self.iterator_values()
+        for heap in heaps:
+            self.check_references(heap, iterators)
+        layout = self.layout()
+        template = self.line_template(layout, fixed)
+        shared = isinstance(template, Template) and not template.depends_on_heap()
+        condition = self.conditions[0].at(layout) if len(self.conditions) > 0 else None
+        allValues = self.cartesianProduct(iterators)
+        while True:
+            with stats.phase('iterate'):
+                valuesList = list(itertools.islice(allValues, BINDINGS_CHUNK_SIZE))
+            if len(valuesList) == 0:
+                return
+            stats.count('bindings', len(valuesList))
+            if condition is None:
+                conditions = [[True] * len(valuesList)] * len(heaps)
+            else:
+                with stats.phase('conditions'):
+                    conditions = [condition.evaluate_each(valuesList, heap) for heap in heaps]
+            for values, holds in itertools.izip(valuesList, itertools.izip(*conditions)):
+                if not any(holds):
+                    continue
+                with stats.phase('emit'):
+                    if shared:
+                        line = template.fill(values, heaps[0])
+                        yield tuple(line if h else None for h in holds)
+                    else:
+                        yield tuple(template.fill(values, heap) if h else None for h, heap in zip(holds, heaps))
+
+# SumExpansions of the Formulas of sums, keyed by id, see Node and Formula.sum_expansion
+# They are only kept during one compilation, as their results depend on the contents of the heap,
+# which may change between compilations, e.g. a heap reloaded in place, or the named sets
+sumExpansions = {}
+
+def start_compilation():
+    sumExpansions.clear()
+
+# Number of heaps for which a SumExpansion keeps its results, see SumExpansion.use_heap
+HEAP_STATES = 8
+
+# Expansion of the Formula of a SumFunc, for each binding of the outer Formula
+#
+# Everything which does not depend on the outer bindings is only computed once:
+# the iterator product, the Templates, and the parts of the condition (see Condition.conjuncts)
+# which only depend on the iterators of the sum
+# The sum is also memoized for outer bindings which only differ in VariableNames the sum does not use,
+# e.g. V in `|V|[c] = sum(X[c, s], s in 01 02), V in Q CH, c in 01 02`
+#
+# The outer bindings are passed as a tuple of values in a Layout, see Template.at,
+# and the inner values are appended to them. Conditions are evaluated with the iterators of the sum
+# taking precedence over the outer bindings, and terms are compiled with the outer bindings
+# taking precedence, as in Formula.evaluate_conditions and Template.fill
+class SumExpansion(object):
+    def __init__(self, formula):
+        self.formula = formula
+        self.innerLayout = formula.layout()
+        self.innerValues = list(formula.iter_values())
+        stats.count('bindings', len(self.innerValues))
+        self.innerNames = set(self.innerLayout.names)
+        self.names = variable_names(formula.equation) | variable_names(formula.conditions)
+        self.conjuncts = formula.conditions[0].conjuncts() if len(formula.conditions) > 0 else []
+        self.plans = {}
+        self.heap = None
+        self.heapStates = []
+
+    # What depends on the outer Layout: Templates per option, the conjuncts which depend
+    # on the outer bindings only, as (those before any other conjunct, the others), on both,
+    # and on the iterators only, and the positions of the outer values the sum is memoized on, if any
+    def plan(self, layout):
+        if layout.names not in self.plans:
+            outerNames = set(layout.names)
+            conditionLayout = layout.extend(self.innerLayout.names, False)
+            outer, mixed, inner = ([], []), [], []
+            for i, conjunct in enumerate(self.conjuncts):
+                names = variable_names(conjunct)
+                if not names & self.innerNames:
+                    outer[len(mixed) + len(inner) > 0].append(conjunct.at(layout))
+                elif not (names & outerNames) - self.innerNames:
+                    inner.append(i)
+                else:
+                    mixed.append(conjunct.at(conditionLayout))
+            # Only memoize if some outer VariableNames are not used by the sum
+            memoized = None
+            if not outerNames <= self.names:
+                memoized = [layout.positions[name] for name in sorted(self.names & outerNames)]
+            self.plans[layout.names] = ({}, layout.extend(self.innerLayout.names, True), outer, mixed, tuple(inner), memoized)
+        return self.plans[layout.names]
+
+    def template(self, templates, termLayout, option):
+        if option not in templates:
+            templates[option] = self.formula.template(termLayout.names, option).at(termLayout)
+        return templates[option]
+
+    # Results depending on the heap are only kept for the heaps they were computed with,
+    # the last HEAP_STATES ones, e.g. the scenarios compiled together, see Formula.compile_scenarios
+    def use_heap(self, heap):
+        if heap is not self.heap:
+            states = [state for state in self.heapStates if state[0] is not heap]
+            state = ([state for state in self.heapStates if state[0] is heap] or [(heap, {}, {})])[0]
+            self.heapStates = [state] + states[:HEAP_STATES - 1]
+            self.heap, self.innerConditions, self.memo = state
+
+    # The inner conjuncts, given by their positions, are evaluated once, without the outer bindings
+    # None if their evaluation failed, see conditions
+    def inner_conditions(self, inner):
+        if inner not in self.innerConditions:
+            try:
+                self.innerConditions[inner] = self.evaluate([self.conjuncts[i].at(self.innerLayout) for i in inner],
+                                                            self.innerValues)
+            except Exception:
+                self.innerConditions[inner] = None
+        return self.innerConditions[inner]
+
+    def evaluate(self, conjuncts, valuesList):
+        conditions = [True] * len(valuesList)
+        for conjunct in conjuncts:
+            conditions = [bool(c) and bool(d) for c, d in zip(conditions, conjunct.evaluate_each(valuesList, self.heap))]
+        return conditions
+
+    # Evaluates the conjuncts separately, in the order they are independent of the outer bindings
+    # If any evaluation fails, e.g. a division by zero which `and` would have skipped,
+    # the whole condition is evaluated as in Formula.evaluate_conditions, raising the same errors
+    # The sum is only skipped on outer conjuncts before any other one, as `and` would: if a later
+    # outer conjunct is False, the conjuncts before it are still evaluated, and may raise
+    def conditions(self, layout, values, outer, mixed, inner):
+        if len(self.conjuncts) == 0:
+            return [True] * len(self.innerValues)
+        leading, later = outer
+        try:
+            if not all(self.evaluate(leading, [values])):
+                return [False] * len(self.innerValues)
+            innerConditions = self.inner_conditions(inner)
+            if innerConditions is None or not all(self.evaluate(later, [values])):
+                raise ValueError()
+            if len(mixed) == 0:
+                return innerConditions
+            valuesList = [values + innerValues for innerValues in self.innerValues]
+            return [c and d for c, d in zip(innerConditions, self.evaluate(mixed, valuesList))]
+        except Exception:
+            innerNames = self.innerLayout.names
+            return self.formula.evaluate_conditions(layout.as_dict(values), self.heap,
+                                                    [dict(zip(innerNames, v)) for v in self.innerValues])
+
+    def compile(self, layout, values, heap, option):
+        self.use_heap(heap)
+        templates, termLayout, outer, mixed, inner, memoized = self.plan(layout)
+        if memoized is not None:
+            # Nested sums are marked while extracting common subexpressions, see cse.py
+            key = (option, cse.enabled) + tuple(values[i] for i in memoized)
+            if key in self.memo:
+                stats.count('sum_memo_hits')
+                return self.memo[key]
+        template = self.template(templates, termLayout, option)
+        with stats.phase('conditions'):
+            conditions = self.conditions(layout, values, outer, mixed, inner)
+        if stats.current is not None and len(self.conjuncts) > 0:
+            stats.count('conditions_evaluated', len(conditions))
+            stats.count('conditions_true', len([c for c in conditions if c]))
+        with stats.phase('emit'):
+            compiled = " + ".join([template.fill(values + innerValues, heap)
+                                   for condition, innerValues in zip(conditions, self.innerValues) if condition])
+        if memoized is not None:
+            self.memo[key] = compiled
+        return compiled
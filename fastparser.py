@@ -0,0 +1,289 @@
+import os, re
+
+from elements import *
+import stats
+
+# Hand-written recursive-descent parser of formulas, which builds the same elements as grammar.py
+#
+# It follows the grammar rule by rule, with the same ordered choices, repetitions and backtracking
+# as pyparsing, including its quirks, e.g. the VariableNames of an Identifier may be separated by
+# whitespace, and `-1` is an Integer after an operator but a unary minus and 1 at the start of an Expression
+# Each token is matched by a regular expression at the current position, after the whitespace
+# skipped by pyparsing. As elements are hash-consed, the Formula it returns is the very one which
+# grammar.formula returns, see tests/test_fastparser.py
+#
+# Input which it does not parse entirely, e.g. invalid formulas, is parsed with grammar.formula instead,
+# so that errors are the same ParseExceptions. Set the MODEL_PARSER environment variable to
+# pyparsing to always use grammar.formula
+
+# Set to False to always use grammar.formula
+enabled = os.environ.get('MODEL_PARSER') != 'pyparsing'
+
+class Unsupported(Exception): pass
+
+# Whitespace skipped by pyparsing before each token
+WHITESPACE = re.compile(r'[ \n\t\r]*')
+
+def token(pattern):
+    return re.compile(r'[ \n\t\r]*(' + pattern + ')')
+
+# Word(alphas + '_%$@', alphanums + '_')
+NAME = token(r'[A-Za-z_%$@][A-Za-z0-9_]*')
+# Combine(Optional('-') + Word(nums) + '.' + Word(nums)) and Combine(Optional('-') + Word(nums))
+REAL = token(r'-?[0-9]+\.[0-9]+')
+INTEGER = token(r'-?[0-9]+')
+# lstRange | lstSet | Word(alphanums), the items of a Lst, told apart by their group
+LST_ITEM = re.compile(r'[ \n\t\r]*(?:([0-9]+\.\.[0-9]+)|(%[A-Za-z0-9_]+)|([A-Za-z0-9]+))')
+# The alternatives of oneOf, in the order in which it tries them
+OPTIONS = token(r'!pv|!p|!Pv|!P')
+UNARY_OPERATOR = token(r'[+\-]')
+# operator | comparisonOperator | booleanOperator, told apart by their group
+BINARY_OPERATOR = re.compile(r'[ \n\t\r]*(?:([+\-*/^])|(<>|<=|<|>=|>|==)|(and|or|xor))')
+BINARY_CLASSES = [None, Operator, ComparisonOperator, BooleanOperator]
+# Literal('sum'), which is not a keyword
+SUM = token(r'sum')
+# Keywords are neither preceded nor followed by Keyword.DEFAULT_KEYWORD_CHARS
+IF = token(r'(?<![A-Za-z0-9_$])if(?![A-Za-z0-9_$])')
+IN = token(r'(?<![A-Za-z0-9_$])in(?![A-Za-z0-9_$])')
+
+# Each rule takes the position where it starts, and returns (element, position after it),
+# or None if it does not match there
+class Parser(object):
+    def __init__(self, text):
+        self.text = text
+
+    def literal(self, literal, pos):
+        pos = WHITESPACE.match(self.text, pos).end()
+        if self.text.startswith(literal, pos):
+            return pos + len(literal)
+        return None
+
+    # parse + ZeroOrMore(Suppress(',') + parse), as a list
+    def delimited(self, parse, pos):
+        result = parse(pos)
+        if result is None:
+            return None
+        element, pos = result
+        elements = [element]
+        while True:
+            p = self.literal(',', pos)
+            result = None if p is None else parse(p)
+            if result is None:
+                return elements, pos
+            elements.append(result[0])
+            pos = result[1]
+
+    def formula(self, pos):
+        text = self.text
+        options = []
+        m = OPTIONS.match(text, pos)
+        if m:
+            options = [m.group(1)]
+            pos = m.end()
+        # equation | expression: both start with the same Expression
+        result = self.expression(pos)
+        if result is None:
+            return None
+        equation, pos = result
+        p = self.literal('=', pos)
+        rhs = None if p is None else self.expression(p)
+        if rhs is not None:
+            equation, pos = Equation(equation, rhs[0]), rhs[1]
+        conditions = []
+        m = IF.match(text, pos)
+        if m:
+            result = self.expression(m.end())
+            if result is not None:
+                conditions = [Condition(result[0])]
+                pos = result[1]
+        iterators = []
+        p = self.literal(',', pos)
+        result = None if p is None else self.delimited(self.iterator, p)
+        if result is not None:
+            iterators, pos = result
+        return Formula(options, equation, conditions, iterators), pos
+
+    def expression(self, pos):
+        text = self.text
+        elements = []
+        m = UNARY_OPERATOR.match(text, pos)
+        if m:
+            elements.append(Operator(m.group(1)))
+            pos = m.end()
+        result = self.atom(pos)
+        if result is None:
+            return None
+        elements.extend(result[0])
+        pos = result[1]
+        while True:
+            m = BINARY_OPERATOR.match(text, pos)
+            if not m:
+                break
+            result = self.atom(m.end())
+            if result is None:
+                break
+            elements.append(BINARY_CLASSES[m.lastindex](m.group(m.lastindex)))
+            elements.extend(result[0])
+            pos = result[1]
+        return Expression(elements), pos
+
+    # Returns the list of elements of the atom, which are spliced into the Expression
+    def atom(self, pos):
+        text = self.text
+        m = SUM.match(text, pos)
+        if m:
+            p = self.literal('(', m.end())
+            result = None if p is None else self.formula(p)
+            p = None if result is None else self.literal(')', result[1])
+            if p is not None:
+                return [SumFunc(result[0])], p
+        m = NAME.match(text, pos)
+        if m:
+            p = self.literal('(', m.end())
+            result = None if p is None else self.delimited(self.expression, p)
+            p = None if result is None else self.literal(')', result[1])
+            if p is not None:
+                return [Func(VariableName(m.group(1)), result[0])], p
+        p = self.literal('(', pos)
+        result = None if p is None else self.expression(p)
+        p = None if result is None else self.literal(')', result[1])
+        if p is not None:
+            return [BaseElement('('), result[0], BaseElement(')')], p
+        result = self.operand(pos)
+        if result is None:
+            return None
+        return [result[0]], result[1]
+
+    def operand(self, pos):
+        text = self.text
+        result = self.identifier(pos)
+        if result is not None:
+            identifier, pos = result
+            p = self.literal('[', pos)
+            index = None if p is None else self.delimited(self.expression, p)
+            p = None if index is None else self.literal(']', index[1])
+            if p is None:
+                return identifier, pos
+            timeOffset = self.time_offset(p)
+            if timeOffset is None:
+                return Array(identifier, Index(index[0]), []), p
+            return Array(identifier, Index(index[0]), [timeOffset[0]]), timeOffset[1]
+        m = REAL.match(text, pos)
+        if m:
+            return Real(float(m.group(1))), m.end()
+        m = INTEGER.match(text, pos)
+        if m:
+            return Integer(int(m.group(1))), m.end()
+        return None
+
+    def identifier(self, pos):
+        text = self.text
+        parts = []
+        while True:
+            m = NAME.match(text, pos)
+            if m:
+                parts.append(VariableName(m.group(1)))
+                pos = m.end()
+                continue
+            p = self.literal('|', pos)
+            m = None if p is None else NAME.match(text, p)
+            p = None if m is None else self.literal('|', m.end())
+            if p is None:
+                break
+            parts.append(Placeholder(VariableName(m.group(1))))
+            pos = p
+        if len(parts) == 0:
+            return None
+        return Identifier(parts), pos
+
+    def time_offset(self, pos):
+        p = self.literal('(', pos)
+        if p is None:
+            return None
+        m = INTEGER.match(self.text, p)
+        if m:
+            value = Integer(int(m.group(1)))
+        else:
+            m = NAME.match(self.text, p)
+            if not m:
+                return None
+            value = VariableName(m.group(1))
+        p = self.literal(')', m.end())
+        if p is None:
+            return None
+        return TimeOffset(value), p
+
+    def variable_name(self, pos):
+        m = NAME.match(self.text, pos)
+        if not m:
+            return None
+        return VariableName(m.group(1)), m.end()
+
+    # The element, or a list of elements between parentheses
+    def grouped(self, parse, pos):
+        result = parse(pos)
+        if result is not None:
+            return Grouped([result[0]]), result[1]
+        p = self.literal('(', pos)
+        result = None if p is None else self.delimited(parse, p)
+        p = None if result is None else self.literal(')', result[1])
+        if p is None:
+            return None
+        return Grouped(result[0]), p
+
+    def items(self, pos):
+        items = []
+        while True:
+            m = LST_ITEM.match(self.text, pos)
+            if not m:
+                return items, pos
+            if m.lastindex == 1:
+                items.append(LstRange(*m.group(1).split('..')))
+            elif m.lastindex == 2:
+                items.append(LstSet(m.group(2)))
+            else:
+                items.append(m.group(3))
+            pos = m.end()
+
+    def lst(self, pos):
+        base, pos = self.items(pos)
+        if len(base) == 0:
+            return None
+        filters = []
+        for separator in ['\\', '&']:
+            items = []
+            p = self.literal(separator, pos)
+            if p is not None:
+                items, p = self.items(p)
+                if len(items) > 0:
+                    pos = p
+            filters.append(items)
+        return Lst(base, *filters), pos
+
+    def iterator(self, pos):
+        result = self.grouped(self.variable_name, pos)
+        m = None if result is None else IN.match(self.text, result[1])
+        if not m:
+            return None
+        variableNames = result[0]
+        result = self.grouped(self.lst, m.end()) or self.variable_name(m.end())
+        if result is None:
+            return None
+        return Iter(variableNames, result[0]), result[1]
+
+# Returns the Formula of the code, as grammar.formula.parseString(code)[0],
+# or raises Unsupported if the code is not a whole formula
+def parse_formula(code):
+    result = Parser(code).formula(0)
+    if result is None or WHITESPACE.match(code, result[1]).end() != len(code):
+        raise Unsupported()
+    return result[0]
+
+def parse(code):
+    if enabled:
+        try:
+            return parse_formula(code)
+        except Unsupported:
+            stats.count('parser_fallbacks')
+    import grammar
+    return grammar.formula.parseString(code)[0]
@@ -0,0 +1,232 @@
+import os
+
+from elements import (Template, BaseElement, Integer, Real, Identifier, Array, Expression, Func, SumFunc,
+                      Operator, ComparisonOperator, BooleanOperator)
+import stats
+
+# Heap-aware constant folding of the compiled equations, opt-in
+#
+# Fixed parameters are declared by name, e.g. PHI_01_02, in a file given with --fixed to batch.py,
+# or in the file named by the MODEL_FIXED environment variable for the eViews compilers
+# Their values are read from the heap, and each Expression of the equation is simplified:
+#   - numbers and fixed parameters are folded, e.g. `2 * PHI_01_02 * X_01` into `1.5 * X_01`
+#   - terms multiplied by zero are dropped, as are factors of one and terms equal to zero
+#   - comparisons and boolean operators whose operands are all known are evaluated,
+#     e.g. the guard `(CH_01 > 0) * CH_01` into `CH_01` if CH_01 is fixed and positive
+# Parameters which are NA or not in the heap are left as they are, and so are divisions by zero
+# Equations without any fixed parameter are left as they are
+#
+# Only volume equations are folded: with the !pv option, the price equation is left as it is,
+# as are the terms of sums and the arguments of functions
+#
+# Each folded equation is preceded in the output by an eViews comment, so that it can be audited, e.g.
+#   ' folded PHI_01_02 = 0.75: X_01 = 2 * PHI_01_02 * Y_01 + 0 * Z_01
+#   X_01 = 1.5 * Y_01
+
+# Reads the names of the fixed parameters, separated by spaces or new lines
+# Lines starting with ' or # are comments
+def read_fixed(path):
+    with open(path, 'r') as f:
+        return frozenset(name.upper() for line in f if line.strip()[:1] not in ("'", "#") for name in line.split())
+
+# The fixed parameters named by the MODEL_FIXED environment variable, if set, or None
+def requested_fixed():
+    path = os.environ.get('MODEL_FIXED')
+    return read_fixed(path) if path else None
+
+def format_number(value):
+    value = float(value)
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+def format_atom(atom):
+    if isinstance(atom, float):
+        return format_number(atom) if atom >= 0 else '(' + format_number(atom) + ')'
+    return atom
+
+PYTHON_OPERATORS = {'^': '**', '<>': '!=', '==': '==', 'xor': '!='}
+
+# Text which is compiled from the tokens of an element but is not a single operand, e.g. `0 + X_01 + X_02`
+# for a sum: the terms it belongs to are left as they are
+class Raw(str): pass
+
+# An Expression lowered at a Layout, whose operands are filled for each tuple of values and then folded
+class ExpressionFolder(object):
+    def __init__(self, expression, layout, fixed):
+        bound = set(layout.names)
+        self.fixed = fixed
+        self.tokens = []
+        for e in expression.value:
+            if isinstance(e, (Integer, Real)):
+                self.tokens.append(('number', float(e.value)))
+            elif isinstance(e, (Operator, ComparisonOperator, BooleanOperator)):
+                self.tokens.append(('operator', e.value))
+            elif isinstance(e, Expression):
+                self.tokens.append(('expression', ExpressionFolder(e, layout, fixed)))
+            elif isinstance(e, (Identifier, Array)):
+                self.tokens.append(('operand', Template(e.lower(bound, '')).at(layout)))
+            elif isinstance(e, BaseElement) and e.value in ('(', ')'):
+                # The parentheses around a nested Expression, which is folded as a whole
+                continue
+            elif isinstance(e, SumFunc) or (isinstance(e, Func) and e.variableName.value == 'value'):
+                self.tokens.append(('raw', Template(e.lower(bound, '')).at(layout)))
+            else:
+                self.tokens.append(('text', Template(e.lower(bound, '')).at(layout)))
+
+    # Returns the folded Expression, as a float if it is known, and as text otherwise
+    # The fixed parameters which were folded are appended to folds
+    def fold(self, values, heap, folds):
+        atoms, operators = [], []
+        for kind, token in self.tokens:
+            if kind == 'operator':
+                operators.append((len(atoms), token))
+            elif kind == 'number':
+                atoms.append(token)
+            elif kind == 'expression':
+                atom = token.fold(values, heap, folds)
+                atoms.append(atom if isinstance(atom, float) else '(' + atom + ')')
+            elif kind == 'operand':
+                atoms.append(self.operand(token.fill(values, heap), heap, folds))
+            elif kind == 'raw':
+                atoms.append(Raw(token.fill(values, heap)))
+            else:
+                atoms.append(token.fill(values, heap))
+        # Leading unary operator, then alternating atoms and binary operators
+        unary = [op for position, op in operators if position == 0]
+        binary = [op for position, op in operators if position > 0]
+        if any(op not in ('+', '-', '*', '/', '^') for op in binary):
+            return self.logical(unary, atoms, binary)
+        return self.arithmetic(unary[0] if unary else '+', atoms, binary)
+
+    def operand(self, name, heap, folds):
+        if name.upper() not in self.fixed:
+            return name
+        try:
+            value = heap[name.upper()]
+        except KeyError:
+            return name
+        if value is None:
+            return name
+        folds.append((name, value))
+        return float(value)
+
+    # Comparisons and boolean operators are only evaluated if all their operands are known
+    def logical(self, unary, atoms, binary):
+        if all(isinstance(atom, float) for atom in atoms):
+            code = ' '.join(unary + [repr(atoms[0])] + [PYTHON_OPERATORS.get(op, op) + ' ' + repr(atom)
+                                                        for op, atom in zip(binary, atoms[1:])])
+            try:
+                return float(eval(code))
+            except ZeroDivisionError:
+                pass
+        return ' '.join(unary + [format_atom(atoms[0])] + [op + ' ' + format_atom(atom) for op, atom in zip(binary, atoms[1:])])
+
+    def arithmetic(self, sign, atoms, binary):
+        # Split into signed terms of factors, e.g. - X * Y + 2 into [('-', ['*', X, '*', Y]), ('+', ['*', 2])]
+        terms = [(sign, ['*', atoms[0]])]
+        for op, atom in zip(binary, atoms[1:]):
+            if op in ('+', '-'):
+                terms.append((op, ['*', atom]))
+            else:
+                terms[-1][1].extend([op, atom])
+
+        constant = 0.
+        texts = []
+        for sign, factors in terms:
+            term = self.term(factors)
+            if isinstance(term, float):
+                constant += term if sign == '+' else -term
+            elif isinstance(term, tuple):
+                # Negative constant factor
+                texts.append(('-' if sign == '+' else '+', term[0]))
+            elif term is not None:
+                texts.append((sign, term))
+        if len(texts) == 0:
+            return constant
+        parts = [texts[0][1] if texts[0][0] == '+' else '- ' + texts[0][1]]
+        parts.extend(sign + ' ' + text for sign, text in texts[1:])
+        if constant != 0:
+            parts.append(('+ ' if constant > 0 else '- ') + format_number(abs(constant)))
+        return ' '.join(parts)
+
+    # Folds a product, given as alternating operators and atoms: returns a float if it is known,
+    # None if it is zero, text, or a tuple (text,) if the text is to be negated
+    def term(self, factors):
+        if any(isinstance(atom, Raw) for atom in factors[1::2]):
+            return ' '.join([format_atom(factors[1])] + [str(factor) if i % 2 == 0 else format_atom(factor)
+                                                         for i, factor in enumerate(factors[2:])])
+        # Powers bind tighter than products
+        powered = []
+        for i in range(0, len(factors), 2):
+            op, atom = factors[i], factors[i + 1]
+            if op == '^':
+                base = powered[-1][1]
+                if isinstance(base, float) and isinstance(atom, float):
+                    try:
+                        powered[-1] = (powered[-1][0], float(base ** atom))
+                        continue
+                    except (ZeroDivisionError, ValueError, OverflowError):
+                        pass
+                powered[-1] = (powered[-1][0], format_atom(base) + ' ^ ' + format_atom(atom))
+            else:
+                powered.append((op, atom))
+
+        constant = 1.
+        texts = []
+        zero = False
+        for op, atom in powered:
+            if not isinstance(atom, float):
+                texts.append((op, atom))
+            elif op == '*':
+                zero = zero or atom == 0
+                constant *= atom
+            elif atom == 0:
+                # Division by zero is left to eViews
+                texts.append((op, format_atom(atom)))
+            else:
+                constant /= atom
+        if zero:
+            return None
+        if len(texts) == 0:
+            return constant
+        negative = constant < 0
+        constant = abs(constant)
+        if constant == 1 and texts[0][0] == '*':
+            parts = [texts[0][1]]
+        else:
+            parts = [format_number(constant), texts[0][0], texts[0][1]]
+        for op, text in texts[1:]:
+            parts.extend([op, text])
+        text = ' '.join(parts)
+        return (text,) if negative else text
+
+# Equations lowered at a Layout, filled and folded for each tuple of values, see Formula.compile_lines
+class FoldedTemplate(object):
+    def __init__(self, equation, layout, option, fixed):
+        bound = set(layout.names)
+        self.option = option
+        self.original = Template(equation.lower(bound, option)).at(layout)
+        self.lhs = ExpressionFolder(equation.lhs, layout, fixed)
+        self.rhs = ExpressionFolder(equation.rhs, layout, fixed)
+        if option == '!pv':
+            self.price = Template(equation.lhs.lower(bound, option) + [' = '] + equation.rhs.lower(bound, option)).at(layout)
+
+    def fill(self, values, heap):
+        original = self.original.fill(values, heap)
+        folds = []
+        volumeEquation = format_atom(self.lhs.fold(values, heap, folds)) + ' = ' + format_atom(self.rhs.fold(values, heap, folds))
+        if len(folds) == 0:
+            return original
+        folded = self.price.fill(values, heap) + '\n' + volumeEquation if self.option == '!pv' else volumeEquation
+        stats.count('folded_equations')
+        stats.count('folded_parameters', len(folds))
+        audit = ', '.join('%s = %s' % (name, format_number(value)) for name, value in unique(folds))
+        return "' folded %s: %s\n%s" % (audit, original.replace('\n', '\n\' '), folded)
+
+def unique(folds):
+    seen = set()
+    for name, value in folds:
+        if name not in seen:
+            seen.add(name)
+            yield name, value
@@ -1,3 +1,5 @@
+from functools import partial
+
 from pyparsing import *
 
 from elements import *
@@ -14,6 +16,9 @@ def setParseClass(self, kls, unpack = False):
 
 ParserElement.setParseClass = setParseClass
 
+# Memoize the alternatives of atom and operand, which backtrack heavily on nested sums
+ParserElement.enablePackrat()
+
 openParenSuppr = Suppress('(')
 closeParenSuppr = Suppress(')')
 
@@ -60,8 +65,12 @@ equation = (expression + Suppress('=') + expression).setParseClass(Equation, Tru
 
 condition = (Suppress(Keyword('if')) + expression).setParseClass(Condition, True)
 
-lstRaw  = OneOrMore(Word(alphanums))
-lst = (Group(lstRaw) + Group(Optional(Suppress('\\') + lstRaw))).setParseClass(Lst, True)
+lstRange = Regex(r'[0-9]+\.\.[0-9]+').setParseAction(lambda toks: LstRange(*toks[0].split('..')))
+
+lstSet = Regex(r'%[A-Za-z0-9_]+').setParseClass(LstSet, True)
+
+lstRaw  = OneOrMore(lstRange | lstSet | Word(alphanums))
+lst = (Group(lstRaw) + Group(Optional(Suppress('\\') + lstRaw)) + Group(Optional(Suppress('&') + lstRaw))).setParseClass(Lst, True)
 
 def grouped(elem):
     return Group(elem | openParenSuppr + delimitedList(elem) + closeParenSuppr).setParseClass(Grouped, True)
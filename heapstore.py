@@ -0,0 +1,156 @@
+import os, csv, mmap, struct, hashlib, math
+from collections import Mapping, namedtuple
+
+# Binary cache of tmp_all_vars.csv, memory-mapped on later runs
+#
+# Layout (little-endian):
+#   header  magic, CSV mtime, CSV size, CSV sha1, number of variables, size of the names blob
+#   offsets (count + 1) uint32 offsets of each name in the names blob
+#   names   the variable names, sorted and concatenated
+#   values  count float64 values, aligned on 8 bytes; NA values are stored as NaN
+
+MAGIC = b'MoDeLHP1'
+HEADER = struct.Struct('<8sdQ20sII')
+
+def csv_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).digest()
+
+def read_csv(path):
+    with open(path, 'rb') as csvfile:
+        rows = list(csv.reader(csvfile))
+        return dict(zip(rows[0],
+                        [float(e) if e != 'NA' else
+                         None for e in rows[2]]))
+
+def write_cache(path, values, mtime, size, digest):
+    names = sorted(values)
+    offsets = [0]
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+    blob = b''.join(names)
+    padding = -(HEADER.size + 4 * len(offsets) + len(blob)) % 8
+
+    # Write to a temporary file first, so that concurrent readers never see a partial cache
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, mtime, size, digest, len(names), len(blob)))
+        f.write(struct.pack('<%dI' % len(offsets), *offsets))
+        f.write(blob + b'\0' * padding)
+        f.write(struct.pack('<%dd' % len(names),
+                            *[values[name] if values[name] is not None else float('nan') for name in names]))
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+# A read-only Mapping of {variable name: value}, with NA values as None,
+# backed by a memory-mapped binary cache of the CSV
+class HeapStore(Mapping):
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        magic, self.mtime, self.size, self.digest, self.count, self.namesSize = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise IOError("Not a heap cache: " + path)
+        self.offsetsStart = HEADER.size
+        self.namesStart = self.offsetsStart + 4 * (self.count + 1)
+        self.valuesStart = self.namesStart + self.namesSize + (-(self.namesStart + self.namesSize) % 8)
+        # Values already looked up, as formulas read the same variables over and over
+        self.lookups = {}
+
+    # Opens the cache of a CSV file, which is (re)built only if the CSV has changed
+    @classmethod
+    def open(cls, csv_path, cache_path = None):
+        cache_path = cache_path or csv_path + '.heap'
+        stat = os.stat(csv_path)
+        digest = None
+        if os.path.exists(cache_path):
+            store = cls(cache_path)
+            if store.mtime == stat.st_mtime and store.size == stat.st_size:
+                return store
+            digest = csv_digest(csv_path)
+            store.close()
+            if store.digest == digest:
+                # Same content, only the modification time changed
+                with open(cache_path, 'r+b') as f:
+                    f.write(HEADER.pack(MAGIC, stat.st_mtime, stat.st_size, digest, store.count, store.namesSize))
+                return cls(cache_path)
+        values = read_csv(csv_path)
+        try:
+            write_cache(cache_path, values, stat.st_mtime, stat.st_size, digest or csv_digest(csv_path))
+        except (IOError, OSError):
+            # e.g. read-only directory, or cache mapped by another process on Windows
+            return values
+        return cls(cache_path)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    # A HeapStore is passed to other processes as the path of its cache, which they map in turn
+    def __reduce__(self):
+        return (HeapStore, (self.path,))
+
+    def name(self, i):
+        start, end = struct.unpack_from('<II', self.map, self.offsetsStart + 4 * i)
+        return self.map[self.namesStart + start:self.namesStart + end]
+
+    def value(self, i):
+        value = struct.unpack_from('<d', self.map, self.valuesStart + 8 * i)[0]
+        return None if math.isnan(value) else value
+
+    # Position of a variable in the sorted index, or -1 if it is not in the heap
+    def index(self, name):
+        if not isinstance(name, bytes):
+            name = name.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo if lo < self.count and self.name(lo) == name else -1
+
+    def __getitem__(self, name):
+        try:
+            return self.lookups[name]
+        except KeyError:
+            i = self.index(name)
+            if i < 0:
+                raise KeyError(name)
+            value = self.lookups[name] = self.value(i)
+            return value
+
+    def __contains__(self, name):
+        return self.index(name) >= 0
+
+    def __iter__(self):
+        return (self.name(i) for i in range(self.count))
+
+    def __len__(self):
+        return self.count
+
+# Names of the variables whose values changed between two heaps, and which were added or removed
+class HeapDiff(namedtuple("HeapDiff", ['changed', 'added', 'removed'])):
+    def names(self):
+        return set(self.changed) | set(self.added) | set(self.removed)
+
+# Compares two heaps, walking their names in order: those of a HeapStore are already sorted
+def diff(old, new):
+    changed, added, removed = [], [], []
+    oldNames, newNames = iter(sorted(old)), iter(sorted(new))
+    oldName, newName = next(oldNames, None), next(newNames, None)
+    while oldName is not None or newName is not None:
+        if newName is None or (oldName is not None and oldName < newName):
+            removed.append(oldName)
+            oldName = next(oldNames, None)
+        elif oldName is None or newName < oldName:
+            added.append(newName)
+            newName = next(newNames, None)
+        else:
+            if old[oldName] != new[newName]:
+                changed.append(oldName)
+            oldName, newName = next(oldNames, None), next(newNames, None)
+    return HeapDiff(changed, added, removed)
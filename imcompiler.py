@@ -1,25 +1,8 @@
-import os, sys, csv, time, random
+import os, sys, time, random, multiprocessing
 
-import pyparsing
-import grammar
-
-# The formula to be compiled is passed in the first command line argument
-# If no formula was passed, exit
-if len(sys.argv) < 2:
-    sys.exit(0)
-code = sys.argv[1]
-
-if code[0] == '"':
-    code = code[1:-1]
-
-code = code.strip()
-
-# Load values of all variables
-with open('tmp_all_vars.csv', 'rb') as csvfile:
-    rows = list(csv.reader(csvfile))
-    heap = dict(zip(rows[0],
-                    [float(e) if e != 'NA' else
-                     None for e in rows[2]]))
+import compilation
+import stats
+import folding
 
 compiler_out = "_compiler_out"
 
@@ -27,22 +10,32 @@ def ensure_directory(_path):
     if not os.path.exists(_path):
         os.makedirs(_path)
 
-ensure_directory(compiler_out)
+# The worker processes of parallel compilation, see parallel.py, import this module on Windows,
+# including in an executable built by PyInstaller: everything else only runs in the main process
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+    # The formula to be compiled is passed in the first command line argument
+    # If no formula was passed, exit
+    if len(sys.argv) < 2:
+        sys.exit(0)
+    code = sys.argv[1]
+
+    # Statistics of the compilation, if requested, see stats.py
+    stats.start_if_requested()
+
+    # Load values of all variables
+    heap = compilation.load_heap()
 
-# Name of the file where the output will be saved
-filename = str(int(time.time())) + str(random.randint(0, 999)) + ".txt"
+    ensure_directory(compiler_out)
 
-# Compilation
-try:
-    output = grammar.formula.parseString(code)[0].compile(heap)
-except pyparsing.ParseException as e:
-    output = "Error\r\n" + str(e)
-except:
-    output = "Error\r\n" + str(sys.exc_info()[0])
+    # Name of the file where the output will be saved
+    filename = str(int(time.time())) + str(random.randint(0, 999)) + ".txt"
 
-# Writes the output, compiled code or error message to a file in _compiler_out
-with open(os.path.join(compiler_out, filename), 'w') as f:
-    f.write(output)
+    # Compilation, writing the output, compiled code or error message to a file in _compiler_out
+    with open(os.path.join(compiler_out, filename), 'w') as f:
+        compilation.write_code(code, heap, f, folding.requested_fixed())
+    stats.finish(os.path.join(compiler_out, filename))
 
-# Prints the filename to stdout, so that eViews can then load it
-print filename
+    # Prints the filename to stdout, so that eViews can then load it
+    print filename
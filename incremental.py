@@ -0,0 +1,106 @@
+import os
+from collections import Mapping
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from parsecache import grammar_version
+
+# Incremental compilation of a model file, see batch.py
+#
+# A Formula only reads the heap to evaluate its conditions, including those of its sums.
+# The state keeps, for each formula, its output and the heap values it read. Against a new heap,
+# a formula whose values are all unchanged has the same output, and is not compiled again.
+# Alternatively, the names of the variables which changed can be given explicitly.
+#
+# The state is tied to the version of the grammar and elements, to the fixed parameters
+# folded into the equations, see folding.py, and to the named sets, see namedsets.py,
+# and is discarded if they change.
+# Formulas which failed to compile are always compiled again.
+
+# Value recorded for a name which is not in the heap
+MISSING = '<missing>'
+
+# Heap which records the values read through it
+class RecordingHeap(Mapping):
+    def __init__(self, heap):
+        self.heap = heap
+        self.reads = {}
+
+    def __getitem__(self, name):
+        try:
+            value = self.reads[name] = self.heap[name]
+        except KeyError:
+            self.reads[name] = MISSING
+            raise
+        return value
+
+    def __contains__(self, name):
+        return name in self.heap
+
+    def __iter__(self):
+        return iter(self.heap)
+
+    def __len__(self):
+        return len(self.heap)
+
+class State(object):
+    def __init__(self, path, fixed = None, sets = None):
+        self.path = path
+        self.version = (grammar_version(), tuple(sorted(fixed or ())), tuple(sets or ()))
+        # {code: (output, {heap name: value read})}
+        self.records = {}
+
+    @classmethod
+    def load(cls, path, fixed = None, sets = None):
+        state = cls(path, fixed, sets)
+        try:
+            with open(path, 'rb') as f:
+                version, records = pickle.load(f)
+        except Exception:
+            # Missing or unreadable state: everything is compiled
+            return state
+        if version == state.version:
+            state.records = records
+        return state
+
+    def save(self):
+        # Write to a temporary file first, so that an interrupted save never leaves a partial state
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((self.version, self.records), f, pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp_path, self.path)
+
+    # Whether the formula must be compiled again, against the heap or given the names which changed
+    def stale(self, code, heap, changed = None):
+        if code not in self.records:
+            return True
+        reads = self.records[code][1]
+        if changed is not None:
+            return any(name.upper() in reads for name in changed)
+        for name, value in reads.items():
+            try:
+                if heap[name] != value:
+                    return True
+            except KeyError:
+                if value != MISSING:
+                    return True
+        return False
+
+    def output(self, code):
+        return self.records[code][0]
+
+    def record(self, code, output, reads):
+        self.records[code] = (output, reads)
+
+    def forget(self, code):
+        self.records.pop(code, None)
+
+    # Drops the records of formulas which are no longer in the model
+    def retain(self, codes):
+        codes = set(codes)
+        self.records = dict((code, record) for code, record in self.records.items() if code in codes)
@@ -0,0 +1,46 @@
+import elements
+
+# Named sets of iterator values, defined once for a whole model, see batch.py --sets
+#
+# A sets file defines one set per line, with the syntax of an iterator over a single list, e.g.
+#   %coms in 01..24
+#   %energy in 21..24
+#   %other in %coms \ %energy
+# Blank lines and comment lines (starting with ' or #) are skipped, and a set can only refer
+# to the sets defined before it. Iterators refer to the sets in their lists, e.g. `c in %coms`,
+# `c in %coms \ 05` or `c in 01..24 & %energy`. Sets whose names do not start with %
+# can only be iterated over by name alone, e.g. `c in _coms`
+# The values of a set are only expanded when a Formula iterates over it, see Lst.expansion
+
+COMMENT_CHARACTERS = "'#"
+
+# Returns the [(name, Lst)] of the sets defined in the file at path
+def read_sets(path):
+    import grammar
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    sets = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line[0] in COMMENT_CHARACTERS:
+            continue
+        iterator = grammar.iter.parseString(line, parseAll = True)[0]
+        if len(iterator.variableNames) != 1 or not isinstance(iterator.lsts_, elements.Grouped) or len(iterator.lsts_.value) != 1:
+            raise ValueError("Line %d: a set is defined by a single name and list: %s" % (number, line))
+        defined = set(name for name, _ in sets)
+        for name in references(iterator.lst):
+            if name not in defined:
+                raise NameError("Line %d: this set is not defined before: %s" % (number, name))
+        sets.append((iterator.variableName.value, iterator.lst))
+    return sets
+
+# Names of the sets a Lst refers to
+def references(lst):
+    return [item.value for item in lst.base + lst.remove + lst.keep if isinstance(item, elements.LstSet)]
+
+# Defines the sets, replacing those defined before, if any
+def define(sets):
+    elements.namedSets.clear()
+    elements.namedSets.update(sets or [])
+    elements.lstExpansions.clear()
+    elements.sumExpansions.clear()
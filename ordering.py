@@ -0,0 +1,153 @@
+import re, argparse
+
+# Block decomposition of compiled equations
+#
+# Each equation determines one variable, the first variable of its left-hand side,
+# e.g. Q_01 in `Q_01 = QD_01 + QM_01` or `dlog(Q_01) = ...`, and PQ_01 in the price equation
+# `PQ_01 * Q_01 = ...` of the !pv option. It depends on all the other variables it references,
+# except lagged ones, e.g. Q_01(-1), which are known when the current period is solved.
+#
+# The strongly connected components of the dependency graph are the blocks which must be solved
+# simultaneously. The blocks are written in topological order, so that each block only depends
+# on the blocks before it, and consecutive equations which do not depend on themselves
+# are grouped into recursive blocks, e.g.
+#   ' BLOCK 1: recursive, 2 equations
+#   X_01 = 2 * Z_01
+#   Y_01 = X_01 + 1
+#   ' BLOCK 2: simultaneous, 2 equations
+#   A = B + Y_01
+#   B = 0.5 * A
+
+TOKEN = re.compile(r'(\d+\.?\d*(?:[eE][+-]?\d+)?)|([A-Za-z_%$@][A-Za-z0-9_]*)')
+OFFSET = re.compile(r'\s*\(\s*([+-]?)\s*(\d+)\s*\)')
+
+# The variables referenced in an expression, in order, without the lagged ones nor the function names
+def variables(text):
+    names = []
+    for match in TOKEN.finditer(text):
+        name = match.group(2)
+        if name is None:
+            continue
+        rest = text[match.end():].lstrip()
+        if rest[:1] == '(':
+            offset = OFFSET.match(text, match.end())
+            if offset is None:
+                # Function call, e.g. dlog(...)
+                continue
+            if offset.group(1) == '-' and int(offset.group(2)) > 0:
+                continue
+        names.append(name.upper())
+    return names
+
+# Returns (the variable determined by the equation or None, the variables it depends on)
+def analyse(equation):
+    lhs, _, rhs = equation.partition('=')
+    lhsVariables = variables(lhs)
+    endogenous = lhsVariables[0] if lhsVariables else None
+    return endogenous, set(lhsVariables[1:] + variables(rhs))
+
+# Strongly connected components of the graph given by the successors of each node, in
+# reverse topological order: each component comes after all the components it leads to
+# Iterative version of Tarjan's algorithm, so that deep graphs do not hit the recursion limit
+def strongly_connected_components(successors):
+    index = [None] * len(successors)
+    lowlink = [0] * len(successors)
+    onStack = [False] * len(successors)
+    stack = []
+    components = []
+    counter = 0
+    for root in range(len(successors)):
+        if index[root] is not None:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, i = work.pop()
+            if i == 0:
+                index[node] = lowlink[node] = counter
+                counter += 1
+                stack.append(node)
+                onStack[node] = True
+            recurse = False
+            for j in range(i, len(successors[node])):
+                successor = successors[node][j]
+                if index[successor] is None:
+                    work.append((node, j + 1))
+                    work.append((successor, 0))
+                    recurse = True
+                    break
+                elif onStack[successor]:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            if recurse:
+                continue
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    onStack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(sorted(component))
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+    return components
+
+# Splits the equations into blocks, in the order they can be solved
+# Returns a list of (simultaneous, equations)
+def blocks(equations):
+    analysed = [analyse(e) for e in equations]
+    definitions = {}
+    for i, (endogenous, _) in enumerate(analysed):
+        if endogenous is not None:
+            definitions.setdefault(endogenous, []).append(i)
+    # Each equation leads to the equations which determine the variables it depends on
+    successors = [sorted(set(j for name in dependencies for j in definitions.get(name, []))) for _, dependencies in analysed]
+
+    result = []
+    for component in strongly_connected_components(successors):
+        simultaneous = len(component) > 1 or component[0] in successors[component[0]]
+        if not simultaneous and result and not result[-1][0]:
+            result[-1][1].append(equations[component[0]])
+        else:
+            result.append((simultaneous, [equations[i] for i in component]))
+    return result
+
+def block_stats(result):
+    sizes = [len(equations) for simultaneous, equations in result if simultaneous]
+    return {"equations": sum(len(equations) for _, equations in result), "blocks": len(result),
+            "simultaneous_blocks": len(sizes), "simultaneous_equations": sum(sizes),
+            "largest_block": max(sizes) if sizes else 0}
+
+# Reads the equations of a compiled file, skipping comment lines, blank lines and error records
+def read_equations(path):
+    equations = []
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    if lines[:1] == ['Error']:
+        return equations
+    for line in lines:
+        if line.strip() and line.strip()[0] != "'" and '=' in line:
+            equations.append(line.strip())
+    return equations
+
+def write_blocks(result, f):
+    stats = block_stats(result)
+    f.write("' %(equations)d equations in %(blocks)d blocks, %(simultaneous_equations)d equations "
+            "in %(simultaneous_blocks)d simultaneous blocks, largest block: %(largest_block)d\n" % stats)
+    for number, (simultaneous, equations) in enumerate(result, 1):
+        f.write("' BLOCK %d: %s, %d equation%s\n" % (number, "simultaneous" if simultaneous else "recursive",
+                                                    len(equations), "s" if len(equations) > 1 else ""))
+        for equation in equations:
+            f.write(equation + "\n")
+    return stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Order compiled equations into recursive and simultaneous blocks")
+    parser.add_argument("input", help = "file of compiled equations, e.g. the output of batch.py")
+    parser.add_argument("output", help = "file where the ordered equations are written")
+    args = parser.parse_args()
+
+    with open(args.output, 'w') as f:
+        stats = write_blocks(blocks(read_equations(args.input)), f)
+    print "%(equations)d equations, %(simultaneous_blocks)d simultaneous blocks, largest block: %(largest_block)d" % stats
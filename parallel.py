@@ -0,0 +1,96 @@
+import os, itertools
+
+from heapstore import HeapStore
+from incremental import RecordingHeap
+import cse
+
+# Parallel compilation of a single Formula with many bindings
+#
+# The iterator product is partitioned on its outermost iterators: each partition binds them
+# to one of their combinations of values, and iterates over all the values of the others, e.g.
+# for `V in Q CH, c in 01 02, s in 01 02 03`, the partitions (Q, 01), (Q, 02), (CH, 01) and (CH, 02)
+# Conditions are evaluated and equations emitted for each partition in a pool of worker processes,
+# and the partitions are generated in their order in the product, which is the original order
+#
+# It is only worth it for Formulas with at least MIN_BINDINGS bindings, which can also be set
+# with the MODEL_PARALLEL_MIN_BINDINGS environment variable, and only if the heap can be shared
+# with the workers: a HeapStore, which they memory-map, or a dict
+# If it is recorded, see incremental.py and resultcache.py, the workers record the values they read,
+# and send them back. Heaps which count their lookups, see stats.py, are used in process
+
+MIN_BINDINGS = int(os.environ.get('MODEL_PARALLEL_MIN_BINDINGS', 200000))
+
+# Number of worker processes, all the cores by default
+processes = None
+
+# Number of partitions per worker process, so that their sizes even out
+PARTITIONS_PER_PROCESS = 4
+
+def process_count():
+    if processes is not None:
+        return processes
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+def binding_count(iterators):
+    count = 1
+    for _, values in iterators:
+        count *= len(values)
+    return count
+
+def shared(heap):
+    return heap.heap if isinstance(heap, RecordingHeap) else heap
+
+def wanted(iterators, heap):
+    if binding_count(iterators) < MIN_BINDINGS or not isinstance(shared(heap), (HeapStore, dict)):
+        return False
+    import multiprocessing
+    # The workers of a pool, e.g. those of batch.py, cannot start their own pool
+    return not multiprocessing.current_process().daemon and process_count() > 1
+
+# Partitions of the iterators: the values of the outermost iterators are restricted to one
+# of their combinations, so that there are at least count partitions if possible
+def partitions(iterators, count):
+    outer = 0
+    size = 1
+    while outer < len(iterators) and size < count:
+        size *= len(iterators[outer][1])
+        outer += 1
+    for combination in itertools.product(*[values for _, values in iterators[:outer]]):
+        yield [(names, [value]) for (names, _), value in zip(iterators, combination)] + iterators[outer:]
+
+# The state of each worker process: the Formula, the heap, and how it is compiled
+worker = None
+
+# The named sets are passed along, for the iterators of sums
+def init_worker(formula, heap, fixed, marking, recording, sets):
+    global worker
+    import namedsets
+    worker = (formula, heap, fixed, recording)
+    cse.enabled = marking
+    namedsets.define(sets)
+
+# Returns the compiled equations of the partition, and the heap values read if recording, None otherwise
+def compile_partition(iterators):
+    formula, heap, fixed, recording = worker
+    if recording:
+        heap = RecordingHeap(heap)
+    return list(formula.compile_partition(heap, fixed, iterators)), heap.reads if recording else None
+
+def compile_lines(formula, heap, fixed, iterators):
+    import multiprocessing
+    import elements
+    count = process_count()
+    recording = isinstance(heap, RecordingHeap)
+    sets = elements.namedSets.items()
+    pool = multiprocessing.Pool(count, init_worker, (formula, shared(heap), fixed, cse.enabled, recording, sets))
+    try:
+        # imap returns the partitions in order, as soon as they are available
+        for lines, reads in pool.imap(compile_partition, partitions(iterators, PARTITIONS_PER_PROCESS * count)):
+            if recording:
+                heap.reads.update(reads)
+            for line in lines:
+                yield line
+    finally:
+        pool.terminate()
+        pool.join()
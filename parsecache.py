@@ -0,0 +1,107 @@
+import os, hashlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# Content-addressed cache of parsed Formulas, stored as pickles in a directory
+# Entries are keyed by the formula text and a hash of the grammar, so that a change
+# in grammar.py, fastparser.py or elements.py never returns a stale AST
+# The directory is bounded in size: the least recently used entries are evicted first
+# The Formulas kept in memory are bounded in number, and cleared once there are MAX_MEMO of them
+
+directory = os.path.dirname(os.path.abspath(__file__))
+
+MAX_MEMO = 10000
+
+def grammar_version():
+    digest = hashlib.sha1()
+    for name in ['grammar.py', 'fastparser.py', 'elements.py']:
+        with open(os.path.join(directory, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+class ParseCache(object):
+    def __init__(self, path = '_parse_cache', max_bytes = 64 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = grammar_version()
+        self.size = None
+        # Formulas already loaded or parsed by this process, see remember
+        self.memo = {}
+
+    # The code is hashed as the bytes it was read as, and as UTF-8 if it is unicode
+    def key(self, code):
+        if isinstance(code, unicode):
+            code = code.encode('utf-8')
+        return hashlib.sha1(self.version + '\0' + code).hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    def get(self, code):
+        key = self.key(code)
+        if key in self.memo:
+            return self.memo[key]
+        try:
+            with open(self.filename(key), 'rb') as f:
+                formula = pickle.load(f)
+        except Exception:
+            # Missing, partially written or unreadable entry
+            return None
+        # The modification time marks the last use, for eviction
+        try:
+            os.utime(self.filename(key), None)
+        except OSError:
+            pass
+        self.remember(key, formula)
+        return formula
+
+    def remember(self, key, formula):
+        if len(self.memo) >= MAX_MEMO:
+            self.memo.clear()
+        self.memo[key] = formula
+
+    def put(self, code, formula):
+        key = self.key(code)
+        self.remember(key, formula)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        # Write to a temporary file first, so that concurrent readers never see a partial entry
+        tmp_filename = '%s.%d.tmp' % (self.filename(key), os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(formula, f, pickle.HIGHEST_PROTOCOL)
+        if os.path.exists(self.filename(key)):
+            os.remove(self.filename(key))
+        os.rename(tmp_filename, self.filename(key))
+        if self.size is not None:
+            self.size += os.path.getsize(self.filename(key))
+        self.evict()
+
+    def entries(self):
+        return [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith('.pickle')]
+
+    def evict(self):
+        if self.size is None:
+            self.size = sum(os.path.getsize(e) for e in self.entries())
+        if self.size <= self.max_bytes:
+            return
+        # Evict down to 3/4 of the maximum size, so that eviction does not run on every put
+        for entry in sorted(self.entries(), key = os.path.getmtime):
+            if self.size <= self.max_bytes * 3 / 4:
+                break
+            try:
+                self.size -= os.path.getsize(entry)
+                os.remove(entry)
+            except OSError:
+                pass
+
+    # Returns the Formula for the code, parsing it only if it is not in the cache
+    def parse(self, code):
+        formula = self.get(code)
+        if formula is None:
+            import fastparser
+            formula = fastparser.parse(code)
+            self.put(code, formula)
+        return formula
@@ -0,0 +1,51 @@
+import os, socket, json
+
+# Messages exchanged between the compile server and its clients are JSON objects,
+# one per line. Requests are either
+#   {"formulas": ["Q = QD + QM", ...]}  to compile one or more formulas, or
+#   {"command": "ping"} / {"command": "shutdown"}
+# and the server replies with {"outputs": [...]} (one output per formula, in order),
+# or {"status": "ok"} for commands.
+
+DEFAULT_ADDRESS = "127.0.0.1:47474"
+
+# The server address is given as host:port for a TCP socket,
+# or as a file path for a Unix domain socket
+# It defaults to the MODEL_SERVER environment variable, if set
+def parse_address(spec = None):
+    spec = spec or os.environ.get("MODEL_SERVER") or DEFAULT_ADDRESS
+    host, sep, port = spec.rpartition(':')
+    if sep and port.isdigit() and os.sep not in spec:
+        return socket.AF_INET, (host or "127.0.0.1", int(port))
+    else:
+        return socket.AF_UNIX, spec
+
+def send_message(sock, message):
+    sock.sendall(json.dumps(message) + "\n")
+
+def receive_message(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if chunk.endswith("\n"):
+            break
+    data = "".join(chunks)
+    if not data:
+        raise socket.error("Connection closed by the compile server")
+    return json.loads(data)
+
+# Sends a message to the server and returns its reply
+# Raises socket.error if no server is listening at the address
+def request(message, address = None, timeout = None):
+    family, address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(address)
+        send_message(sock, message)
+        return receive_message(sock)
+    finally:
+        sock.close()
@@ -0,0 +1,157 @@
+import os, hashlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from parsecache import directory, grammar_version
+import stats
+
+# Content-addressed cache of compiled outputs, stored in a directory next to the parse cache
+#
+# A Formula only reads the heap to evaluate its conditions, and the same code compiled against
+# the same values of the heap entries it reads always gives the same output. For each formula,
+# keyed by its normalized text, which includes its option, and the fixed parameters folded, if any,
+# the cache keeps the names of the heap entries it read the last time it was compiled.
+# Its outputs are then keyed by a hash of these names and of their values: looking up a formula
+# hashes the current values of the names, and never compiles it
+#
+# Entries are written to a temporary file first, so that concurrent compiler processes never
+# read a partial entry, and the directory is bounded in size: the least recently used entries
+# are evicted first, as in parsecache.py
+
+# Outputs also depend on the folding of fixed parameters
+def result_version():
+    digest = hashlib.sha1(grammar_version())
+    with open(os.path.join(directory, 'folding.py'), 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+def normalized(code):
+    return ' '.join(code.split())
+
+# Width of the header of a result, which holds the number of bindings compiled
+HEADER_SIZE = 21
+
+# A result being written, to the output file and to a temporary file of the cache
+class Entry(object):
+    def __init__(self, cache, key, f):
+        self.cache = cache
+        self.key = key
+        self.f = f
+        if not os.path.exists(cache.path):
+            os.makedirs(cache.path)
+        self.tmp_filename = os.path.join(cache.path, '%s.%d.tmp' % (key, os.getpid()))
+        self.tmp = open(self.tmp_filename, 'wb')
+        self.tmp.write(' ' * (HEADER_SIZE - 1) + '\n')
+
+    def write(self, text):
+        self.f.write(text)
+        self.tmp.write(text)
+
+    def commit(self, reads, count):
+        self.tmp.seek(0)
+        self.tmp.write(str(count))
+        self.tmp.close()
+        names = tuple(sorted(reads))
+        tmp_filename = '%s.%d.tmp' % (self.cache.names_filename(self.key), os.getpid())
+        try:
+            self.cache.replace(self.tmp_filename, self.cache.result_filename(self.key, names, reads))
+            with open(tmp_filename, 'wb') as f:
+                pickle.dump(names, f, pickle.HIGHEST_PROTOCOL)
+            self.cache.replace(tmp_filename, self.cache.names_filename(self.key))
+        except (IOError, OSError):
+            # e.g. the entry is being read by another process on Windows: it is left as it is
+            for filename in [self.tmp_filename, tmp_filename]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            return
+        self.cache.evict()
+
+    def discard(self):
+        self.tmp.close()
+        try:
+            os.remove(self.tmp_filename)
+        except OSError:
+            pass
+
+class ResultCache(object):
+    def __init__(self, path = '_result_cache', max_bytes = 256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.version = result_version()
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, code, fixed = None):
+        return hashlib.sha1('\0'.join([self.version, normalized(code)] + sorted(fixed or ()))).hexdigest()
+
+    def names_filename(self, key):
+        return os.path.join(self.path, key + '.names')
+
+    def result_filename(self, key, names, heap):
+        digest = hashlib.sha1()
+        for name in names:
+            try:
+                value = heap[name]
+            except KeyError:
+                value = '<missing>'
+            digest.update('%s=%r\0' % (name, value))
+        return os.path.join(self.path, '%s-%s.result' % (key, digest.hexdigest()))
+
+    # Returns (number of bindings compiled, open file of the output) if the output of the code
+    # against the heap is in the cache, None otherwise
+    def get(self, code, heap, fixed = None):
+        key = self.key(code, fixed)
+        try:
+            with open(self.names_filename(key), 'rb') as f:
+                names = pickle.load(f)
+            filename = self.result_filename(key, names, heap)
+            f = open(filename, 'rb')
+            count = int(f.read(HEADER_SIZE))
+        except Exception:
+            # Missing, partially written or unreadable entry
+            self.misses += 1
+            stats.count('result_cache_misses')
+            return None
+        # The modification time marks the last use, for eviction
+        for used in [self.names_filename(key), filename]:
+            try:
+                os.utime(used, None)
+            except OSError:
+                pass
+        self.hits += 1
+        stats.count('result_cache_hits')
+        return count, f
+
+    # Entry through which the output of the code is written to f, and then committed to the cache
+    def entry(self, code, f, fixed = None):
+        return Entry(self, self.key(code, fixed), f)
+
+    def replace(self, tmp_filename, filename):
+        if os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmp_filename, filename)
+        if self.size is not None:
+            self.size += os.path.getsize(filename)
+
+    def entries(self):
+        return [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(('.names', '.result'))]
+
+    def evict(self):
+        if self.size is None:
+            self.size = sum(os.path.getsize(e) for e in self.entries())
+        if self.size <= self.max_bytes:
+            return
+        # Evict down to 3/4 of the maximum size, so that eviction does not run on every put
+        for entry in sorted(self.entries(), key = os.path.getmtime):
+            if self.size <= self.max_bytes * 3 / 4:
+                break
+            try:
+                size = os.path.getsize(entry)
+                os.remove(entry)
+                self.size -= size
+            except OSError:
+                pass
@@ -0,0 +1,85 @@
+import sys, argparse
+
+import compilation
+import batch
+import folding
+
+# Compiles a model file against several heaps, e.g. the tmp_all_vars.csv of scenarios, in one pass
+#
+# Each formula is parsed and lowered once, and its conditions are evaluated in all the heaps
+# for each chunk of bindings, see Formula.compile_scenarios. One output file is written per heap,
+# in the format of batch.py, along with a report of the equations which differ between the scenarios,
+# listed by formula, e.g.
+#   ' 12: Q[c] = QD[c] if QD[c] <> 0, c in 01 02
+#   Q_02 = QD_02: 1 3
+#   ' 13: Y = sum(Q[c] if Q[c] <> 0, c in 01 02)
+#   Y = 0 + Q_01: 1 2, Y = 0 + Q_01 + Q_02: 3
+# where each variant of an equation is followed by the scenarios (numbered from 1) in which it is compiled
+#
+# A formula which fails to compile in any scenario is compiled against each heap separately,
+# so that each output gets the same error records as with batch.py
+
+# Returns (output in each heap, error message in each heap, the variants of the equations which differ)
+def compile_formula(code, heaps, fixed = None):
+    try:
+        formula = compilation.parse(code)
+        lines = list(formula.compile_scenarios(heaps, fixed))
+    except Exception:
+        results = [batch.compile_with(heap, (None, code), fixed) for heap in heaps]
+        return [result[2] for result in results], [result[3] for result in results], []
+    outputs = ["\n".join(line[i] for line in lines if line[i] is not None) for i in range(len(heaps))]
+    differences = [variants(line) for line in lines if len(set(line)) > 1]
+    return outputs, [None] * len(heaps), differences
+
+# The distinct equations, each with the scenarios in which it is compiled
+def variants(line):
+    scenarios = {}
+    for i, equation in enumerate(line):
+        if equation is not None:
+            scenarios.setdefault(equation, []).append(i + 1)
+    return sorted(scenarios.items(), key = lambda (equation, numbers): numbers)
+
+def format_differences(number, code, differences):
+    lines = ["' %d: %s\n" % (number, code)]
+    for difference in differences:
+        lines.append(', '.join('%s: %s' % (equation.replace('\n', ' / '), ' '.join(str(n) for n in numbers))
+                               for equation, numbers in difference) + '\n')
+    return ''.join(lines)
+
+# Compiles the model file against the heaps, into one output file per heap and the report
+# Returns the number of formulas which failed in any scenario
+def compile_model(model_path, heap_paths, output_paths, report_path, fixed = None):
+    entries = batch.read_model(model_path)
+    heaps = [compilation.load_heap(path) for path in heap_paths]
+    outputs = [open(path, 'w') for path in output_paths]
+    errors = 0
+    try:
+        with open(report_path, 'w') as report:
+            for number, code in entries:
+                compiled, messages, differences = compile_formula(code, heaps, fixed)
+                for f, output, error in zip(outputs, compiled, messages):
+                    f.write(batch.format_result((number, code, output, error)))
+                errors += any(error is not None for error in messages)
+                if differences:
+                    report.write(format_differences(number, code, differences))
+    finally:
+        for f in outputs:
+            f.close()
+    return errors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Compile a model file against the heaps of several scenarios")
+    parser.add_argument("model", help = "file of formulas")
+    parser.add_argument("report", help = "file where the equations which differ between the scenarios are listed")
+    parser.add_argument("--heaps", nargs = '+', required = True, help = "values of all variables in each scenario")
+    parser.add_argument("--outputs", nargs = '+', required = True, help = "file where the equations of each scenario are written")
+    parser.add_argument("--fixed", help = "file of the names of fixed parameters, see batch.py")
+    args = parser.parse_args()
+    if len(args.heaps) != len(args.outputs):
+        parser.error("there must be one output per heap")
+
+    fixed = folding.read_fixed(args.fixed) if args.fixed else None
+    errors = compile_model(args.model, args.heaps, args.outputs, args.report, fixed)
+    if errors > 0:
+        print str(errors) + " formula(s) failed to compile in some scenario"
+    sys.exit(1 if errors > 0 else 0)
@@ -0,0 +1,90 @@
+import os, socket, argparse
+import SocketServer
+
+import compilation
+from heapstore import HeapStore
+import protocol
+
+# A long-lived compiler: the grammar and the heap are loaded once,
+# then formulas are compiled on request over a local socket (see protocol.py)
+# The heap is loaded again before a request if its CSV file has changed since, e.g. rewritten by eViews
+# Requests are handled one at a time, in the order they are received
+class CompileHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        message = protocol.receive_message(self.request)
+        if message.get("command") == "shutdown":
+            protocol.send_message(self.request, {"status": "ok"})
+            self.server.shutting_down = True
+        elif "formulas" in message:
+            protocol.send_message(self.request, {"outputs": self.server.compile_all(message["formulas"])})
+        else:
+            protocol.send_message(self.request, {"status": "ok"})
+
+class CompileServerMixin:
+    allow_reuse_address = True
+    shutting_down = False
+    heapPath = None
+
+    # The modification time and size of the CSV file of the heap, as HeapStore.open checks them
+    def csv_stat(self):
+        stat = os.stat(self.heapPath)
+        return stat.st_mtime, stat.st_size
+
+    # Those of the CSV file the heap was loaded from, if known
+    def heap_stat(self, heap):
+        if isinstance(heap, HeapStore):
+            return heap.mtime, heap.size
+        return self.csv_stat()
+
+    def use_heap(self, heap):
+        self.heap, self.heapStat = heap, self.heap_stat(heap)
+
+    def refresh_heap(self):
+        if self.heapPath is not None and self.csv_stat() != self.heapStat:
+            self.use_heap(compilation.load_heap(self.heapPath))
+
+    def compile_all(self, formulas):
+        self.refresh_heap()
+        return [compilation.compile_code(code, self.heap) for code in formulas]
+
+    def serve(self):
+        while not self.shutting_down:
+            self.handle_request()
+
+class TCPCompileServer(CompileServerMixin, SocketServer.TCPServer): pass
+
+if hasattr(socket, "AF_UNIX"):
+    class UnixCompileServer(CompileServerMixin, SocketServer.UnixStreamServer): pass
+
+# If the path of the CSV file of the heap is given, the heap is reloaded when the file changes
+def make_server(heap, address = None, heap_path = None):
+    family, address = protocol.parse_address(address)
+    if family == socket.AF_INET:
+        server = TCPCompileServer(address, CompileHandler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixCompileServer(address, CompileHandler)
+    server.heap = heap
+    if heap_path is not None:
+        server.heapPath = heap_path
+        server.use_heap(heap)
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Resident MoDeL compile server")
+    parser.add_argument("directory", nargs = '?', help = "directory containing tmp_all_vars.csv")
+    parser.add_argument("--address", help = "host:port or Unix socket path (default: %s)" % protocol.DEFAULT_ADDRESS)
+    args = parser.parse_args()
+
+    if args.directory:
+        os.chdir(args.directory)
+
+    server = make_server(compilation.load_heap(), args.address, 'tmp_all_vars.csv')
+    print "Ready to compile on " + str(server.server_address)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
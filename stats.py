@@ -0,0 +1,115 @@
+import os, time
+from collections import Mapping, defaultdict
+
+# Opt-in statistics of a compilation: wall time and counts per phase
+#
+# Set the MODEL_STATS environment variable to write them as a JSON sidecar next to the output
+# file of compiler.py, imcompiler.py and async-compiler.py, e.g. out.txt.stats.json
+# Set MODEL_PROFILE to 'cprofile' or 'tracemalloc' to also dump a profile (out.txt.prof)
+# or a memory snapshot (out.txt.tracemalloc, Python 3 only)
+#
+# Phase times are exclusive: the time spent in a nested phase, e.g. the conditions
+# of a sum while its outer equation is emitted, only counts for the nested phase
+#
+# When statistics are not enabled, current is None and phase() and count() do nothing
+
+current = None
+
+class NullPhase(object):
+    def __enter__(self): pass
+    def __exit__(self, *args): pass
+
+NULL_PHASE = NullPhase()
+
+class Phase(object):
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        # Time spent in the phases nested in this one
+        self.stats.stack.append(0.)
+
+    def __exit__(self, *args):
+        elapsed = time.time() - self.start
+        self.stats.times[self.name] += elapsed - self.stats.stack.pop()
+        if self.stats.stack:
+            self.stats.stack[-1] += elapsed
+
+class Stats(object):
+    def __init__(self):
+        self.start = time.time()
+        self.times = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.stack = []
+        self.profiler = None
+        self.tracemalloc = None
+
+    def as_dict(self):
+        return {"total": time.time() - self.start, "times": dict(self.times), "counts": dict(self.counts)}
+
+# Heap which counts its lookups
+class CountingHeap(Mapping):
+    def __init__(self, heap, stats):
+        self.heap = heap
+        self.stats = stats
+
+    def __getitem__(self, name):
+        self.stats.counts['heap_lookups'] += 1
+        return self.heap[name]
+
+    def __contains__(self, name):
+        return name in self.heap
+
+    def __iter__(self):
+        return iter(self.heap)
+
+    def __len__(self):
+        return len(self.heap)
+
+def phase(name):
+    return NULL_PHASE if current is None else Phase(current, name)
+
+def count(name, n = 1):
+    if current is not None:
+        current.counts[name] += n
+
+# The heap, counting its lookups if statistics are enabled
+def counted(heap):
+    return heap if current is None else CountingHeap(heap, current)
+
+# Starts recording statistics if the MODEL_STATS environment variable is set
+def start_if_requested():
+    global current
+    if not os.environ.get('MODEL_STATS'):
+        return
+    current = Stats()
+    profile = os.environ.get('MODEL_PROFILE', '').lower()
+    if profile == 'cprofile':
+        import cProfile
+        current.profiler = cProfile.Profile()
+        current.profiler.enable()
+    elif profile == 'tracemalloc':
+        try:
+            import tracemalloc
+        except ImportError:
+            return
+        tracemalloc.start()
+        current.tracemalloc = tracemalloc
+
+# Stops recording, and writes the statistics next to the output file
+def finish(output_path):
+    global current
+    if current is None:
+        return
+    stats, current = current, None
+    if stats.profiler is not None:
+        stats.profiler.disable()
+        stats.profiler.dump_stats(output_path + '.prof')
+    if stats.tracemalloc is not None:
+        stats.tracemalloc.take_snapshot().dump(output_path + '.tracemalloc')
+        stats.tracemalloc.stop()
+    import json
+    with open(output_path + '.stats.json', 'w') as f:
+        json.dump(stats.as_dict(), f, indent = 2, sort_keys = True)
@@ -0,0 +1,90 @@
+from .. import batch
+import os, shutil, tempfile
+
+class TestBatch(object):
+    @classmethod
+    def setup_class(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.model = os.path.join(cls.directory, 'model.txt')
+        with open(cls.model, 'w') as f:
+            f.write("' Supply\n"
+                    "|V|[c] = |V|D[c] + |V|M[c], V in Q CH, c in 01 02\n"
+                    "\n"
+                    "= QD[c] + QM[c], c in 01 02\n"
+                    "# Undefined iterator\n"
+                    '"X[c] = |V|[c], c in 01"\n'
+                    "Y = sum(Y[c] if 0 > 1, c in 01)\n"
+                    "Z[c] = 1 if UNKNOWN[c] > 0, c in 01 02\n")
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_reads_model(self):
+        assert [number for number, code in batch.read_model(self.model)] == [2, 4, 6, 7, 8]
+        assert batch.read_model(self.model)[2][1] == "X[c] = |V|[c], c in 01"
+
+    def test_compiles_model_in_order_with_error_records(self):
+        for processes in [1, 2]:
+            output = os.path.join(self.directory, 'out%d.txt' % processes)
+            assert batch.compile_model(self.model, output, '../tmp_all_vars.csv', processes) == 3
+            lines = open(output).read().splitlines()
+            assert lines[:5] == ["' 2: |V|[c] = |V|D[c] + |V|M[c], V in Q CH, c in 01 02",
+                                 "Q_01 = QD_01 + QM_01", "Q_02 = QD_02 + QM_02",
+                                 "CH_01 = CHD_01 + CHM_01", "CH_02 = CHD_02 + CHM_02"]
+            assert lines[5].startswith("' ERROR 4: ") and lines[6].startswith("' ")
+            assert lines[7].startswith("' ERROR 6: ") and "IndexError" in lines[8]
+            assert lines[9:] == ["' 7: Y = sum(Y[c] if 0 > 1, c in 01)", "Y = 0",
+                                 "' ERROR 8: Z[c] = 1 if UNKNOWN[c] > 0, c in 01 02",
+                                 "' Missing variables: UNKNOWN_01 (c = 01), UNKNOWN_02 (c = 02)"]
+
+    def test_compiles_model_incrementally(self):
+        heap_path = os.path.join(self.directory, 'tmp_all_vars.csv')
+        model = os.path.join(self.directory, 'incremental.txt')
+        with open(model, 'w') as f:
+            f.write("Y[c] = sum(X[c, s] if X[c, s] > 0, s in 01 02), c in 01 02\n"
+                    "Z[c] = X[c, c], c in 01 02\n"
+                    "W = sum(Y[c] if Y[c] <> 0, c in 01 02)\n")
+        state = os.path.join(self.directory, 'model.state')
+        output = os.path.join(self.directory, 'incremental_out.txt')
+
+        def compile(values, changed = None):
+            with open(heap_path, 'w') as f:
+                f.write("obs,X_01_01,X_01_02,X_02_01,X_02_02,Y_01,Y_02\n,,,,,,\n2006," + ",".join(values) + "\n")
+            compiled = []
+            original = batch.compile_entry
+            def compile_entry(entry):
+                compiled.append(entry[0])
+                return original(entry)
+            batch.compile_entry = compile_entry
+            try:
+                assert batch.compile_model(model, output, heap_path, 1, state, changed) == 0
+            finally:
+                batch.compile_entry = original
+            return compiled, open(output).read().splitlines()
+
+        compiled, lines = compile(['1', '0', '2', '3', '1', '0'])
+        assert compiled == [1, 2, 3]
+        assert lines[1:3] == ["Y_01 = 0 + X_01_01", "Y_02 = 0 + X_02_01 + X_02_02"]
+        # Only the formula which reads X_01_02 is compiled again
+        compiled, lines = compile(['1', '50', '2', '3', '1', '0'])
+        assert compiled == [1]
+        assert lines[1:3] == ["Y_01 = 0 + X_01_01 + X_01_02", "Y_02 = 0 + X_02_01 + X_02_02"]
+        assert lines[3:6] == ["' 2: Z[c] = X[c, c], c in 01 02", "Z_01 = X_01_01", "Z_02 = X_02_02"]
+        assert lines[6:] == ["' 3: W = sum(Y[c] if Y[c] <> 0, c in 01 02)", "W = 0 + Y_01"]
+        compiled, _ = compile(['1', '50', '2', '3', '1', '0'], ['Y_02'])
+        assert compiled == [3]
+
+    def test_extracts_common_subexpressions(self):
+        model = os.path.join(self.directory, 'cse.txt')
+        with open(model, 'w') as f:
+            f.write("|V|[c] = sum(X[c, s], s in 01 02 03), V in Q CH, c in 01\n"
+                    "Z[c] = sum(X[c, s], s in 01 02 03) * 2, c in 01\n")
+        output = os.path.join(self.directory, 'cse_out.txt')
+        assert batch.compile_model(model, output, '../tmp_all_vars.csv', 1, extract_subexpressions = True) == 0
+        lines = open(output).read().splitlines()
+        name = lines[1].split(' = ')[0]
+        assert lines[:2] == ["' COMMON SUBEXPRESSIONS", name + " = X_01_01 + X_01_02 + X_01_03"]
+        assert lines[3:5] == ["Q_01 = 0 + " + name, "CH_01 = 0 + " + name]
+        # Followed by `* 2`, the sum is left inline, as eViews only multiplies its last term
+        assert lines[6] == "Z_01 = 0 + X_01_01 + X_01_02 + X_01_03 * 2"
@@ -0,0 +1,28 @@
+from .. import benchmark, heapstore
+import os, shutil, tempfile
+
+class TestBenchmark(object):
+    def test_writes_synthetic_heap_as_csv(self):
+        directory = tempfile.mkdtemp()
+        try:
+            heap = benchmark.synthetic_heap(3, 2)
+            path = os.path.join(directory, 'tmp_all_vars.csv')
+            benchmark.write_heap_csv(heap, path)
+            values = heapstore.read_csv(path)
+            assert values.pop('obs') == 2006
+            assert values == heap
+        finally:
+            shutil.rmtree(directory)
+
+    def test_times_every_phase(self):
+        results = benchmark.run(3, 2, repeat = 1)
+        phases = set((r["benchmark"], r["phase"]) for r in results)
+        for name, _ in benchmark.synthetic_formulas(3, 2):
+            assert set(p for b, p in phases if b == name) == set(['parse', 'parse_fast', 'iterate', 'conditions', 'compile'])
+        assert set(p for b, p in phases if b == "heap") == set(['heap_csv', 'heap_build', 'heap_open'])
+        assert all(r["seconds"] >= 0 for r in results)
+
+    def test_compares_reports(self):
+        previous = benchmark.report(3, 2, 1, [{"benchmark": "sum", "phase": "compile", "size": 15, "seconds": 2.}])
+        lines = benchmark.compare(previous, [{"benchmark": "sum", "phase": "compile", "size": 15, "seconds": 1.}])
+        assert len(lines) == 1 and lines[0].endswith("x0.50")
@@ -1,14 +1,10 @@
-from .. import grammar
-import csv
+from .. import grammar, namedsets, elements
+from ..heapstore import HeapStore
 
 class TestCompiler(object):
     @classmethod
     def setup_class(cls):
-        with open('../tmp_all_vars.csv', 'rb') as csvfile:
-            rows = list(csv.reader(csvfile))
-            cls.heap = dict(zip(rows[0],
-                                [float(e) if e != 'NA' else
-                                 None for e in rows[2]]))
+        cls.heap = HeapStore.open('../tmp_all_vars.csv')
 
     def test_parses_VariableName_with_alphas(self):
         res = grammar.variableName.parseString("testVariable")[0]
@@ -184,6 +180,16 @@ class TestCompiler(object):
         res = grammar.equation.parseString("energy[com] = B[3]")[0]
         assert res.compile({grammar.VariableName('com'): '24'}, {}, '!pv') == "Penergy_24 * energy_24 = PB_3 * B_3\nenergy_24 = B_3"
 
+    def test_lowers_Equation_to_Template(self):
+        bindings = {grammar.VariableName('V'): 'Q', grammar.VariableName('c'): '02', grammar.VariableName('$c'): 2}
+        heap = {'Q_01_02': 1, 'Q_02_02': 0}
+        for code in ["|V|[c] = |V|D[c](-1) + d(log(A[c, $c])) * $c + value(B[c] + C)",
+                     "|V|[c] = sum(|V|[s, c] if |V|[s, c] <> 0, s in 01 02) - 2.5 * X"]:
+            res = grammar.equation.parseString(code)[0]
+            for option in ['', '!pv']:
+                template = grammar.Template(res.lower(set(bindings.keys()), option))
+                assert template.fill(bindings, heap) == res.compile(bindings, heap, option)
+
     def test_parses_Condition(self):
         res = grammar.condition.parseString("if energy[com, sec] > 0")[0]
         assert isinstance(res, grammar.Condition)
@@ -208,6 +214,39 @@ class TestCompiler(object):
         res = grammar.lst.parseString("01 02 03 04 05 06 07 \ 04 06")[0]
         assert res.compile() == ['01', '02', '03', '05', '07']
 
+    def test_compiles_Lst_ranges_and_filters(self):
+        res = grammar.lst.parseString("01..12 \\ 05 09..10")[0]
+        assert res.base == (grammar.LstRange('01', '12'),)
+        assert res.compile() == ['01', '02', '03', '04', '06', '07', '08', '11', '12']
+        assert res.counters() == [1, 2, 3, 4, 6, 7, 8, 11, 12]
+        # Expanded once, and shared
+        assert res.compile() is res.compile()
+        res = grammar.lst.parseString("8..11 & 9 10 11..20")[0]
+        assert res.compile() == ['9', '10', '11']
+        assert grammar.LstRange('01', '12').contains('05') and not grammar.LstRange('01', '12').contains('5')
+
+    def test_sizes_and_indexes_Lst_without_listing_it(self):
+        res = grammar.lst.parseString("A 001..100 B")[0]
+        assert res.size() == 102 and res.value(0) == 'A' and res.value(100) == '100' and res.value(101) == 'B'
+        assert res.size() == len(res.compile()) and [res.value(i) for i in range(102)] == res.compile()
+
+    def test_compiles_Formula_over_named_sets(self):
+        namedsets.define([('%coms', grammar.lst.parseString("01..04")[0]),
+                          ('%energy', grammar.lst.parseString("%coms & 03 04")[0]),
+                          ('_energy', grammar.lst.parseString("%energy")[0])])
+        try:
+            res = grammar.formula.parseString("Y[c] = X[c] * $c, c in %coms \\ %energy")[0]
+            assert res.compile({}) == "Y_01 = X_01 * 1\nY_02 = X_02 * 2"
+            res = grammar.formula.parseString("Y[c] = sum(X[c, s], s in %coms \\ 01..02), c in _energy")[0]
+            assert res.compile({}) == "Y_03 = 0 + X_03_03 + X_03_04\nY_04 = 0 + X_04_03 + X_04_04"
+        finally:
+            namedsets.define([])
+        try:
+            res.compile({})
+            assert False
+        except NameError:
+            pass
+
     def test_parses_Grouped_Lst(self):
         res = grammar.grouped(grammar.lst).parseString("(01 02 03 04 05 06 07, 01 02 03)")[0]
         assert isinstance(res, grammar.Grouped)
@@ -284,3 +323,124 @@ class TestCompiler(object):
                     "Q_06 = Test_3 + 2 * 3")
         res = grammar.formula.parseString("Q[c] = Test[$c] + 2 * $c, c in 04 05 06")[0]
         assert res.compile({}) == expected
+
+    def test_generates_Formula_equations_lazily(self):
+        res = grammar.formula.parseString("|V|[com] = |V|D[com] + |V|M[com], V in Q CH, com in 01 02")[0]
+        lines = res.compile_lines({})
+        assert not isinstance(lines, list)
+        assert next(lines) == "Q_01 = QD_01 + QM_01"
+        assert len(list(lines)) == 3
+
+    def test_compiles_Formula_across_condition_chunks(self):
+        values = ' '.join(['%04d' % i for i in range(1, 10001)])
+        heap = dict(('X_%04d' % i, i % 3) for i in range(1, 10001))
+        res = grammar.formula.parseString("Y[c] = X[c] if X[c] > 0, c in " + values)[0]
+        assert res.compile(heap).splitlines() == ['Y_%04d = X_%04d' % (i, i) for i in range(1, 10001) if i % 3 > 0]
+
+    def test_writes_Formula(self):
+        import StringIO
+        f = StringIO.StringIO()
+        res = grammar.formula.parseString("!pv |V|[com] = |V|D[com], V in Q CH, com in 01 02")[0]
+        assert res.write({}, f) == 4
+        assert f.getvalue() == res.compile({})
+
+    def test_compiles_SumFunc_with_split_Condition(self):
+        heap = {'X_01': 1, 'X_02': 0, 'Y_10': 1, 'Y_11': 0, 'Z_01_10': 2, 'Z_02_10': 0, 'Z_01_11': 2, 'Z_02_11': 2}
+        res = grammar.formula.parseString("Q[s] = sum(Q[c, s] if X[c] > 0 and Y[s] > 0 and Z[c, s] > 1, c in 01 02), s in 10 11")[0]
+        assert res.compile(heap) == "Q_10 = 0 + Q_01_10\nQ_11 = 0"
+        # The division by zero is skipped by `and`, as without the split
+        res = grammar.formula.parseString("Q[s] = sum(Q[c, s] if X[c] <> 0 and 1 / X[c] > 0, c in 01 02), s in 10 11")[0]
+        assert res.compile(heap) == "Q_10 = 0 + Q_01_10\nQ_11 = 0 + Q_01_11"
+        # A False outer conjunct only skips the sum if it comes first, as errors before it are raised
+        res = grammar.formula.parseString("Q[c] = sum(Y[c, t] if H[t, c] * 2 == 1 and H[c] * 2 <= 1, t in 01), c in 01")[0]
+        try:
+            res.compile({'H_01_01': None, 'H_01': 1.0})
+            assert False
+        except TypeError:
+            pass
+        res = grammar.formula.parseString("Q[c] = sum(Y[c, t] if H[c] * 2 <= 1 and H[t, c] * 2 == 1, t in 01), c in 01")[0]
+        assert res.compile({'H_01_01': None, 'H_01': 1.0}) == "Q_01 = 0"
+
+    def test_memoizes_SumFunc_across_unused_outer_bindings(self):
+        heap = {'X_01': 1, 'X_02': 0}
+        res = grammar.formula.parseString("|V| = sum(X[c] if X[c] > 0, c in 01 02), V in Q CH")[0]
+        assert res.compile(heap) == "Q = 0 + X_01\nCH = 0 + X_01"
+        assert res.compile({'X_01': 0, 'X_02': 1}) == "Q = 0 + X_02\nCH = 0 + X_02"
+        # The memoized sums are not kept across compilations, in which the heap may have changed in place
+        heap['X_02'] = 5
+        assert res.compile(heap) == "Q = 0 + X_01 + X_02\nCH = 0 + X_01 + X_02"
+
+    def test_compiles_SumFunc_shadowing_outer_iterator(self):
+        # The condition uses the iterator of the sum, the terms use the outer iterator
+        res = grammar.formula.parseString("Y[c] = sum($c * Z[c] if X[c] > 0, c in 01 02), c in 01 02")[0]
+        assert res.compile({'X_01': 1, 'X_02': 0}) == "Y_01 = 0 + 1 * Z_01\nY_02 = 0 + 2 * Z_02"
+
+    def test_fills_Template_with_values_in_Layout(self):
+        res = grammar.formula.parseString("|V|[c] = |V|D[c] * $c, V in Q CH, c in 01 02")[0]
+        layout = res.layout()
+        assert list(res.iter_values())[1] == ('Q', 1, '02', 2)
+        template = res.template(layout.names, '').at(layout)
+        assert template.fill(('CH', 2, '01', 1), {}) == "CH_01 = CHD_01 * 1"
+
+    def test_interns_structurally_equal_nodes(self):
+        res = grammar.formula.parseString("Y[c] = Q[c] + 1.0 * Q[c] + 1, c in 01")[0]
+        assert res is grammar.formula.parseString("Y[c] = Q[c] + 1.0 * Q[c] + 1, c in 01")[0]
+        elements = res.equation.rhs.value
+        assert isinstance(elements, tuple) and elements[0] is elements[4]
+        # Equal as tuples, but not the same nodes
+        assert isinstance(elements[2], grammar.Real) and isinstance(elements[6], grammar.Integer)
+        assert res.compile({}) == "Y_01 = Q_01 + 1.0 * Q_01 + 1"
+
+    def test_bounds_the_interned_nodes(self):
+        code = "Y[c] = sum(Q[c, s] + 7.5, s in 01) + 3, c in 01"
+        res = grammar.formula.parseString(code)[0]
+        res.compile({})
+        assert len(elements.lstExpansions) > 0
+        elements.MAX_NODES, previous = len(elements.nodes) + 5, elements.MAX_NODES
+        try:
+            grammar.formula.parseString("Y[c] = sum(Q[c, s] + 8.5, s in 02) + 4, c in 02")
+            assert len(elements.nodes) < elements.MAX_NODES
+            # The caches keyed by id(node) are cleared with the table
+            assert len(elements.lstExpansions) == 0 and len(elements.sumExpansions) == 0
+            # Equal to the nodes built before the table was cleared, but not the same
+            again = grammar.formula.parseString(code)[0]
+            assert again == res and again is not res
+            assert again.compile({}) == res.compile({}) == "Y_01 = 0 + Q_01_01 + 7.5 + 3"
+        finally:
+            elements.MAX_NODES = previous
+
+    def test_checks_Condition_references_before_compiling(self):
+        heap = {'X_01_01': 1., 'X_02_01': 1., 'Y_01': 2., 'Y_02': None}
+        res = grammar.formula.parseString("Z[c, s] = 1 if X[c, s] > 0 and Y[c] * 2 > 1, c in 01 02 03, s in 01 02")[0]
+        lines = res.compile_lines(heap)
+        try:
+            next(lines)
+            assert False
+        except grammar.InvalidReferences as e:
+            assert isinstance(e, KeyError)
+            assert e.missing == {'X_01_02': 'c = 01, s = 02', 'X_02_02': 'c = 02, s = 02', 'X_03_01': 'c = 03, s = 01',
+                                 'X_03_02': 'c = 03, s = 02', 'Y_03': 'c = 03, s = 01'}
+            # NA values compare lower than any number, and only fail in arithmetic
+            assert e.na == {'Y_02': 'c = 02, s = 01'}
+            assert str(e).startswith("Missing variables: X_01_02 (c = 01, s = 02), X_02_02 (c = 02, s = 02), ")
+            assert str(e).endswith("; NA values in arithmetic: Y_02 (c = 02, s = 01)")
+        # NA values in arithmetic which is not evaluated, after `and`, are not reported
+        heap = {'QD_01': 2., 'QM_01': 1., 'QD_02': None, 'QM_02': None}
+        res = grammar.formula.parseString("Q[c] = QD[c] if QD[c] > 0 and QM[c] / QD[c] > 0.1, c in 01 02")[0]
+        res.check_references(heap, res.iterator_values())
+        assert res.compile(heap) == "Q_01 = QD_01"
+
+    def test_checks_Condition_references_once_per_distinct_name(self):
+        class CountingHeap(dict):
+            lookups = 0
+            def __getitem__(self, name):
+                CountingHeap.lookups += 1
+                return dict.__getitem__(self, name)
+        values = ' '.join(['%03d' % i for i in range(1, 101)])
+        heap = CountingHeap(('X_%03d' % i, 1.) for i in range(1, 101))
+        res = grammar.formula.parseString("Y[c, s] = 1 if X[c] > 0 and X[s] > 0, c in %s, s in %s" % (values, values))[0]
+        res.check_references(heap, res.iterator_values())
+        assert CountingHeap.lookups == 200
+        # The conditions of sums are only evaluated where the outer condition holds
+        res = grammar.formula.parseString("Y[c] = sum(Z[c, s] if Z[c, s] > 0, s in 01) if X[c] > 0, c in 001")[0]
+        assert res.compile({'X_001': 0.}) == ""
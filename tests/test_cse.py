@@ -0,0 +1,43 @@
+from .. import grammar, cse
+import hashlib
+
+class TestCse(object):
+    def test_marks_sums_and_values_while_marking(self):
+        formula = grammar.formula.parseString("Y = sum(X[c], c in 01 02 03) + value(A + B + C) + sum(X[c], c in 01)")[0]
+        assert formula.compile({}) == "Y = 0 + X_01 + X_02 + X_03 + PA * A + PB * B + PC * C + 0 + X_01"
+        with cse.marking():
+            assert formula.compile({}) == "Y = 0 + \x02X_01 + X_02 + X_03\x03 + \x02PA * A + PB * B + PC * C\x03 + 0 + X_01"
+        assert not cse.enabled
+
+    def test_extracts_texts_occurring_twice(self):
+        definitions, outputs = cse.extract(["A = 0 + \x02X + Y + Z\x03", "B = 1 + \x02X + Y + Z\x03 - C", "C = \x02U + V + W\x03"])
+        name = cse.name("X + Y + Z")
+        assert definitions == [(name, "X + Y + Z")]
+        assert outputs == ["A = 0 + " + name, "B = 1 + " + name + " - C", "C = U + V + W"]
+
+    def test_leaves_texts_whose_grouping_changes(self):
+        definitions, outputs = cse.extract(["A = 0 + \x02X + Y + Z\x03 * 2", "B = 0 + \x02X + Y + Z\x03 * 2"])
+        assert definitions == [] and outputs == ["A = 0 + X + Y + Z * 2", "B = 0 + X + Y + Z * 2"]
+
+    def test_extracts_nested_texts_innermost_first(self):
+        inner = "\x02X + Y + Z\x03"
+        definitions, outputs = cse.extract(["A = 0 + \x02U + 0 + %s + V\x03" % inner, "B = 0 + " + inner, "C = 0 + \x02U + 0 + %s + V\x03" % inner])
+        name = cse.name("X + Y + Z")
+        outer = cse.name("U + 0 + %s + V" % name)
+        assert sorted(definitions) == sorted([(name, "X + Y + Z"), (outer, "U + 0 + %s + V" % name)])
+        assert outputs == ["A = 0 + " + outer, "B = 0 + " + name, "C = 0 + " + outer]
+
+    def test_lengthens_colliding_names(self):
+        texts = ["X%d + Y + Z" % i for i in range(20)]
+        cse.NAME_LENGTH = 1
+        try:
+            definitions, outputs = cse.extract(["A%d = \x02%s\x03 + \x02%s\x03" % (i, text, text) for i, text in enumerate(texts)])
+        finally:
+            cse.NAME_LENGTH = 8
+        # 20 texts cannot have distinct names of 1 hexadecimal digit
+        names = dict((text, name) for name, text in definitions)
+        assert len(set(names.values())) == 20
+        assert any(len(name) > len("CSE_0") for name in names.values())
+        for text, name in names.items():
+            assert hashlib.md5(text).hexdigest().upper().startswith(name[len("CSE_"):])
+        assert outputs == ["A%d = %s + %s" % (i, names[text], names[text]) for i, text in enumerate(texts)]
@@ -0,0 +1,94 @@
+from .. import grammar, fastparser, benchmark
+import random
+from pyparsing import ParseException
+
+# Formulas on which fastparser.py is checked against grammar.formula, including the quirks of the grammar
+CORPUS = [
+    "Q = QD + QM",
+    "Q[c] = QD[c] + QM[c], c in 01 02 03",
+    "|V|[com] = |V|D[com] + |V|M[com], V in Q CH G I DS, com in 01 02 03 04 05 06 07 08 09",
+    "|V|_energy[c](-1) = Price|O|[c](t) * 2, V in Q, O in A B, c in 01",
+    "X[c, s] = PHI[$c, $s] * Q[c, s], c in 01 02 03, s in 01 02",
+    "Q[s] = sum(Q[c, s] if Q[c, s] <> 0, c in 01 02 03), s in 10 11 12",
+    "Q = sum(sum(Y[c, s], s in 1 2) if Y[c] <> 0, c in 01 02)",
+    "!pv |V|[c] = sum(|V|D[c, s] + |V|M[c, s] if |V|D[c, s] <> 0, s in 01 02), V in Q CH, c in 01 02",
+    "!p X = Y", "!Pv X = Y", "!P X = Y",
+    "Y[c] = X[c] if X[c] > 0 and X[c] <= 3 or X[c] == 1 xor X[c] >= 2, c in 01 02 03 \\ 02",
+    "(X + Y) * Z[c] = 1, (c, d) in (01 02, 03 04)",
+    "X[c, d] = 1, (c, d) in (01 02, 03 04), s in a b",
+    "A = - 1.5 * B", "A = -1", "A = + B", "A = B*-1 + f(a, b[c]) ^ (2 - -3.25) / 4",
+    "X = value(Y[c]) + value(Y), c in 01",
+    "d(log(X)) = d(log(Y[c])) - 0.5 * (log(X(-1)) - log(Y(-1))), c in 01",
+    "X(-1) = Y(d)",
+    "X = sum(A, B)",
+    "X = summary(A)",
+    "X = Y if Y > 0",
+    "X = Y Z",
+    "X = Y in",
+    "X == Y",
+    "X = Y, c in $ab",
+    "X = Y[c] if Y[c] > 0 orange, c in 01",
+    "@elem(X, 2006) = %a + $b",
+    "  !pv   X[c]\t=\nY[c] ,  c in  01  02  ",
+    "X = (((Y)))",
+    "Y[c, s] = X[c, s] * $c, c in 01..24 \\ 05 07..09 & %energy 01, s in %sectors",
+    "Y[c] = X[c], (c, d) in (1..3, %a_b 4..6)",
+    "Y[c] = X[c], c in _coms",
+]
+
+class TestFastParser(object):
+    def check(self, code):
+        try:
+            formula = fastparser.parse_formula(code)
+        except fastparser.Unsupported:
+            return False
+        assert formula is grammar.formula.parseString(code)[0], code
+        return True
+
+    def test_builds_the_same_Formulas_as_the_grammar(self):
+        for code in CORPUS:
+            assert self.check(code), code
+
+    def test_builds_the_same_Formulas_as_the_grammar_for_benchmarks(self):
+        for _, code in benchmark.synthetic_formulas(3, 2):
+            assert self.check(code), code
+
+    # Random edits of the corpus, most of which are not formulas: each is either parsed
+    # as by the grammar, or left to it
+    def test_parses_edited_formulas_as_the_grammar_or_not_at_all(self):
+        rng = random.Random(42)
+        characters = "XY01 ,()[]|=<>-+*.\\"
+        parsed = 0
+        for _ in range(500):
+            code = list(rng.choice(CORPUS))
+            for _ in range(rng.randint(1, 3)):
+                i = rng.randrange(len(code))
+                if rng.random() < 0.5:
+                    del code[i]
+                else:
+                    code.insert(i, rng.choice(characters))
+            parsed += self.check(''.join(code))
+        assert parsed > 100
+
+    def test_leaves_invalid_or_partial_formulas_to_the_grammar(self):
+        for code in ["", "= X", "X = Y )", "X = Y, c in my_set", "X = 2if Y", "X = Y[c"]:
+            try:
+                fastparser.parse_formula(code)
+                assert False, code
+            except fastparser.Unsupported:
+                pass
+        assert fastparser.parse("X = Y )") is grammar.formula.parseString("X = Y )")[0]
+        try:
+            fastparser.parse("= X")
+            assert False
+        except ParseException:
+            pass
+
+    def test_can_be_disabled(self):
+        def parse_formula(code):
+            assert False
+        fastparser.enabled, fastparser.parse_formula, original = False, parse_formula, fastparser.parse_formula
+        try:
+            assert fastparser.parse("Q = QD + QM") is grammar.formula.parseString("Q = QD + QM")[0]
+        finally:
+            fastparser.enabled, fastparser.parse_formula = True, original
@@ -0,0 +1,41 @@
+from .. import grammar, folding
+import os, shutil, tempfile
+
+class TestFolding(object):
+    def setup(self):
+        self.heap = {'PHI_01': 0.75, 'PHI_02': 0., 'PHI_03': None, 'CH_01': 3., 'CH_02': -1., 'ONE': 1.}
+        self.fixed = frozenset(self.heap)
+
+    def compile(self, code):
+        return grammar.formula.parseString(code)[0].compile(self.heap, self.fixed)
+
+    def test_folds_fixed_parameters_and_drops_zero_terms(self):
+        assert self.compile("X[c] = 2 * PHI[c] * Y[c] + 0 * Z[c], c in 01 02 03") == "\n".join([
+            "' folded PHI_01 = 0.75: X_01 = 2 * PHI_01 * Y_01 + 0 * Z_01", "X_01 = 1.5 * Y_01",
+            "' folded PHI_02 = 0: X_02 = 2 * PHI_02 * Y_02 + 0 * Z_02", "X_02 = 0",
+            "X_03 = 2 * PHI_03 * Y_03 + 0 * Z_03"])
+
+    def test_evaluates_known_guards(self):
+        assert self.compile("Y[c] = (CH[c] > 0) * CH[c] + W[c], c in 01 02").splitlines()[1::2] == [
+            "Y_01 = W_01 + 3", "Y_02 = W_02"]
+
+    def test_folds_powers_divisions_and_constants(self):
+        assert self.compile("A = X / ONE - PHI_01 ^ 2 * Y + ONE").splitlines()[1] == "A = X - 0.5625 * Y + 1"
+
+    def test_leaves_sums_and_price_equations(self):
+        assert self.compile("A = ONE * sum(B[s], s in 1 2) + PHI_02 * X").splitlines()[1] == "A = 1 * 0 + B_1 + B_2"
+        assert self.compile("!pv Q = ONE * Z").splitlines()[2:] == ["PQ * Q = PONE * ONE * PZ * Z", "Q = Z"]
+
+    def test_leaves_equations_without_fixed_parameters(self):
+        code = "X[c] = 2 * 3 * Y[c], c in 01 02"
+        assert self.compile(code) == grammar.formula.parseString(code)[0].compile(self.heap)
+
+    def test_reads_fixed_parameters(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'fixed.txt')
+            with open(path, 'w') as f:
+                f.write("' Parameters\nphi_01 PHI_02\nONE\n")
+            assert folding.read_fixed(path) == frozenset(['PHI_01', 'PHI_02', 'ONE'])
+        finally:
+            shutil.rmtree(directory)
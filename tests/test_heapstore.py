@@ -0,0 +1,61 @@
+from .. import heapstore
+from ..heapstore import HeapStore, read_csv
+import os, shutil, tempfile, time
+
+class TestHeapStore(object):
+    @classmethod
+    def setup_class(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.csv = os.path.join(cls.directory, 'tmp_all_vars.csv')
+        with open(cls.csv, 'wb') as f:
+            f.write("obs,Q_01,CH_01,X_NA\n,,,\n2006,15.5,0.000000,NA\n")
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_maps_names_to_values(self):
+        heap = HeapStore.open(self.csv)
+        assert isinstance(heap, HeapStore)
+        assert heap['Q_01'] == 15.5 and heap['CH_01'] == 0 and heap['X_NA'] is None
+        assert 'Q_01' in heap and 'Q_02' not in heap
+        assert list(heap.keys()) == ['CH_01', 'Q_01', 'X_NA', 'obs']
+        assert len(heap) == 4
+        try:
+            heap['Q_02']
+            assert False
+        except KeyError:
+            pass
+        heap.close()
+
+    def test_matches_csv(self):
+        heap = HeapStore.open('../tmp_all_vars.csv')
+        values = read_csv('../tmp_all_vars.csv')
+        assert len(heap) == len(values)
+        assert all(heap[name] == value for name, value in values.items())
+        heap.close()
+
+    def test_rebuilds_only_when_csv_changes(self):
+        path = os.path.join(self.directory, 'changing.csv')
+        shutil.copy(self.csv, path)
+        HeapStore.open(path).close()
+        # Touching the CSV without changing its content keeps the cache
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        heap = HeapStore.open(path)
+        assert heap.mtime == os.stat(path).st_mtime
+        assert heap['Q_01'] == 15.5
+        heap.close()
+        with open(path, 'wb') as f:
+            f.write("obs,Q_01\n,\n2006,42\n")
+        heap = HeapStore.open(path)
+        assert heap['Q_01'] == 42 and len(heap) == 2
+        heap.close()
+
+    def test_diffs_heaps(self):
+        old = {'A': 1., 'B': 2., 'C': None, 'D': 4.}
+        new = {'A': 1., 'B': 3., 'C': 0., 'E': 5.}
+        assert heapstore.diff(old, new) == (['B', 'C'], ['E'], ['D'])
+        assert heapstore.diff(old, new).names() == set(['B', 'C', 'D', 'E'])
+        heap = HeapStore.open(self.csv)
+        assert heapstore.diff(heap, read_csv(self.csv)) == ([], [], [])
+        heap.close()
@@ -0,0 +1,51 @@
+from .. import namedsets, batch, grammar
+import os, shutil, tempfile
+
+class TestNamedSets(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.sets = os.path.join(self.directory, 'sets.txt')
+
+    def teardown(self):
+        namedsets.define([])
+        shutil.rmtree(self.directory)
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def test_reads_sets(self):
+        self.write(self.sets, "' Commodities\n%coms in 01..04\n\n%energy in %coms & 03 04 05\n")
+        sets = namedsets.read_sets(self.sets)
+        assert [name for name, _ in sets] == ['%coms', '%energy']
+        namedsets.define(sets)
+        assert sets[1][1].compile() == ['03', '04']
+
+    def test_redefines_sets(self):
+        self.write(self.sets, "%s in 01 02\n")
+        namedsets.define(namedsets.read_sets(self.sets))
+        formula = grammar.formula.parseString("Y[c] = sum(X[c, s], s in %s), c in 01")[0]
+        assert formula.compile({}) == "Y_01 = 0 + X_01_01 + X_01_02"
+        self.write(self.sets, "%s in 01 02 03\n")
+        namedsets.define(namedsets.read_sets(self.sets))
+        assert formula.compile({}) == "Y_01 = 0 + X_01_01 + X_01_02 + X_01_03"
+
+    def test_rejects_sets_referring_to_later_sets(self):
+        self.write(self.sets, "%energy in %coms & 03 04\n%coms in 01..04\n")
+        try:
+            namedsets.read_sets(self.sets)
+            assert False
+        except NameError as e:
+            assert "Line 1" in str(e) and "%coms" in str(e)
+
+    def test_compiles_model_with_sets(self):
+        self.write(self.sets, "%coms in 01..03\n")
+        model = os.path.join(self.directory, 'model.txt')
+        output = os.path.join(self.directory, 'output.txt')
+        self.write(model, "Q[c] = QD[c], c in %coms \\ 02\n")
+        for processes in [1, 2]:
+            assert batch.compile_model(model, output, '../tmp_all_vars.csv', processes,
+                                       sets = namedsets.read_sets(self.sets)) == 0
+            assert open(output).read() == "' 1: Q[c] = QD[c], c in %coms \\ 02\nQ_01 = QD_01\nQ_03 = QD_03\n"
+        namedsets.define([])
+        assert batch.compile_model(model, output, '../tmp_all_vars.csv', 1) == 1
@@ -0,0 +1,33 @@
+from .. import ordering
+from StringIO import StringIO
+
+class TestOrdering(object):
+    def test_variables_exclude_lags_and_functions(self):
+        assert ordering.variables("dlog(Q_01) + Q_02(-1) + X(+1) + 2.5e3 * @elem(PQ, 2006)") == ['Q_01', 'X', 'PQ']
+
+    def test_endogenous_is_first_variable_of_lhs(self):
+        assert ordering.analyse("PQ_01 * Q_01 = PD_01 * QD_01") == ('PQ_01', set(['Q_01', 'PD_01', 'QD_01']))
+        assert ordering.analyse("dlog(Q) = dlog(Q(-1))") == ('Q', set())
+
+    def test_blocks_in_topological_order(self):
+        equations = ["A = B + Y", "Y = X + 1", "B = 0.5 * A", "X = 2 * Z", "W = W(-1) + A"]
+        assert ordering.blocks(equations) == [
+            (False, ["X = 2 * Z", "Y = X + 1"]),
+            (True, ["A = B + Y", "B = 0.5 * A"]),
+            (False, ["W = W(-1) + A"])]
+
+    def test_self_reference_is_simultaneous(self):
+        assert ordering.blocks(["X = 0.5 * X + 1"]) == [(True, ["X = 0.5 * X + 1"])]
+
+    def test_long_chain_does_not_recurse(self):
+        count = 100000
+        equations = ["X%d = X%d + 1" % (i, i + 1) for i in range(count)] + ["X%d = X0" % count]
+        result = ordering.blocks(equations)
+        assert len(result) == 1 and result[0][0] and len(result[0][1]) == count + 1
+
+    def test_write_blocks(self):
+        f = StringIO()
+        stats = ordering.write_blocks(ordering.blocks(["A = B", "B = A", "C = A"]), f)
+        assert stats["largest_block"] == 2 and stats["blocks"] == 2
+        assert f.getvalue().splitlines()[1:] == ["' BLOCK 1: simultaneous, 2 equations", "A = B", "B = A",
+                                                  "' BLOCK 2: recursive, 1 equation", "C = A"]
@@ -0,0 +1,35 @@
+from .. import grammar, parallel
+
+class TestParallel(object):
+    def setup(self):
+        self.minBindings, self.processes = parallel.MIN_BINDINGS, parallel.processes
+        parallel.MIN_BINDINGS, parallel.processes = 10, 2
+
+    def teardown(self):
+        parallel.MIN_BINDINGS, parallel.processes = self.minBindings, self.processes
+
+    def test_partitions_outermost_iterators_in_order(self):
+        iterators = [(['V'], ['Q', 'CH']), (['c'], ['01', '02', '03']), (['s'], ['1', '2'])]
+        partitions = list(parallel.partitions(iterators, 4))
+        assert [p[:2] for p in partitions] == [[(['V'], [v]), (['c'], [c])] for v in ['Q', 'CH'] for c in ['01', '02', '03']]
+        assert all(p[2] == iterators[2] for p in partitions)
+
+    def test_compiles_in_parallel_in_original_order(self):
+        formula = grammar.formula.parseString("|V|[c, s] = sum(|V|[c, s, t] if |V|D[c, s] <> 3, t in 1 2) + PHI[$c, $s], "
+                                              "V in Q CH, c in 01 02 03, s in 1 2 3 4")[0]
+        heap = dict(('%sD_%s_%s' % (v, c, s), float(i)) for i, (v, c, s) in
+                    enumerate((v, c, s) for v in ['Q', 'CH'] for c in ['01', '02', '03'] for s in '1234'))
+        iterators = formula.iterator_values()
+        assert parallel.wanted(iterators, heap) and not parallel.wanted(iterators, object())
+        expected = "\n".join(formula.compile_partition(heap, None, iterators))
+        assert formula.compile(heap) == expected
+        assert len(expected.splitlines()) == 24
+
+    def test_records_heap_values_read_by_workers(self):
+        from ..incremental import RecordingHeap
+        formula = grammar.formula.parseString("X[c, s] = Y[c, s] if Y[c, s] > 0, c in 01 02 03, s in 1 2 3 4")[0]
+        heap = dict(('Y_%s_%s' % (c, s), 1.) for c in ['01', '02', '03'] for s in '1234')
+        recordingHeap = RecordingHeap(heap)
+        assert parallel.wanted(formula.iterator_values(), recordingHeap)
+        assert len(formula.compile(recordingHeap).splitlines()) == 12
+        assert recordingHeap.reads == heap
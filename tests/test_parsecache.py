@@ -0,0 +1,63 @@
+from .. import grammar
+from .. import parsecache
+from ..parsecache import ParseCache
+import os, shutil, tempfile
+
+class TestParseCache(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def test_returns_parsed_Formula_from_disk(self):
+        code = "Q[s] = sum(Q[c, s] if Q[c, s] <> 0, c in 01 02 03), s in 10 11 12"
+        formula = ParseCache(self.directory).parse(code)
+        assert formula == grammar.formula.parseString(code)[0]
+        cache = ParseCache(self.directory)
+        cached = cache.get(code)
+        assert cached == formula
+        assert isinstance(cached, grammar.Formula) and isinstance(cached.iterators[0], grammar.Iter)
+        assert cached.compile({'Q_01_10': 1, 'Q_02_10': 0, 'Q_03_10': 0,
+                               'Q_01_11': 0, 'Q_02_11': 0, 'Q_03_11': 0,
+                               'Q_01_12': 0, 'Q_02_12': 0, 'Q_03_12': 2}) == "Q_10 = 0 + Q_01_10\nQ_11 = 0\nQ_12 = 0 + Q_03_12"
+
+    def test_caches_non_ASCII_formulas(self):
+        code = "X = Y + Z \xc3\xa9"
+        formula = ParseCache(self.directory).parse(code)
+        assert ParseCache(self.directory).get(code) == formula
+        assert formula.compile({}) == "X = Y + Z"
+        assert ParseCache(self.directory).key(u"X = Y + Z \xe9") == ParseCache(self.directory).key(code)
+
+    def test_bounds_Formulas_kept_in_memory(self):
+        cache = ParseCache(self.directory)
+        parsecache.MAX_MEMO, previous = 3, parsecache.MAX_MEMO
+        try:
+            for i in range(10):
+                cache.parse("Q = QD + %d" % i)
+                assert len(cache.memo) <= 3
+        finally:
+            parsecache.MAX_MEMO = previous
+        assert cache.parse("Q = QD + 0") == grammar.formula.parseString("Q = QD + 0")[0]
+
+    def test_ignores_entries_from_other_grammar_versions(self):
+        code = "Q = QD + QM"
+        ParseCache(self.directory).parse(code)
+        cache = ParseCache(self.directory)
+        cache.version = 'other'
+        assert cache.get(code) is None
+
+    def test_evicts_least_recently_used_entries(self):
+        cache = ParseCache(self.directory, max_bytes = 10 ** 9)
+        for i in range(10):
+            cache.parse("Q%d = QD + QM" % i)
+        size = sum(os.path.getsize(e) for e in cache.entries())
+        cache = ParseCache(self.directory, max_bytes = size / 2)
+        cache.parse("Q = QD + QM")
+        assert sum(os.path.getsize(e) for e in cache.entries()) <= size / 2
+        assert ParseCache(self.directory).get("Q = QD + QM") is not None
+
+    def test_interns_Formulas_loaded_from_disk(self):
+        code = "Q[c] = QD[c] + QM[c], c in 01 02"
+        formula = ParseCache(self.directory).parse(code)
+        assert ParseCache(self.directory).get(code) is formula
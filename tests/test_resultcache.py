@@ -0,0 +1,54 @@
+from .. import compilation
+from ..resultcache import ResultCache
+from StringIO import StringIO
+import os, shutil, tempfile
+
+class TestResultCache(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.resultCache = compilation.resultCache
+        compilation.resultCache = ResultCache(self.directory)
+
+    def teardown(self):
+        compilation.resultCache = self.resultCache
+        shutil.rmtree(self.directory)
+
+    def write(self, code, heap):
+        f = StringIO()
+        count = compilation.write_formula(code, heap, f)
+        return count, f.getvalue()
+
+    def test_reuses_output_for_same_values_read(self):
+        code = "Y[c] = sum(X[c, s] if X[c, s] > 0, s in 01 02), c in 01"
+        heap = {'X_01_01': 1., 'X_01_02': 0., 'Z': 1.}
+        assert self.write(code, heap) == (1, "Y_01 = 0 + X_01_01")
+        cache = compilation.resultCache
+        assert (cache.hits, cache.misses) == (0, 1)
+        # Unread values, and whitespace in the code, do not matter
+        heap['Z'] = 2.
+        assert self.write(code.replace(' = ', '  =  '), heap) == (1, "Y_01 = 0 + X_01_01")
+        assert (cache.hits, cache.misses) == (1, 1)
+        heap['X_01_02'] = 3.
+        assert self.write(code, heap) == (1, "Y_01 = 0 + X_01_01 + X_01_02")
+        assert (cache.hits, cache.misses) == (1, 2)
+        heap['X_01_02'] = 0.
+        assert self.write(code, heap) == (1, "Y_01 = 0 + X_01_01")
+        assert (cache.hits, cache.misses) == (2, 2)
+
+    def test_does_not_keep_errors(self):
+        try:
+            self.write("Y[c] = X[c] if X[c] > 0, c in 01", {})
+            assert False
+        except KeyError:
+            pass
+        assert compilation.resultCache.entries() == []
+        assert [name for name in os.listdir(self.directory) if name.endswith('.tmp')] == []
+
+    def test_evicts_least_recently_used_entries(self):
+        for i in range(10):
+            self.write("Q%d = QD + QM" % i, {})
+        size = sum(os.path.getsize(e) for e in compilation.resultCache.entries())
+        compilation.resultCache = cache = ResultCache(self.directory, max_bytes = size / 2)
+        self.write("Q = QD + QM", {})
+        assert sum(os.path.getsize(e) for e in cache.entries()) <= size / 2
+        assert cache.get("Q = QD + QM", {}) is not None
@@ -0,0 +1,39 @@
+from .. import scenarios, grammar
+import os, shutil, tempfile
+
+class TestScenarios(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def write_heap(self, name, values):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write("obs,QD_01,QD_02\n,,\n2006," + ",".join(values) + "\n")
+        return path
+
+    def test_compiles_Formula_against_heaps_at_once(self):
+        formula = grammar.formula.parseString("Y = sum(QD[c] if QD[c] <> 0, c in 01 02)")[0]
+        heaps = [{'QD_01': 1, 'QD_02': 0}, {'QD_01': 1, 'QD_02': 2}]
+        assert list(formula.compile_scenarios(heaps)) == [("Y = 0 + QD_01", "Y = 0 + QD_01 + QD_02")]
+        formula = grammar.formula.parseString("Q[c] = QD[c] if QD[c] <> 0, c in 01 02")[0]
+        assert list(formula.compile_scenarios(heaps)) == [("Q_01 = QD_01", "Q_01 = QD_01"), (None, "Q_02 = QD_02")]
+
+    def test_writes_outputs_and_differences(self):
+        model = os.path.join(self.directory, 'model.txt')
+        with open(model, 'w') as f:
+            f.write("Q[c] = QD[c] if QD[c] <> 0, c in 01 02\n"
+                    "Y = sum(QD[c] if QD[c] <> 0, c in 01 02)\n"
+                    "Z = QD[c] if QD[c] > 0\n")
+        heaps = [self.write_heap('h1.csv', ['1', '0']), self.write_heap('h2.csv', ['1', '0']), self.write_heap('h3.csv', ['1', '2'])]
+        outputs = [os.path.join(self.directory, 'out%d.txt' % i) for i in range(1, 4)]
+        report = os.path.join(self.directory, 'report.txt')
+        assert scenarios.compile_model(model, heaps, outputs, report) == 1
+        assert open(outputs[0]).read().splitlines()[:4] == ["' 1: Q[c] = QD[c] if QD[c] <> 0, c in 01 02", "Q_01 = QD_01",
+                                                            "' 2: Y = sum(QD[c] if QD[c] <> 0, c in 01 02)", "Y = 0 + QD_01"]
+        assert open(outputs[2]).read().splitlines()[5].startswith("' ERROR 3: ")
+        assert open(report).read().splitlines() == [
+            "' 1: Q[c] = QD[c] if QD[c] <> 0, c in 01 02", "Q_02 = QD_02: 3",
+            "' 2: Y = sum(QD[c] if QD[c] <> 0, c in 01 02)", "Y = 0 + QD_01: 1 2, Y = 0 + QD_01 + QD_02: 3"]
@@ -0,0 +1,54 @@
+from .. import compilation, server, protocol, client
+import os, shutil, tempfile, threading
+
+class TestServer(object):
+    @classmethod
+    def setup_class(cls):
+        cls.heap = compilation.load_heap('../tmp_all_vars.csv')
+        cls.server = server.make_server(cls.heap, "127.0.0.1:0")
+        cls.address = "%s:%d" % cls.server.server_address
+        cls.thread = threading.Thread(target = cls.server.serve)
+        cls.thread.start()
+
+    @classmethod
+    def teardown_class(cls):
+        protocol.request({"command": "shutdown"}, cls.address)
+        cls.thread.join()
+        cls.server.server_close()
+
+    def test_compiles_batch_of_formulas(self):
+        outputs = protocol.request({"formulas": ['"Q[c] = QD[c], c in 01 02"', "Q = QD + QM"]}, self.address)["outputs"]
+        assert outputs == ["Q_01 = QD_01\nQ_02 = QD_02", "Q = QD + QM"]
+
+    def test_reports_errors(self):
+        outputs = protocol.request({"formulas": ["= QD"]}, self.address)["outputs"]
+        assert outputs[0].startswith("Error\r\n")
+
+    def test_client_uses_server(self):
+        assert client.compile_formulas(["Q = QD + QM"], self.address) == ["Q = QD + QM"]
+
+    def test_client_falls_back_to_in_process_compilation(self):
+        cwd = os.getcwd()
+        os.chdir('..')
+        try:
+            assert client.compile_formulas(["Q[c] = QD[c], c in 01 02"], "127.0.0.1:1") == ["Q_01 = QD_01\nQ_02 = QD_02"]
+        finally:
+            os.chdir(cwd)
+
+    def test_reloads_heap_when_its_file_changes(self):
+        directory = tempfile.mkdtemp()
+        heap_path = os.path.join(directory, 'tmp_all_vars.csv')
+        def write_heap(values):
+            with open(heap_path, 'w') as f:
+                f.write("obs,X_01,X_02\n,,\n2006," + ",".join(values) + "\n")
+            os.utime(heap_path, (0, os.path.getmtime(heap_path) + 1))
+        write_heap(['1', '0'])
+        compileServer = server.make_server(compilation.load_heap(heap_path), "127.0.0.1:0", heap_path)
+        try:
+            formulas = ["Z[c] = X[c] if X[c] > 0, c in 01 02"]
+            assert compileServer.compile_all(formulas) == ["Z_01 = X_01"]
+            write_heap(['1', '2'])
+            assert compileServer.compile_all(formulas) == ["Z_01 = X_01\nZ_02 = X_02"]
+        finally:
+            compileServer.server_close()
+            shutil.rmtree(directory)
@@ -0,0 +1,50 @@
+import os, sys, shutil, subprocess, tempfile
+
+# eViews waits for the compiler on every formula: once a formula is in the parse cache,
+# compiling it must not import the grammar, pyparsing, numpy or funcy
+# The grammar and pyparsing are only imported for formulas which fastparser.py does not parse,
+# or with MODEL_PARSER=pyparsing
+# Measured at about 20 ms, excluding the interpreter startup
+STARTUP_TARGET = 0.1
+
+SCRIPT = """
+import sys, time
+start = time.time()
+sys.path.insert(0, %r)
+import compilation
+heap = compilation.load_heap(%r)
+output = compilation.compile_code("|V|[com] = |V|D[com] + |V|M[com], V in Q CH, com in 01 02", heap)
+assert output.startswith("Q_01 = QD_01 + QM_01"), output
+print time.time() - start
+print ' '.join(m for m in ['grammar', 'pyparsing', 'numpy', 'funcy'] if m in sys.modules)
+"""
+
+class TestStartup(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.script = SCRIPT % (package, os.path.join(package, 'tmp_all_vars.csv'))
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def compile_in_subprocess(self):
+        output = subprocess.check_output([sys.executable, '-c', self.script], cwd = self.directory).splitlines()
+        return float(output[0]), output[1].split() if len(output) > 1 else []
+
+    def test_cold_compilation_imports_the_grammar_only_with_pyparsing(self):
+        _, modules = self.compile_in_subprocess()
+        assert 'grammar' not in modules and 'pyparsing' not in modules
+        shutil.rmtree(os.path.join(self.directory, '_parse_cache'))
+        os.environ['MODEL_PARSER'] = 'pyparsing'
+        try:
+            _, modules = self.compile_in_subprocess()
+        finally:
+            del os.environ['MODEL_PARSER']
+        assert 'grammar' in modules and 'pyparsing' in modules
+
+    def test_cached_compilation_starts_fast(self):
+        self.compile_in_subprocess()
+        durations, modules = zip(*[self.compile_in_subprocess() for _ in range(3)])
+        assert all(m == [] for m in modules)
+        assert min(durations) < STARTUP_TARGET
@@ -0,0 +1,46 @@
+from .. import grammar, stats
+import os, json, shutil, tempfile
+
+class TestStats(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        os.environ['MODEL_STATS'] = '1'
+
+    def teardown(self):
+        del os.environ['MODEL_STATS']
+        stats.current = None
+        shutil.rmtree(self.directory)
+
+    def test_writes_counts_and_times_per_phase(self):
+        heap = {'R_01_10': 15, 'R_02_10': 0, 'R_03_10': 20, 'R_01_11': 0, 'R_02_11': 0, 'R_03_11': 0}
+        output = os.path.join(self.directory, 'out.txt')
+        stats.start_if_requested()
+        formula = grammar.formula.parseString("!pv R[s] = sum(R[c, s] if R[c, s] <> 0, c in 01 02 03), s in 10 11")[0]
+        with open(output, 'w') as f:
+            formula.write(stats.counted(heap), f)
+        stats.finish(output)
+        assert stats.current is None
+        result = json.load(open(output + '.stats.json'))
+        assert result["counts"] == {"bindings": 2 + 3, "conditions_evaluated": 2 * 2 * 3, "conditions_true": 2 * 2,
+                                    "heap_lookups": 2 * 2 * 3, "sum_expansions": 4, "lines": 4,
+                                    "bytes": os.path.getsize(output)}
+        assert set(result["times"]) == set(['iterate', 'conditions', 'emit', 'write'])
+        assert sum(result["times"].values()) <= result["total"]
+
+    def test_dumps_profile(self):
+        os.environ['MODEL_PROFILE'] = 'cprofile'
+        try:
+            output = os.path.join(self.directory, 'out.txt')
+            stats.start_if_requested()
+            grammar.formula.parseString("Q[c] = QD[c], c in 01 02")[0].compile({})
+            stats.finish(output)
+            assert os.path.exists(output + '.prof')
+        finally:
+            del os.environ['MODEL_PROFILE']
+
+    def test_is_disabled_by_default(self):
+        del os.environ['MODEL_STATS']
+        stats.start_if_requested()
+        heap = {}
+        assert stats.current is None and stats.counted(heap) is heap
+        os.environ['MODEL_STATS'] = '1'
@@ -0,0 +1,74 @@
+from .. import grammar, vectorized
+import itertools, random
+
+class TestVectorized(object):
+    @classmethod
+    def setup_class(cls):
+        random.seed(42)
+        values = [0., 1., -1., 2.5, 0.30000000000000004, None]
+        cls.heap = dict(('%s_%02d_%02d' % (v, c, s), random.choice(values))
+                        for v in ['Q', 'X'] for c in range(1, 7) for s in range(1, 7))
+        cls.heapWithoutNA = dict((k, v if v is not None else 1.) for k, v in cls.heap.items())
+        cls.bindings = [{grammar.VariableName('c'): '%02d' % c, grammar.VariableName('s'): '%02d' % s}
+                        for c, s in itertools.product(range(1, 7), range(1, 7))]
+
+    def check(self, code, heap = None):
+        heap = heap or self.heap
+        condition = grammar.condition.parseString("if " + code)[0]
+        expected = [bool(condition.evaluate(b, heap)) for b in self.bindings]
+        assert condition.evaluate_all(self.bindings, heap) == expected
+
+    def check_unsupported(self, code, heap = None):
+        condition = grammar.condition.parseString("if " + code)[0]
+        try:
+            condition.evaluate_all(self.bindings, heap or self.heap)
+            assert False
+        except vectorized.Unsupported:
+            pass
+
+    def test_comparisons(self):
+        for operator in ['<>', '<', '<=', '>', '>=', '==']:
+            self.check("Q[c, s] %s 0" % operator)
+            self.check("Q[c, s] %s X[c, s]" % operator)
+            self.check("2 %s X[c, s]" % operator)
+
+    def test_boolean_operators(self):
+        self.check("Q[c, s] > 0 and X[c, s] <> 0")
+        self.check("Q[c, s] > 0 or X[c, s] < 0 and Q[c, s] <> X[c, s]")
+        self.check("Q[c, s]")
+
+    def test_chained_comparisons(self):
+        self.check("0 < Q[c, s] <= 2")
+
+    def test_comparisons_of_constants(self):
+        self.check("1 > 0 and Q[c, s] > 0")
+        self.check("Q[c, s] < 0 > -1")
+        self.check("0 <> 0 or X[c, s] <= 1")
+        values = ' '.join('%02d' % c for c in range(1, 41))
+        formula = grammar.formula.parseString("Y[c] = X[c] if 1 > 0 and X[c] > 0, c in " + values)[0]
+        assert formula.compile(dict(('X_%02d' % c, c % 2) for c in range(1, 41))) == \
+            '\n'.join('Y_%02d = X_%02d' % (c, c) for c in range(1, 41, 2))
+
+    def test_arithmetic(self):
+        self.check("2 * Q[c, s] - 1 > -X[c, s] + 0.5", self.heapWithoutNA)
+        self.check("1 / 2 * Q[c, s] == 0", self.heapWithoutNA)
+        self.check("Q[c, s] / 2 > X[c, s] * 3", self.heapWithoutNA)
+
+    def test_na_handling(self):
+        self.check("Q[c, s] <> X[c, s] or Q[c, s] == X[c, s]")
+        self.check("Q[c, s] >= -1")
+
+    def test_falls_back_when_results_could_differ(self):
+        # Arithmetic on NA values, and divisions by zero, raise errors in the scalar evaluation
+        self.check_unsupported("Q[c, s] + 1 > 0")
+        self.check_unsupported("1 / Q[c, s] > 0", self.heapWithoutNA)
+        self.check_unsupported("Q[c, s] xor X[c, s]")
+        self.check_unsupported("Y[c, s] > 0")
+
+    def test_evaluates_Formula_conditions(self):
+        formula = grammar.formula.parseString("Y[c, s] = Q[c, s] if Q[c, s] <> 0 and X[c, s] > Q[c, s], "
+                                              "c in 01 02 03 04 05 06, s in 01 02 03 04 05 06")[0]
+        iteratorDicts = formula.build_iterator_dicts()
+        assert len(iteratorDicts) >= vectorized.MIN_BINDINGS
+        expected = [bool(formula.conditions[0].evaluate(b, self.heap)) for b in iteratorDicts]
+        assert formula.evaluate_conditions({}, self.heap, iteratorDicts) == expected
@@ -0,0 +1,113 @@
+from .. import watch
+import os, shutil, tempfile
+
+class TestWatch(object):
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.input = os.path.join(self.directory, 'in')
+        self.output = os.path.join(self.directory, 'out')
+        os.makedirs(self.input)
+        os.makedirs(self.output)
+        self.messages = []
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, filename, code):
+        path = os.path.join(self.input, filename)
+        with open(path, 'w') as f:
+            f.write(code + '\n')
+        return path
+
+    def read(self, filename):
+        return open(os.path.join(self.output, filename)).read()
+
+    def test_compiles_each_content_once(self):
+        for processes in [1, 2]:
+            watcher = watch.Watcher(self.output, '../tmp_all_vars.csv', processes, debounce = 0.05, log = self.messages.append)
+            path = self.write('a.txt', 'Q[c] = QD[c] + QM[c], c in 01 02')
+            for _ in range(5):
+                watcher.submit(path)
+            watcher.close()
+            assert self.read('a.txt') == "Q_01 = QD_01 + QM_01\nQ_02 = QD_02 + QM_02"
+            assert [m for m in self.messages if m.startswith("Compiling")] == ["Compiling a.txt"]
+            del self.messages[:]
+        assert sorted(os.listdir(self.output)) == ['a.txt']
+
+    def test_skips_content_already_compiled(self):
+        watcher = watch.Watcher(self.output, '../tmp_all_vars.csv', 1, debounce = 0.01, log = self.messages.append)
+        path = self.write('a.txt', 'Q = QD')
+        watcher.compile(path)
+        watcher.compile(path)
+        self.write('a.txt', 'Q = QM')
+        watcher.compile(path)
+        watcher.close()
+        assert self.read('a.txt') == "Q = QM"
+        assert self.messages.count("Compiling a.txt") == 2
+
+    def test_compiles_content_again_once_its_output_is_removed(self):
+        watcher = watch.Watcher(self.output, '../tmp_all_vars.csv', 1, debounce = 0.01, log = self.messages.append)
+        path = self.write('a.txt', 'Q = QD')
+        watcher.compile(path)
+        watcher.compile(path)
+        watcher.pool.close()
+        watcher.pool.join()
+        os.remove(os.path.join(self.output, 'a.txt'))
+        watcher.pool = watch.ThreadPool(1)
+        watcher.compile(path)
+        watcher.close()
+        assert self.read('a.txt') == "Q = QD"
+        assert self.messages.count("Compiling a.txt") == 2
+
+    def test_writes_errors(self):
+        watcher = watch.Watcher(self.output, '../tmp_all_vars.csv', 1, debounce = 0.01, log = self.messages.append)
+        watcher.compile(self.write('b.txt', '= QD[c], c in 01'))
+        watcher.close()
+        assert self.read('b.txt').startswith("Error\r\n")
+        assert self.messages[-1].startswith("Compilation failed: b.txt")
+
+    def test_compiles_again_after_failing_to_write_output(self):
+        watcher = watch.Watcher(self.output, '../tmp_all_vars.csv', 1, debounce = 0.01, log = self.messages.append)
+        path = self.write('a.txt', 'Q = QD')
+        os.rmdir(self.output)
+        watcher.compile(path)
+        watcher.pool.close()
+        watcher.pool.join()
+        assert self.messages[-1].startswith("Compilation failed: a.txt")
+        os.makedirs(self.output)
+        watcher.pool = watch.ThreadPool(1)
+        watcher.compile(path)
+        watcher.close()
+        assert self.read('a.txt') == "Q = QD"
+        assert self.messages.count("Compiling a.txt") == 2
+
+    def test_reloads_heap_and_invalidates_files_reading_changed_values(self):
+        heap_path = os.path.join(self.directory, 'tmp_all_vars.csv')
+        def write_heap(values):
+            with open(heap_path, 'w') as f:
+                f.write("obs,X_01,X_02,Y\n,,,\n2006," + ",".join(values) + "\n")
+            # The cache of the heap is rebuilt when the size or modification time of the CSV change
+            os.utime(heap_path, (0, os.path.getmtime(heap_path) + 1))
+        write_heap(['1', '0', '1'])
+        watcher = watch.Watcher(self.output, heap_path, 1, debounce = 0.01, log = self.messages.append)
+        diffs = []
+        watcher.listeners.append(diffs.append)
+        x = self.write('x.txt', 'Z[c] = X[c] if X[c] > 0, c in 01 02')
+        y = self.write('y.txt', 'W = Y if Y > 0')
+        watcher.compile(x)
+        watcher.compile(y)
+        watcher.pool.close()
+        watcher.pool.join()
+        assert self.read('x.txt') == "Z_01 = X_01"
+        previous = watch.heap
+        write_heap(['1', '2', '1'])
+        assert watcher.reload_heap() == (['X_02'], [], [])
+        assert diffs == [(['X_02'], [], [])]
+        watcher.pool = watch.ThreadPool(1)
+        watcher.compile(x)
+        watcher.compile(y)
+        watcher.close()
+        assert self.read('x.txt') == "Z_01 = X_01\nZ_02 = X_02"
+        # The worker closed the heap it replaced
+        assert watch.heap is not previous and previous.file.closed
+        assert self.messages.count("Compiling x.txt") == 2 and self.messages.count("Compiling y.txt") == 1
@@ -0,0 +1,183 @@
+# numpy is imported on first use, see load(), as importing it
+# would dominate the startup time of the compiler
+numpy = None
+
+# Vectorized evaluation of a Condition over every binding of the iterator product at once
+#
+# Conditions are evaluated by Expression.evaluate as a Python expression, one binding at a time.
+# Here the heap values of each operand are gathered into arrays (one element per binding),
+# and the operators are applied as array operations, following the precedence and semantics of
+# the Python expression: chained comparisons, `and` / `or`, integer division of integer literals,
+# and NA (None) values comparing lower than any number.
+#
+# Whenever the result could differ from the scalar evaluation (arithmetic on NA values,
+# division by zero, unsupported operators), Unsupported is raised so that the caller
+# falls back to the scalar evaluation, which raises the same errors as before.
+
+# Below this number of bindings, the scalar evaluation is faster
+MIN_BINDINGS = 32
+
+# Set to False to always use the scalar evaluation
+enabled = True
+
+class Unsupported(Exception): pass
+
+# Imports numpy, and returns whether the vectorized evaluation can be used
+def load():
+    global numpy, enabled
+    if enabled and numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            enabled = False
+    return enabled
+
+COMPARISON_OPERATORS = ['<>', '<', '<=', '>', '>=', '==']
+
+# Result of a comparison with an NA value, depending on which side(s) are NA
+NA_LEFT = ['<>', '<', '<=']
+NA_RIGHT = ['<>', '>', '>=']
+NA_BOTH = ['==', '<=', '>=']
+
+class Values(object):
+    def __init__(self, values, na, integers = False):
+        self.values = values
+        self.na = na
+        # Integer heap values (e.g. in hand-written heaps) use integer division in the scalar evaluation
+        self.integers = integers
+
+    @classmethod
+    def gather(cls, names, heap):
+        lookups = {}
+        for name in set(names):
+            try:
+                value = heap[name]
+            except KeyError:
+                raise Unsupported()
+            # Values are compared through their string representation in the scalar evaluation
+            lookups[name] = float(str(value)) if value is not None else None
+        values = [lookups[name] for name in names]
+        na = numpy.array([v is None for v in values], dtype = bool)
+        integers = any(isinstance(heap[name], (int, long)) for name in lookups)
+        return cls(numpy.array([v if v is not None else 0. for v in values], dtype = float), na, integers)
+
+def truth(operand, size):
+    if isinstance(operand, Values):
+        return (operand.values != 0) & ~operand.na
+    else:
+        return numpy.repeat(bool(operand), size)
+
+def compare(operator, left, right, size):
+    if not isinstance(left, Values) and not isinstance(right, Values):
+        return Values(numpy.repeat(float(eval(repr(left) + ' ' + operator + ' ' + repr(right))), size),
+                      numpy.zeros(size, dtype = bool))
+    leftValues, leftNa = (left.values, left.na) if isinstance(left, Values) else (left, numpy.zeros(size, dtype = bool))
+    rightValues, rightNa = (right.values, right.na) if isinstance(right, Values) else (right, numpy.zeros(size, dtype = bool))
+    if operator == '<>':
+        result = leftValues != rightValues
+    else:
+        result = eval('leftValues ' + operator + ' rightValues')
+    result = numpy.where(leftNa & ~rightNa, operator in NA_LEFT, result)
+    result = numpy.where(~leftNa & rightNa, operator in NA_RIGHT, result)
+    result = numpy.where(leftNa & rightNa, operator in NA_BOTH, result)
+    return Values(result.astype(float), numpy.zeros(size, dtype = bool))
+
+def arithmetic(operator, left, right):
+    if not isinstance(left, Values) and not isinstance(right, Values):
+        try:
+            return eval(repr(left) + ' ' + operator + ' ' + repr(right))
+        except ZeroDivisionError:
+            raise Unsupported()
+    for operand in [left, right]:
+        if isinstance(operand, Values) and operand.na.any():
+            raise Unsupported()
+    leftValues = left.values if isinstance(left, Values) else left
+    rightValues = right.values if isinstance(right, Values) else right
+    if operator == '/' and (numpy.any(numpy.asarray(rightValues) == 0) or
+                            any(isinstance(operand, Values) and operand.integers for operand in [left, right])):
+        raise Unsupported()
+    result = eval('leftValues ' + operator + ' rightValues')
+    size = len(left.values) if isinstance(left, Values) else len(right.values)
+    return Values(result, numpy.zeros(size, dtype = bool))
+
+# Precedence climbing over the flat list of tokens of an Expression
+# Each token is ('operator', text), ('number', int or float) or ('values', Values)
+class Evaluator(object):
+    def __init__(self, tokens, size):
+        self.tokens = tokens
+        self.size = size
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens) and self.tokens[self.position][0] == 'operator':
+            return self.tokens[self.position][1]
+
+    def next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def evaluate(self):
+        result = self.parse_or()
+        if self.position < len(self.tokens):
+            raise Unsupported()
+        return truth(result, self.size)
+
+    def parse_or(self):
+        left = self.parse_and()
+        while self.peek() == 'or':
+            self.next()
+            left = Values(truth(left, self.size) | truth(self.parse_and(), self.size), numpy.zeros(self.size, dtype = bool))
+        return left
+
+    def parse_and(self):
+        left = self.parse_comparison()
+        while self.peek() == 'and':
+            self.next()
+            left = Values(truth(left, self.size) & truth(self.parse_comparison(), self.size), numpy.zeros(self.size, dtype = bool))
+        return left
+
+    def parse_comparison(self):
+        operands = [self.parse_sum()]
+        operators = []
+        while self.peek() in COMPARISON_OPERATORS:
+            operators.append(self.next()[1])
+            operands.append(self.parse_sum())
+        if not operators:
+            return operands[0]
+        # Chained comparisons, e.g. 0 < X < 1, are evaluated pairwise
+        result = numpy.ones(self.size, dtype = bool)
+        for operator, left, right in zip(operators, operands, operands[1:]):
+            result &= compare(operator, left, right, self.size).values.astype(bool)
+        return Values(result.astype(float), numpy.zeros(self.size, dtype = bool))
+
+    def parse_sum(self):
+        left = self.parse_product()
+        while self.peek() in ['+', '-']:
+            operator = self.next()[1]
+            left = arithmetic(operator, left, self.parse_product())
+        return left
+
+    def parse_product(self):
+        left = self.parse_unary()
+        while self.peek() in ['*', '/']:
+            operator = self.next()[1]
+            left = arithmetic(operator, left, self.parse_unary())
+        return left
+
+    def parse_unary(self):
+        if self.peek() in ['+', '-']:
+            operator = self.next()[1]
+            return arithmetic('-' if operator == '-' else '+', 0, self.parse_unary())
+        if self.position >= len(self.tokens):
+            raise Unsupported()
+        kind, value = self.next()
+        if kind == 'operator':
+            raise Unsupported()
+        return value
+
+# Returns a list of booleans, one per binding
+def evaluate(tokens, size):
+    if not enabled:
+        raise Unsupported()
+    return list(Evaluator(tokens, size).evaluate())
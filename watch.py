@@ -0,0 +1,201 @@
+import os, sys, hashlib, threading, multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import compilation
+import heapstore
+import stats
+from incremental import RecordingHeap
+
+# Compilation of the formula files dropped in a directory, see async-compiler.py
+#
+# eViews and editors often fire several events for a single write: the events of each file
+# are debounced, and the file is only compiled once no event came for DEBOUNCE_SECONDS
+# A file whose content was already compiled, or is being compiled, is skipped, unless its output was removed
+#
+# Formulas are compiled in a pool of worker processes, which each load the heap once
+# Each output, compiled code or error message, is written to a temporary file first,
+# and then renamed, so that eViews never reads a partial output. If a file is changed again
+# while it is compiled, only the output of its latest content is kept
+# Formulas already compiled against the same heap values are copied from the result cache, see resultcache.py
+#
+# When the heap file is rewritten, e.g. by eViews, it is reloaded in the background, see reload_heap,
+# and compared with the previous one. The files whose formulas read variables which changed,
+# or were added or removed, are compiled again when they are next submitted, and the diff is passed
+# to the listeners, if any. Each compilation runs against a single heap, the latest one when it starts:
+# workers only switch to a new heap between compilations
+
+DEBOUNCE_SECONDS = 0.1
+
+# Replaces path with the file tmp_path
+# os.rename does not replace an existing file on Windows
+def replace_file(tmp_path, path):
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+# The heap, its path and version, and the fixed parameters of each worker
+heap = None
+heapPath = None
+heapVersion = 0
+fixed = None
+
+def init_worker(heap_path, fixed_parameters = None):
+    global heap, heapPath, heapVersion, fixed
+    heap = compilation.load_heap(heap_path)
+    heapPath = heap_path
+    heapVersion = 0
+    fixed = fixed_parameters
+
+# Compiles the code into tmp_path, against a heap at least as recent as version
+# Returns (number of equations, error message or None, names of the heap values read)
+# It always returns, as the pool has no error callback: if the heap cannot be reloaded,
+# or tmp_path written, the error is returned and tmp_path is left absent
+def compile_to(code, tmp_path, output_path, version = 0):
+    global heap, heapVersion
+    try:
+        if version > heapVersion:
+            previous, heap, heapVersion = heap, compilation.load_heap(heapPath), version
+            # The mapping of the previous cache would keep it from being rewritten on Windows
+            if hasattr(previous, 'close'):
+                previous.close()
+        stats.start_if_requested()
+        recordingHeap = RecordingHeap(heap)
+        with open(tmp_path, 'w') as f:
+            try:
+                count, error = compilation.write_formula(compilation.clean_code(code), stats.counted(recordingHeap), f, fixed), None
+            except Exception:
+                f.seek(0)
+                f.truncate()
+                count, error = 0, compilation.error_message()
+                f.write(error)
+        stats.finish(output_path)
+        return count, error, set(recordingHeap.reads)
+    except Exception:
+        error = compilation.error_message()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return 0, error, set()
+
+class Watcher(object):
+    def __init__(self, output_directory, heap_path = 'tmp_all_vars.csv', processes = None, fixed = None,
+                 debounce = DEBOUNCE_SECONDS, log = None):
+        self.outputDirectory = output_directory
+        self.heapPath = heap_path
+        self.debounce = debounce
+        self.log = log or (lambda message: sys.stdout.write(message + '\n'))
+        self.lock = threading.Lock()
+        # {filename: Timer} of the files waiting for their events to settle
+        self.timers = {}
+        # {filename: digest} of the latest content compiled, or being compiled, for each file
+        self.digests = {}
+        # {filename: generation} of the latest compilation of each file
+        self.generations = {}
+        # Filenames whose latest compilation is not done yet
+        self.pending = set()
+        # {filename: names of the heap values read} by the latest compilation of each file
+        self.reads = {}
+        # The heap, as loaded by this process, to compare it with the next one, and its version
+        self.heap = compilation.load_heap(heap_path)
+        self.heapVersion = 0
+        # Functions called with the HeapDiff of each reload
+        self.listeners = []
+        if processes == 1:
+            # In process, but still off the thread which receives the events
+            init_worker(heap_path, fixed)
+            self.pool = ThreadPool(1)
+        else:
+            self.pool = multiprocessing.Pool(processes, init_worker, (heap_path, fixed))
+
+    # Called for each event on the file at path
+    def submit(self, path):
+        self.debounced(os.path.basename(path), self.compile, path)
+
+    # Called for each event on the heap file
+    def submit_heap(self):
+        self.debounced(None, self.reload_heap)
+
+    def debounced(self, key, function, *args):
+        with self.lock:
+            if key in self.timers:
+                self.timers[key].cancel()
+            timer = self.timers[key] = threading.Timer(self.debounce, function, args)
+            timer.daemon = True
+            timer.start()
+
+    # Loads the heap file again, and swaps it with the previous heap once it is loaded
+    # Returns the HeapDiff between them
+    def reload_heap(self):
+        with self.lock:
+            self.timers.pop(None, None)
+        heap = compilation.load_heap(self.heapPath)
+        diff = heapstore.diff(self.heap, heap)
+        with self.lock:
+            previous, self.heap = self.heap, heap
+            self.heapVersion += 1
+            names = diff.names()
+            for filename, reads in self.reads.items():
+                if reads & names:
+                    self.digests.pop(filename, None)
+                    del self.reads[filename]
+        if hasattr(previous, 'close'):
+            previous.close()
+        self.log("Heap reloaded: %d changed, %d added, %d removed" % tuple(len(n) for n in diff))
+        for listener in self.listeners:
+            listener(diff)
+        return diff
+
+    def compile(self, path):
+        filename = os.path.basename(path)
+        try:
+            with open(path, 'r') as f:
+                code = f.readline().strip()
+        except IOError:
+            # e.g. the file was removed in the meantime
+            return
+        digest = hashlib.md5(code).hexdigest()
+        output_path = os.path.join(self.outputDirectory, filename)
+        with self.lock:
+            self.timers.pop(filename, None)
+            # Compiled again if its output was removed, e.g. by eViews once read
+            if self.digests.get(filename) == digest and (filename in self.pending or os.path.exists(output_path)):
+                return
+            self.pending.add(filename)
+            self.digests[filename] = digest
+            generation = self.generations[filename] = self.generations.get(filename, 0) + 1
+            version = self.heapVersion
+        self.log("Compiling " + filename)
+        tmp_path = '%s.%d.tmp' % (output_path, generation)
+        self.pool.apply_async(compile_to, (code, tmp_path, output_path, version),
+                              callback = lambda result: self.done(filename, generation, version, tmp_path, output_path, result))
+
+    def done(self, filename, generation, version, tmp_path, output_path, result):
+        count, error, reads = result
+        with self.lock:
+            latest = self.generations.get(filename) == generation
+            written = os.path.exists(tmp_path)
+            if latest:
+                self.pending.discard(filename)
+                # Nothing was written if compile_to failed before compiling
+                if written:
+                    replace_file(tmp_path, output_path)
+                    self.reads[filename] = reads
+                # Compiled again if it is submitted again, e.g. once the heap is fixed,
+                # or if the heap was reloaded during the compilation
+                if error is not None or version != self.heapVersion:
+                    self.digests.pop(filename, None)
+        if not latest:
+            if written:
+                os.remove(tmp_path)
+        elif error is None:
+            self.log("Compilation successful: " + str(count) + " equation(s)")
+        else:
+            self.log("Compilation failed: " + filename + ": " + error.splitlines()[-1])
+
+    # Waits for the files submitted to be compiled
+    def close(self):
+        with self.lock:
+            timers = self.timers.values()
+        for timer in timers:
+            timer.join()
+        self.pool.close()
+        self.pool.join()